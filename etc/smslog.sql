@@ -0,0 +1,9 @@
+/*  The indexes of the SMS log (StoredSMS), for databases whose table was made before
+ they were declared (syncdb makes them for a new table, but leaves existing ones alone).
+ The pages of / and /messages are read newest first on ("when", id), for everyone or
+ for one sender; /messages/since reads on the primary key.
+ Built concurrently, so that the SMS keep coming in meanwhile:
+   psql thousanddays thousanddays -f etc/smslog.sql
+*/
+CREATE INDEX CONCURRENTLY IF NOT EXISTS thoureport_storedsms_when_id ON thoureport_storedsms ("when", id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS thoureport_storedsms_sender_when_id ON thoureport_storedsms (sender, "when", id);
@@ -0,0 +1,107 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+# What the benchmark commands share: timing, latency summaries, allocation counts, and
+# the JSON results files that let one run be compared with another.
+
+from timeit import default_timer as clock
+import datetime
+import gc
+import json
+import os
+import platform
+import sys
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+def percentile(vals, pct):
+  'Returns the `pct` percentile of the sorted list `vals` (the nearest rank).'
+  if not vals:
+    return None
+  ind = int(round(pct / 100.0 * (len(vals) - 1)))
+  return vals[ind]
+
+def summary(secs):
+  'Summarises the durations `secs` (in seconds) as a hash of their count, mean, and percentiles, the latter in microseconds.'
+  vals  = sorted(secs)
+  if not vals:
+    return {'count': 0}
+  ans   = {'count': len(vals), 'mean': 1e6 * sum(vals) / len(vals)}
+  for nom, pct in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]:
+    ans[nom]  = 1e6 * percentile(vals, pct)
+  return ans
+
+def throughput(fn, items, rounds = 3):
+  '''Calls `fn` on each of the `items`, `rounds` times over, and returns the best rate (items per second) of the rounds.
+The garbage collector is left running, as it would be in production.'''
+  best  = None
+  for _ in range(rounds):
+    began = clock()
+    for it in items:
+      fn(it)
+    took  = clock() - began
+    if best is None or took < best:
+      best  = took
+  return len(items) / best if best else None
+
+def latencies(fn, items):
+  'Calls `fn` on each of the `items`, and returns the list of the durations of the calls.'
+  ans = []
+  for it in items:
+    began = clock()
+    fn(it)
+    ans.append(clock() - began)
+  return ans
+
+def allocations(fn, items):
+  '''Counts what calling `fn` on each of the `items` allocates, keeping the results alive, and returns a hash of the counts per item.
+With `tracemalloc` (Python 3, or its backport), they are the memory blocks and bytes allocated; without, they are the objects that the garbage collector tracks, which are most of the containers and instances.'''
+  keep  = []
+  if tracemalloc:
+    tracemalloc.start()
+    snap  = tracemalloc.take_snapshot()
+    for it in items:
+      keep.append(fn(it))
+    stts  = tracemalloc.take_snapshot().compare_to(snap, 'filename')
+    tracemalloc.stop()
+    return {'blocks': float(sum([st.count_diff for st in stts])) / len(items),
+            'bytes':  float(sum([st.size_diff for st in stts])) / len(items)}
+  gc.collect()
+  gc.disable()
+  try:
+    before  = len(gc.get_objects())
+    for it in items:
+      keep.append(fn(it))
+    after   = len(gc.get_objects())
+  finally:
+    gc.enable()
+  return {'objects': float(after - before) / len(items)}
+
+def environment():
+  'Describes where the benchmark runs, for the results file.'
+  return {'when':     datetime.datetime.now().isoformat(),
+          'python':   sys.version.split()[0],
+          'platform': platform.platform(),
+          'machine':  platform.node()}
+
+def save_results(path, res):
+  'Writes the results `res` (a hash) to the JSON file `path`.'
+  drc = os.path.dirname(path)
+  if drc and not os.path.isdir(drc):
+    os.makedirs(drc)
+  with open(path, 'w') as fch:
+    json.dump(res, fch, indent = 2, sort_keys = True)
+
+def load_results(path):
+  'Reads back results saved with `save_results`.'
+  with open(path) as fch:
+    return json.load(fch)
+
+def ratio(new, old):
+  'Formats the change from `old` to `new` as a percentage.'
+  if not old or new is None:
+    return '-'
+  return '%+.1f%%' % (100.0 * (new - old) / old,)
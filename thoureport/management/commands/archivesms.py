@@ -0,0 +1,58 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.reports.reports import POOL
+from thoureport.smslog import PARTITIONS_SERVER, server_version, is_partitioned, expired, leftovers, archive_month, archive_path, read_archive
+from thousand.settings import SMS_RETENTION_MONTHS, SMS_ARCHIVE_DIR
+import json
+import os
+
+class Command(BaseCommand):
+  args        = '[archive ...]'
+  help        = '''Moves the months of the SMS log more than SMS_RETENTION_MONTHS old out of the database, into a gzipped file of JSON lines per month (appended to, never rewritten) in SMS_ARCHIVE_DIR, and finishes the archiving of those that was interrupted.
+With --read, writes out the SMS of the archives given instead, a JSON line each, for an audit.'''
+  option_list = BaseCommand.option_list + (
+    make_option('--months', type = 'int', default = SMS_RETENTION_MONTHS,
+      help = 'How many months before this one to keep (default: SMS_RETENTION_MONTHS).'),
+    make_option('--dir', default = SMS_ARCHIVE_DIR,
+      help = 'The directory of the archives (default: SMS_ARCHIVE_DIR).'),
+    make_option('--dry-run', action = 'store_true', default = False,
+      help = 'Only show the months that would be archived.'),
+    make_option('--read', action = 'store_true', default = False,
+      help = 'Write out the SMS of the archives given.'),
+    make_option('--sender', default = None,
+      help = 'With --read, only the SMS of this sender.'),
+  )
+
+  def handle(self, *args, **options):
+    if options['read']:
+      if not args:
+        raise CommandError('--read needs the archives to read.')
+      for path in args:
+        for sms in read_archive(path, options['sender']):
+          self.stdout.write(json.dumps(sms))
+      return
+    if options['months'] < 1:
+      raise CommandError('At least this month and the one before are kept.')
+    with POOL.transaction() as curz:
+      got = server_version(curz)
+      if got < PARTITIONS_SERVER:
+        raise CommandError('Partitioning the SMS log takes PostgreSQL 11 or later (this server_version_num is %d).' % (got,))
+      if not is_partitioned(curz):
+        raise CommandError('The SMS log is not partitioned; see `manage.py smspartitions --convert`.')
+      mths  = sorted(set(expired(curz, options['months']) + leftovers(curz, options['dir'])))
+    if not mths:
+      self.stdout.write('No month is more than %d months old.' % (options['months'],))
+      return
+    if options['dry_run']:
+      for mth in mths:
+        self.stdout.write('%s would go to %s.' % (mth.strftime('%B %Y'), archive_path(options['dir'], mth)))
+      return
+    if not os.path.isdir(options['dir']):
+      os.makedirs(options['dir'])
+    for mth in mths:
+      done  = archive_month(mth, options['dir'])
+      if done is None:
+        self.stdout.write('%s: left alone, as some of its SMS are still queued.' % (mth.strftime('%B %Y'),))
+      else:
+        self.stdout.write('%s: %d SMS archived to %s.' % (mth.strftime('%B %Y'), done, archive_path(options['dir'], mth)))
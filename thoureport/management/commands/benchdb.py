@@ -0,0 +1,143 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from thoureport.benchmarks import *
+from thoureport.messages.corpus import corpus
+from thoureport.messages.rapid1000messages import ThouMessage
+from thoureport.models import StoredSMS
+from thoureport.reports.reports import POOL
+from thoureport.views import REPORT_SET, MSG_ASSOC, SCHEMA
+from thousand.settings import REPORTS_POOL
+import threading
+
+def scenario(secs, rows = None):
+  'Summarises a scenario from the durations `secs` of its operations, which wrote `rows` rows in all (one per operation by default).'
+  ans         = summary(secs)
+  tot         = sum(secs)
+  ans['rows'] = len(secs) if rows is None else rows
+  ans['rate'] = ans['rows'] / tot if tot else None
+  return ans
+
+class Command(BaseCommand):
+  help        = '''Benchmarks the persistence path (StoredSMS.save, ThouMessage.create_in_db, ThouReport.save and save_many) on a throwaway database, across all the report tables: rows per second and latency percentiles, for single, batched and concurrent writes.
+The database is created next to the configured one (the role from etc/dbsetup.sql may create databases), and dropped at the end.'''
+  option_list = BaseCommand.option_list + (
+    make_option('--size', type = 'int', default = 1000,
+      help = 'Reports written per report table and scenario (default: 1000).'),
+    make_option('--batch', type = 'int', default = 100,
+      help = 'Reports per save_many call in the batched scenario (default: 100).'),
+    make_option('--threads', type = 'int', default = REPORTS_POOL['MAX'],
+      help = 'Writer threads in the concurrent scenario (default: the pool maximum).'),
+    make_option('--seed', type = 'int', default = 0,
+      help = 'Seed of the generated messages (default: 0).'),
+    make_option('--output', default = None,
+      help = 'Save the results to this JSON file.'),
+    make_option('--compare', default = None,
+      help = 'Compare the results with those saved in this JSON file.'),
+  )
+
+  def handle(self, *args, **options):
+    old = None
+    if options['compare']:
+      try:
+        old = load_results(options['compare'])
+      except (IOError, ValueError), e:
+        raise CommandError('Cannot read the results to compare with: %s' % (e,))
+    reps  = self.reports(options['size'], options['seed'])
+    if not reps:
+      raise CommandError('None of the report classes got a valid message to write.')
+    name  = connection.settings_dict['NAME']
+    test  = connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    try:
+      POOL.rebind(database = test)
+      SCHEMA.reset()
+      res = environment()
+      res.update({'size': options['size'], 'batch': options['batch'], 'threads': options['threads'], 'seed': options['seed'],
+                  'tables': sorted(set([rep.msg.__class__.creation_sql(rep.__class__)[0] for rep in reps]))})
+      res['scenarios']  = self.run(reps, options['batch'], options['threads'])
+    finally:
+      POOL.closeall()
+      connection.creation.destroy_test_db(name, verbosity = 0)
+      POOL.rebind(database = name)
+      SCHEMA.reset()
+    self.report(res, old)
+    if options['output']:
+      save_results(options['output'], res)
+      self.stdout.write('Results saved to %s.' % (options['output'],))
+
+  def reports(self, size, seed):
+    'Returns the list of the report objects of `size` valid generated messages for each report class, in the order they came.'
+    cods  = [cod for cod in sorted(REPORT_SET) if cod in MSG_ASSOC]
+    ans   = []
+    for _, msg, rep in ThouMessage.parse_many([(None, txt) for _, txt in corpus(size, seed, 0, 0, cods)], REPORT_SET):
+      if rep:
+        ans.append(rep)
+    return ans
+
+  def run(self, reps, batch, threads):
+    'Runs all the scenarios over the reports `reps`, returning the hash of their results.'
+    ans   = {}
+    # Before any table exists: the first call reads the catalog and creates the tables.
+    began = clock()
+    for rep in reps:
+      rep.msg.__class__.create_in_db(rep.__class__)
+    ans['create_in_db (first)'] = scenario([clock() - began], 0)
+    ans['create_in_db (warm)']  = scenario(latencies(lambda rep: rep.msg.__class__.create_in_db(rep.__class__), reps), 0)
+    def cold(rep):
+      SCHEMA.reset()
+      rep.msg.__class__.create_in_db(rep.__class__)
+    ans['create_in_db (catalog)'] = scenario(latencies(cold, reps[:100]), 0)
+    ans['StoredSMS.save']         = scenario(latencies(lambda rep: StoredSMS(message = 'benchmark', sender = '0').save(), reps))
+    ans['ThouReport.save']        = scenario(latencies(lambda rep: rep.save(), reps))
+    # The same saves, joining a transaction held open around them, with the commits timed apart.
+    ins = []
+    cmt = []
+    with POOL.connection() as conn:
+      for rep in reps:
+        began = clock()
+        rep.save()
+        mid   = clock()
+        conn.commit()
+        ins.append(mid - began)
+        cmt.append(clock() - mid)
+    ans['save (insert only)'] = scenario(ins)
+    ans['save (commit only)'] = scenario(cmt, 0)
+    chks  = [reps[sht:sht + batch] for sht in range(0, len(reps), batch)]
+    ans['ThouReport.save_many'] = scenario(latencies(lambda chk: chk[0].__class__.save_many(chk), chks), len(reps))
+    ans['ThouReport.save (%d threads)' % (threads,)] = self.concurrent(reps, threads)
+    return ans
+
+  def concurrent(self, reps, threads):
+    'Saves the reports `reps` one by one from `threads` threads at once, returning the scenario results.'
+    secs  = []
+    errs  = []
+    def writer(mine):
+      try:
+        secs.extend(latencies(lambda rep: rep.save(), mine))
+      except Exception, e:
+        errs.append(e)
+    thds  = [threading.Thread(target = writer, args = (reps[ind::threads],)) for ind in range(threads)]
+    began = clock()
+    for thd in thds:
+      thd.start()
+    for thd in thds:
+      thd.join()
+    took  = clock() - began
+    if errs:
+      raise CommandError('A writer failed: %s' % (errs[0],))
+    ans         = scenario(secs)
+    ans['rate'] = len(secs) / took if took else None
+    return ans
+
+  def report(self, res, old):
+    'Writes out the results `res`, next to those of the `old` run if there is one.'
+    self.stdout.write('%s, tables %s, %s' % (res['python'], ', '.join(res['tables']), res['when']))
+    self.stdout.write('%-32s %7s %10s %9s %9s %9s %9s%s' % ('scenario', 'ops', 'rows/s', 'p50 us', 'p90 us', 'p99 us', 'max us', '  rows/s vs old  p50 vs old' if old else ''))
+    for nom in sorted(res['scenarios']):
+      stt   = res['scenarios'][nom]
+      line  = '%-32s %7d %10s %9.1f %9.1f %9.1f %9.1f' % (nom, stt['count'], '%.0f' % (stt['rate'],) if stt['rows'] else '-', stt['p50'], stt['p90'], stt['p99'], stt['max'])
+      if old:
+        was   = old.get('scenarios', {}).get(nom, {})
+        line  = line + '  %14s %11s' % (ratio(stt['rate'], was.get('rate')) if stt['rows'] else '-', ratio(stt['p50'], was.get('p50')))
+      self.stdout.write(line)
@@ -0,0 +1,93 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.benchmarks import *
+from thoureport.messages.corpus import corpus
+from thoureport.messages.rapid1000messages import ThouMessage, UnknownMessage, MSG_ASSOC
+
+def reference_parse(msg):
+  'Parses `msg` as `ThouMessage.parse` does, but with the field-by-field `ThouMessage.process`.'
+  code, rem = ThouMessage.pull_code(msg.strip())
+  return ThouMessage.process(MSG_ASSOC.get(code.upper(), UnknownMessage), code, rem)
+
+PARSERS = {
+  'compiled':   ThouMessage.parse,
+  'reference':  reference_parse,
+}
+
+class Command(BaseCommand):
+  args        = '[code ...]'
+  help        = 'Benchmarks the parsing of a synthetic corpus of SMS of every message class (or those of the codes given): throughput, per-class latency percentiles and allocations.'
+  option_list = BaseCommand.option_list + (
+    make_option('--size', type = 'int', default = 2000,
+      help = 'Messages generated for each message class (default: 2000).'),
+    make_option('--invalid', type = 'float', default = 0.3,
+      help = 'Fraction of the messages that are spoilt (default: 0.3).'),
+    make_option('--unknown', type = 'float', default = 0.05,
+      help = 'Messages with unknown codes, as a fraction of the rest (default: 0.05).'),
+    make_option('--seed', type = 'int', default = 0,
+      help = 'Seed of the corpus generator; the same seed gives the same corpus (default: 0).'),
+    make_option('--rounds', type = 'int', default = 3,
+      help = 'Passes over the corpus for the throughput, of which the best counts (default: 3).'),
+    make_option('--parser', type = 'choice', choices = sorted(PARSERS), default = 'compiled',
+      help = 'The parser to measure: "compiled" (ThouMessage.parse) or "reference" (ThouMessage.process).'),
+    make_option('--output', default = None,
+      help = 'Save the results to this JSON file.'),
+    make_option('--compare', default = None,
+      help = 'Compare the results with those saved in this JSON file.'),
+  )
+
+  def handle(self, *args, **options):
+    cods  = [cod.upper() for cod in args]
+    for cod in cods:
+      if cod not in MSG_ASSOC:
+        raise CommandError('No message class for the code %s.' % (cod,))
+    old   = None
+    if options['compare']:
+      try:
+        old = load_results(options['compare'])
+      except (IOError, ValueError), e:
+        raise CommandError('Cannot read the results to compare with: %s' % (e,))
+    parse = PARSERS[options['parser']]
+    msgs  = corpus(options['size'], options['seed'], options['invalid'], options['unknown'], cods)
+    txts  = [txt for _, txt in msgs]
+    res   = environment()
+    res.update({'parser': options['parser'], 'size': options['size'], 'invalid': options['invalid'],
+                'unknown': options['unknown'], 'seed': options['seed'], 'messages': len(msgs)})
+    res['throughput']   = throughput(parse, txts, options['rounds'])
+    res['allocations']  = allocations(parse, txts)
+    lats  = latencies(parse, txts)
+    bycd  = {}
+    errs  = {}
+    for (cod, txt), lat in zip(msgs, lats):
+      bycd.setdefault(cod, []).append(lat)
+      if parse(txt).errors:
+        errs[cod] = errs.get(cod, 0) + 1
+    res['latency']  = summary(lats)
+    res['classes']  = {}
+    for cod in bycd:
+      res['classes'][cod]             = summary(bycd[cod])
+      res['classes'][cod]['errors']   = errs.get(cod, 0)
+      res['classes'][cod]['throughput'] = throughput(parse, [txt for cd, txt in msgs if cd == cod], options['rounds'])
+    self.report(res, old)
+    if options['output']:
+      save_results(options['output'], res)
+      self.stdout.write('Results saved to %s.' % (options['output'],))
+
+  def report(self, res, old):
+    'Writes out the results `res`, next to those of the `old` run if there is one.'
+    self.stdout.write('%d messages (%s parser, seed %d), %s' % (res['messages'], res['parser'], res['seed'], res['python']))
+    line  = 'Throughput: %.0f msg/s; allocations per message: %s' % (res['throughput'], ', '.join(['%.1f %s' % (res['allocations'][k], k) for k in sorted(res['allocations'])]))
+    if old:
+      line  = line + ' (throughput %s against %s)' % (ratio(res['throughput'], old.get('throughput')), old.get('when'))
+    self.stdout.write(line)
+    self.stdout.write('%-6s %7s %6s %10s %8s %8s %8s %8s%s' % ('code', 'msgs', 'errors', 'msg/s', 'p50 us', 'p90 us', 'p99 us', 'max us', '  p50 vs old' if old else ''))
+    for cod in sorted(res['classes']):
+      stt   = res['classes'][cod]
+      line  = '%-6s %7d %6d %10.0f %8.1f %8.1f %8.1f %8.1f' % (cod, stt['count'], stt['errors'], stt['throughput'], stt['p50'], stt['p90'], stt['p99'], stt['max'])
+      if old:
+        was   = old.get('classes', {}).get(cod, {})
+        line  = line + '  %s' % (ratio(stt['p50'], was.get('p50')),)
+      self.stdout.write(line)
+    stt   = res['latency']
+    self.stdout.write('%-6s %7d %6s %10.0f %8.1f %8.1f %8.1f %8.1f' % ('all', stt['count'], '', res['throughput'], stt['p50'], stt['p90'], stt['p99'], stt['max']))
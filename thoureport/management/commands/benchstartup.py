@@ -0,0 +1,79 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.benchmarks import *
+from thousand.settings import BASE_DIR, WSGI_WARM_UP
+import os
+import subprocess
+import sys
+
+ROOT    = os.path.abspath(BASE_DIR)
+
+# What is timed, each in a new Python process: the interpreter alone (for reference), loading
+# the parser (as the offline tools do), `manage.py help`, and the boot of the WSGI application.
+TARGETS = [
+  ('python',  ['-c', 'pass']),
+  ('parser',  ['-c', 'import thoureport.messages.rapid1000messages']),
+  ('manage',  [os.path.join(ROOT, 'manage.py'), 'help']),
+  ('wsgi',    ['-c', 'import thousand.wsgi']),
+]
+
+def boot_time(argv):
+  'Runs Python with the arguments `argv`, in the project directory, and returns how long it took, in seconds.'
+  env   = dict(os.environ, DJANGO_SETTINGS_MODULE = os.environ.get('DJANGO_SETTINGS_MODULE', 'thousand.settings'))
+  with open(os.devnull, 'w') as null:
+    began = clock()
+    code  = subprocess.call([sys.executable] + argv, cwd = ROOT, env = env, stdout = null)
+    took  = clock() - began
+  if code:
+    raise CommandError('`python %s` failed (exit status %d).' % (' '.join(argv), code))
+  return took
+
+class Command(BaseCommand):
+  args        = '[target ...]'
+  help        = 'Benchmarks the start-up of new processes: the Python interpreter alone, loading the parser, `manage.py help`, and the WSGI application (with WSGI_WARM_UP as set), or those of the targets given.'
+  option_list = BaseCommand.option_list + (
+    make_option('--runs', type = 'int', default = 10,
+      help = 'Processes started for each target (default: 10).'),
+    make_option('--output', default = None,
+      help = 'Save the results to this JSON file.'),
+    make_option('--compare', default = None,
+      help = 'Compare the results with those saved in this JSON file.'),
+  )
+
+  def handle(self, *args, **options):
+    known = dict(TARGETS)
+    for tgt in args:
+      if tgt not in known:
+        raise CommandError('No target %s (there are %s).' % (tgt, ', '.join([nom for nom, _ in TARGETS])))
+    old   = None
+    if options['compare']:
+      try:
+        old = load_results(options['compare'])
+      except (IOError, ValueError), e:
+        raise CommandError('Cannot read the results to compare with: %s' % (e,))
+    res   = environment()
+    res.update({'runs': options['runs'], 'warm_up': WSGI_WARM_UP, 'targets': {}})
+    for nom, argv in TARGETS:
+      if args and nom not in args:
+        continue
+      boot_time(argv)
+      res['targets'][nom] = summary([boot_time(argv) for _ in range(options['runs'])])
+    self.report(res, old)
+    if options['output']:
+      save_results(options['output'], res)
+      self.stdout.write('Results saved to %s.' % (options['output'],))
+
+  def report(self, res, old):
+    'Writes out the results `res` (in milliseconds), next to those of the `old` run if there is one.'
+    self.stdout.write('%d processes per target (WSGI warm-up %s), %s' % (res['runs'], 'on' if res['warm_up'] else 'off', res['python']))
+    self.stdout.write('%-8s %8s %8s %8s %8s%s' % ('target', 'mean ms', 'p50 ms', 'p90 ms', 'max ms', '  p50 vs old' if old else ''))
+    for nom, _ in TARGETS:
+      if nom not in res['targets']:
+        continue
+      stt   = res['targets'][nom]
+      line  = '%-8s %8.1f %8.1f %8.1f %8.1f' % (nom, stt['mean'] / 1000, stt['p50'] / 1000, stt['p90'] / 1000, stt['max'] / 1000)
+      if old:
+        was   = old.get('targets', {}).get(nom, {})
+        line  = line + '  %s' % (ratio(stt['p50'], was.get('p50')),)
+      self.stdout.write(line)
@@ -0,0 +1,110 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+from thoureport.models import QueuedSMS, StoredSMS
+from thoureport.reports.reports import POOL
+from thoureport.views import ingest
+from thousand.settings import INGEST_WORKERS, INGEST_BATCH, INGEST_POLL, INGEST_RETRY, INGEST_ATTEMPTS
+import json
+import multiprocessing
+import time
+
+class ClaimLost(Exception):
+  'Raised when a claimed SMS has been claimed again by another worker (as when it took longer than `INGEST_RETRY`), so that the reports saved for it are rolled back.'
+  pass
+
+def claim(size):
+  '''Claims up to `size` queued SMS (and those whose processing has not finished in `INGEST_RETRY` seconds, if they have attempts left) for this worker, returning the list of their (QueuedSMS id, StoredSMS id, attempts).
+Those that have not finished in time after their last attempt are marked failed. Rows claimed by other workers are skipped rather than waited for.'''
+  tbl = QueuedSMS._meta.db_table
+  with transaction.atomic():
+    curz  = connection.cursor()
+    curz.execute('''UPDATE %s SET state = 'failed', outcome = %%s WHERE id IN
+                      (SELECT id FROM %s WHERE state = 'working' AND claimed < NOW() - %%s * INTERVAL '1 second' AND attempts >= %%s
+                        FOR UPDATE SKIP LOCKED)''' % (tbl, tbl),
+                  (json.dumps({'error': 'Not processed after %d attempts.' % (INGEST_ATTEMPTS,)}), INGEST_RETRY, INGEST_ATTEMPTS))
+    curz.execute('''UPDATE %s SET state = 'working', claimed = NOW(), attempts = attempts + 1 WHERE id IN
+                      (SELECT id FROM %s WHERE state = 'queued' OR (state = 'working' AND claimed < NOW() - %%s * INTERVAL '1 second' AND attempts < %%s)
+                        ORDER BY id LIMIT %%s FOR UPDATE SKIP LOCKED)
+                    RETURNING id, sms_id, attempts''' % (tbl, tbl), (INGEST_RETRY, INGEST_ATTEMPTS, size))
+    return sorted(curz.fetchall())
+
+def process(got, sms):
+  '''Ingests the claimed SMS `got` (as `claim` gives them; `sms` has their StoredSMS by id), and records them as done in the transaction that saves their reports, so that the reports of an SMS are saved once, however often it is claimed.
+Raises ClaimLost if one of them was claimed again meanwhile, which rolls the whole transaction back.'''
+  tbl = QueuedSMS._meta.db_table
+  with POOL.transaction() as curz:
+    ans = ingest([(sms[sid].sender, sms[sid].message) for _, sid, _ in got])
+    for (qid, _, atts), res in zip(got, ans):
+      curz.execute("UPDATE %s SET state = 'done', outcome = %%s WHERE id = %%s AND state = 'working' AND attempts = %%s;" % (tbl,), (json.dumps(res), qid, atts))
+      if curz.rowcount != 1:
+        raise ClaimLost, ('Queued SMS %d was claimed again.' % (qid,))
+
+def work(size):
+  '''Processes one claimed batch of at most `size` SMS, returning how many there were.
+If the batch fails, its SMS are processed again one at a time, so that only those that fail on their own are requeued (or, after `INGEST_ATTEMPTS`, failed).'''
+  got = claim(size)
+  if not got:
+    return 0
+  sms = StoredSMS.objects.in_bulk([sid for _, sid, _ in got])
+  if len(got) > 1:
+    try:
+      process(got, sms)
+      return len(got)
+    except Exception:
+      pass
+  for one in got:
+    try:
+      process([one], sms)
+    except ClaimLost:
+      pass
+    except Exception, e:
+      qid, _, atts  = one
+      QueuedSMS.objects.filter(id = qid, state = 'working', attempts = atts).update(state = 'failed' if atts >= INGEST_ATTEMPTS else 'queued', outcome = json.dumps({'error': str(e)}))
+  return len(got)
+
+def worker(size, poll):
+  'The loop of a worker process: it drains the queue batch by batch, and sleeps `poll` seconds whenever it is empty.'
+  connection.close()
+  while True:
+    try:
+      if not work(size):
+        time.sleep(poll)
+    except KeyboardInterrupt:
+      return
+
+class Command(BaseCommand):
+  help        = 'Runs the pool of ingestion worker processes, which drain the queue that /sendsms and /sendsms/bulk fill when INGEST_ASYNC is set.'
+  option_list = BaseCommand.option_list + (
+    make_option('--processes', type = 'int', default = INGEST_WORKERS,
+      help = 'How many worker processes to run (default: INGEST_WORKERS).'),
+    make_option('--batch', type = 'int', default = INGEST_BATCH,
+      help = 'The most SMS a worker takes at a time (default: INGEST_BATCH).'),
+    make_option('--poll', type = 'float', default = INGEST_POLL,
+      help = 'Seconds a worker waits when the queue is empty (default: INGEST_POLL).'),
+    make_option('--once', action = 'store_true', default = False,
+      help = 'Drain the queue in this process, then stop.'),
+  )
+
+  def handle(self, *args, **options):
+    if options['once']:
+      done  = 0
+      while True:
+        got   = work(options['batch'])
+        done  = done + got
+        if not got:
+          break
+      self.stdout.write('Processed %d queued SMS.' % (done,))
+      return
+    connection.close()
+    POOL.closeall()
+    procs = [multiprocessing.Process(target = worker, args = (options['batch'], options['poll'])) for _ in range(options['processes'])]
+    for proc in procs:
+      proc.start()
+    try:
+      for proc in procs:
+        proc.join()
+    except KeyboardInterrupt:
+      for proc in procs:
+        proc.join()
@@ -0,0 +1,61 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.views import SCHEMA
+from thoureport.reports.reports import POOL
+from thousand.settings import CODE_BITMASKS
+
+def packing(tbl, fldc, have):
+  '''Returns the statement that moves the codes of the multiple field class `fldc` from their own columns (those of them in `have`) of the report table `tbl` into its bitmask, with the list of those columns; (None, []) if it has none of them.
+Only the rows whose bitmask is still NULL are filled, so that the rows saved since the bitmask was added are left alone, and it can run again.'''
+  sub   = fldc.subname()
+  cols  = [('%s_%s' % (sub, exp.lower()), exp) for exp in fldc.expectation_codes]
+  cols  = [(col, exp) for col, exp in cols if col in have]
+  if not cols:
+    return (None, [])
+  bits  = ' | '.join(['CASE WHEN %s THEN %d ELSE 0 END' % (col, fldc.bit(exp)) for col, exp in cols])
+  some  = ' OR '.join([col for col, _ in cols])
+  return ('UPDATE %s SET %s = %s WHERE %s IS NULL AND (%s);' % (tbl, sub, bits, sub, some), [col for col, _ in cols])
+
+class Command(BaseCommand):
+  help        = '''Moves the codes of the multiple fields of the report tables from their column per code (as they were stored before CODE_BITMASKS) into the bitmask of the field, and drops those columns.
+All the tables are done in a single transaction.'''
+  option_list = BaseCommand.option_list + (
+    make_option('--keep', action = 'store_true', default = False,
+      help = 'Fill the bitmasks, but keep the columns of the codes.'),
+    make_option('--dry-run', action = 'store_true', default = False,
+      help = 'Only show the statements.'),
+  )
+
+  def handle(self, *args, **options):
+    if not CODE_BITMASKS:
+      raise CommandError('The codes are stored a column per code; set CODE_BITMASKS to store them as bitmasks.')
+    SCHEMA.prepare()
+    stmts = []
+    done  = {}
+    for repc, msgc in SCHEMA.pairs:
+      tbl, _  = SCHEMA.creation_sql(msgc, repc)
+      have    = SCHEMA.columns(tbl)
+      for fldc in sorted(msgc.multiples(), key = lambda x: x.subname()):
+        if (tbl, fldc) in done:
+          continue
+        stmt, cols        = packing(tbl, fldc, have)
+        done[(tbl, fldc)] = cols
+        if not stmt:
+          continue
+        stmts.append(stmt)
+        if not options['keep']:
+          stmts.append('ALTER TABLE %s %s;' % (tbl, ', '.join(['DROP COLUMN %s' % (col,) for col in cols])))
+    if not stmts:
+      self.stdout.write('There are no columns of codes to pack.')
+      return
+    if options['dry_run']:
+      self.stdout.write('\n'.join(stmts))
+      return
+    with POOL.transaction() as curz:
+      for stmt in stmts:
+        curz.execute(stmt)
+    SCHEMA.reset()
+    for (tbl, fldc), cols in sorted(done.items()):
+      if cols:
+        self.stdout.write('%s: packed %d columns into %s%s.' % (tbl, len(cols), fldc.subname(), ' (kept)' if options['keep'] else ''))
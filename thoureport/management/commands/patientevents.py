@@ -0,0 +1,22 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from thoureport.views import REPORT_SET, MSG_ASSOC, SCHEMA
+from thoureport.reports.reports import POOL
+from thoureport.reports.events import rebuild_events, patient_field
+
+class Command(BaseCommand):
+  args        = '[code ...]'
+  help        = 'Recomputes the patient timeline from the rows of the report tables (all of those in REPORT_SET, or those of the codes given), as for the reports saved before it was kept.'
+
+  def handle(self, *args, **options):
+    cods  = [cod.upper() for cod in args] or sorted(REPORT_SET)
+    for cod in cods:
+      try:
+        repc, msgc  = REPORT_SET[cod], MSG_ASSOC[cod]
+      except KeyError:
+        raise CommandError('No report for the code %s.' % (cod,))
+      tbl, _  = SCHEMA.ensure(msgc, repc)
+      with POOL.transaction() as curz:
+        rebuild_events(curz, tbl, msgc)
+        got = curz.rowcount if patient_field(msgc) else 0
+      self.stdout.write('%s: %d patient events.' % (cod, got))
@@ -0,0 +1,9 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand
+from thoureport.models import SMSDigest
+
+class Command(BaseCommand):
+  help        = 'Deletes the digests of the SMS received too long ago for their re-deliveries to be recognised (twice DEDUP_WINDOW).'
+
+  def handle(self, *args, **options):
+    self.stdout.write('Deleted %d SMS digests.' % (SMSDigest.purge(),))
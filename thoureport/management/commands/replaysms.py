@@ -0,0 +1,100 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from thoureport.views import REPORT_SET, MSG_ASSOC, SCHEMA
+from thoureport.reports.reports import POOL
+from thoureport.replay import current, begin, pending, plan, setup, replay_chunk, index_shadows, swap, abandon
+from thousand.settings import INGEST_WORKERS
+import datetime
+import multiprocessing
+
+def day(txt):
+  'Reads the date `txt` (YYYY-MM-DD), or None.'
+  if txt is None:
+    return None
+  try:
+    return datetime.datetime.strptime(txt, '%Y-%m-%d').date()
+  except ValueError:
+    raise CommandError('%s is not a date (YYYY-MM-DD).' % (txt,))
+
+class Command(BaseCommand):
+  args        = '[code ...]'
+  help        = '''Rebuilds the report tables (all of those in REPORT_SET, or those of the codes given) by parsing their stored SMS again, in a pool of processes, into shadow tables that then replace them at once.
+The replay is checkpointed as it goes: run the command again, with the same arguments, to resume it after an interruption.
+With --since or --until, only the SMS (and the reports) of those days are replayed; the others are kept as they are.
+Reports are carried over column by column, so pack the codes (`manage.py packcodes`) before replaying with CODE_BITMASKS.'''
+  option_list = BaseCommand.option_list + (
+    make_option('--since', default = None,
+      help = 'Replay the SMS from this day (YYYY-MM-DD) on.'),
+    make_option('--until', default = None,
+      help = 'Replay the SMS before this day (YYYY-MM-DD).'),
+    make_option('--processes', type = 'int', default = INGEST_WORKERS,
+      help = 'How many processes parse the SMS (default: INGEST_WORKERS).'),
+    make_option('--batch', type = 'int', default = 2000,
+      help = 'How many SMS a chunk (the unit of work and of checkpointing) has (default: 2000).'),
+    make_option('--no-swap', action = 'store_true', default = False,
+      help = 'Stop once the shadow tables are full, leaving the swap to the next run.'),
+    make_option('--abandon', action = 'store_true', default = False,
+      help = 'Drop the replay under way, leaving the report tables as they are.'),
+  )
+
+  def handle(self, *args, **options):
+    cods  = sorted([cod.upper() for cod in args] or REPORT_SET)
+    reps  = {}
+    for cod in cods:
+      if cod not in REPORT_SET or cod not in MSG_ASSOC:
+        raise CommandError('No report for the code %s.' % (cod,))
+      reps[cod] = REPORT_SET[cod]
+    pairs = [(reps[cod], MSG_ASSOC[cod]) for cod in cods]
+    since = day(options['since'])
+    until = day(options['until'])
+    SCHEMA.prepare()
+    with POOL.transaction() as curz:
+      run = current(curz)
+      if run and options['abandon']:
+        abandon(run)
+        self.stdout.write('Abandoned the replay of %s.' % (', '.join(run['codes']),))
+        return
+      if options['abandon']:
+        raise CommandError('There is no replay under way.')
+      if run and (run['codes'], run['since'], run['until']) != (cods, since, until):
+        raise CommandError('A replay of %s (since %s, until %s) is under way; run again with those arguments to resume it, or --abandon it.' % (', '.join(run['codes']), run['since'], run['until']))
+      if not run:
+        begin(curz, reps, MSG_ASSOC, since, until, options['batch'])
+        run = current(curz)
+      todo, done  = pending(curz)
+    self.stdout.write('Replaying %s: %d chunks to go (of %d), up to SMS %d.' % (', '.join(cods), len(todo), len(todo) + done, run['sms_mark']))
+    self.replay(plan(run, reps), todo, options['processes'])
+    if options['no_swap']:
+      self.stdout.write('The shadow tables are full; run again to swap them in.')
+      return
+    index_shadows(run, pairs)
+    for tbl, cnt in sorted(swap(run, pairs).items()):
+      self.stdout.write('%s: %d reports.' % (tbl, cnt))
+
+  def replay(self, pln, todo, procs):
+    'Replays the chunks `todo` of the plan `pln`, in `procs` processes (in this one, if 1).'
+    sms   = 0
+    reps  = 0
+    if procs < 2:
+      setup(pln)
+      work  = (replay_chunk(chunk) for chunk in todo)
+    else:
+      connection.close()
+      POOL.closeall()
+      pool  = multiprocessing.Pool(procs, setup, (pln,))
+      work  = pool.imap_unordered(replay_chunk, todo)
+    try:
+      for ind, (_, got, made) in enumerate(work):
+        sms   = sms + got
+        reps  = reps + made
+        if (ind + 1) % 10 == 0 or ind + 1 == len(todo):
+          self.stdout.write('%d of %d chunks: %d SMS, %d reports.' % (ind + 1, len(todo), sms, reps))
+    except KeyboardInterrupt:
+      if procs >= 2:
+        pool.terminate()
+      raise CommandError('Interrupted; the chunks done are kept, and the next run resumes from there.')
+    if procs >= 2:
+      pool.close()
+      pool.join()
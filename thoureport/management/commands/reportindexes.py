@@ -0,0 +1,77 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.views import REPORT_SET, MSG_ASSOC, SCHEMA
+from thoureport.reports.reports import POOL
+
+def concurrently(tbl, nom, stmt):
+  '''Returns the statements building the index `nom` (made by `stmt`) of the table `tbl` without locking out its writers.
+A primary key is added on a unique index built that way.'''
+  if nom == '%s_pkey' % (tbl,):
+    return ['CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (indexcol);' % (nom, tbl),
+            'ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY USING INDEX %s;' % (tbl, nom, nom)]
+  return [stmt.replace('CREATE INDEX ', 'CREATE INDEX CONCURRENTLY ', 1)]
+
+def size(byts):
+  'Writes the number of bytes `byts` in kB, MB or GB.'
+  for unit in ['kB', 'MB', 'GB']:
+    byts  = byts / 1024.0
+    if byts < 1024:
+      break
+  return '%.0f %s' % (byts, unit)
+
+class Command(BaseCommand):
+  args        = '[code ...]'
+  help        = '''Reports, for the report tables (all of those in REPORT_SET, or those of the codes given), the indexes that they should have but do not, and those that no query has used since the statistics were last reset, with the sequential scans of every table.
+With --create, builds the missing indexes without locking out the writers.'''
+  option_list = BaseCommand.option_list + (
+    make_option('--create', action = 'store_true', default = False,
+      help = 'Build the missing indexes (and primary keys), concurrently.'),
+  )
+
+  def handle(self, *args, **options):
+    cods  = [cod.upper() for cod in args] or sorted(REPORT_SET)
+    pairs = []
+    for cod in cods:
+      try:
+        pairs.append((REPORT_SET[cod], MSG_ASSOC[cod]))
+      except KeyError:
+        raise CommandError('No report for the code %s.' % (cod,))
+    for repc, msgc in pairs:
+      SCHEMA.ensure(msgc, repc)
+    SCHEMA.load()
+    mssg  = SCHEMA.missing_indexes(pairs)
+    if options['create']:
+      self.create(mssg)
+      SCHEMA.load()
+      mssg  = SCHEMA.missing_indexes(pairs)
+    tbls  = sorted(set([SCHEMA.creation_sql(msgc, repc)[0] for repc, msgc in pairs]))
+    with POOL.transaction() as curz:
+      curz.execute('SELECT relname, seq_scan, seq_tup_read, COALESCE(idx_scan, 0), n_live_tup FROM pg_stat_user_tables WHERE schemaname = current_schema() AND relname IN %s', (tuple(tbls),))
+      tsts  = dict([(rw[0], rw[1:]) for rw in curz.fetchall()])
+      curz.execute('SELECT s.relname, s.indexrelname, s.idx_scan, pg_relation_size(s.indexrelid), i.indisvalid, i.indisprimary OR i.indisunique FROM pg_stat_user_indexes s JOIN pg_index i ON i.indexrelid = s.indexrelid WHERE s.schemaname = current_schema() AND s.relname IN %s ORDER BY 1, 2', (tuple(tbls),))
+      ists  = curz.fetchall()
+    for tbl in tbls:
+      seqs, seqr, idxs, rows = tsts.get(tbl, (0, 0, 0, 0))
+      self.stdout.write('%s: about %d rows; %d sequential scans (%d rows read), %d index scans' % (tbl, rows, seqs, seqr, idxs))
+      for _, nom, _ in [m for m in mssg if m[0] == tbl]:
+        self.stdout.write('  %-8s %s' % ('missing', nom))
+      for _, nom, scns, byts, vld, unq in [i for i in ists if i[0] == tbl]:
+        stt = 'invalid' if not vld else ('unused' if not (scns or unq) else '')
+        self.stdout.write('  %-8s %-48s %8d scans %10s' % (stt, nom, scns, size(byts)))
+    if mssg and not options['create']:
+      self.stdout.write('%d indexes missing; --create builds them.' % (len(mssg),))
+
+  def create(self, mssg):
+    'Builds the missing indexes `mssg` (as `missing_indexes` gives them), each outside of a transaction so that it can be built concurrently.'
+    with POOL.connection() as conn:
+      conn.autocommit = True
+      try:
+        curz  = conn.cursor()
+        for tbl, nom, stmt in mssg:
+          for sql in concurrently(tbl, nom, stmt):
+            curz.execute(sql)
+          self.stdout.write('%s: built %s.' % (tbl, nom))
+        curz.close()
+      finally:
+        conn.autocommit = False
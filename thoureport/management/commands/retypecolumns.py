@@ -0,0 +1,46 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.views import SCHEMA
+from thoureport.reports.reports import POOL
+
+def conversion(col):
+  '''Returns the SQL expression converting the TEXT value of the column `col` (as in `creation_sql`) into its declared type.
+The value of a field was the token the SMS had, and the column of a field's code held the code where it was there.'''
+  name, _, fldc, _ = col
+  if name == fldc.subname():
+    return fldc.cast_sql(name)
+  return 'CASE WHEN %s IS NOT NULL THEN TRUE END' % (name,)
+
+class Command(BaseCommand):
+  help        = '''Converts the columns of the report tables that are still TEXT (as they all were before the fields had their own types) to the types of their fields, with their values.
+Each table is rewritten once, and all of them in a single transaction.'''
+  option_list = BaseCommand.option_list + (
+    make_option('--dry-run', action = 'store_true', default = False,
+      help = 'Only show the statements.'),
+  )
+
+  def handle(self, *args, **options):
+    SCHEMA.load()
+    stmts = {}
+    for tbl, col, have, want in SCHEMA.stale(SCHEMA.pairs):
+      if have != 'text':
+        raise CommandError('%s.%s is %s, and only TEXT columns can be converted to %s.' % (tbl, col[0], have, want))
+      stmts.setdefault(tbl, []).extend([
+        'ALTER COLUMN %s DROP DEFAULT' % (col[0],),
+        'ALTER COLUMN %s TYPE %s USING %s' % (col[0], want.upper(), conversion(col)),
+        'ALTER COLUMN %s SET DEFAULT %s' % (col[0], col[1].split(' DEFAULT ')[1]),
+      ])
+    if not stmts:
+      self.stdout.write('All the columns have their types.')
+      return
+    ddl = ['ALTER TABLE %s %s;' % (tbl, ', '.join(stmts[tbl])) for tbl in sorted(stmts)]
+    if options['dry_run']:
+      self.stdout.write('\n'.join(ddl))
+      return
+    with POOL.transaction() as curz:
+      for stmt in ddl:
+        curz.execute(stmt)
+    SCHEMA.reset()
+    for tbl in sorted(stmts):
+      self.stdout.write('%s: converted %d columns.' % (tbl, len(stmts[tbl]) / 3))
@@ -0,0 +1,32 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.views import REPORT_SET, MSG_ASSOC, SCHEMA
+from thoureport.reports.reports import POOL
+from thoureport.reports.rollups import rebuild
+import datetime
+
+class Command(BaseCommand):
+  args        = '[code ...]'
+  help        = 'Recomputes the per-day rollups of the report tables (all of those in REPORT_SET, or those of the codes given) from their rows.'
+  option_list = BaseCommand.option_list + (
+    make_option('--days', type = 'int', default = 2,
+      help = 'Recompute the rollups of this many days, today included (default: 2).'),
+    make_option('--all', action = 'store_true', default = False,
+      help = 'Recompute the rollups of every day.'),
+  )
+
+  def handle(self, *args, **options):
+    cods  = [cod.upper() for cod in args] or sorted(REPORT_SET)
+    since = None
+    if not options['all']:
+      since = datetime.date.today() - datetime.timedelta(days = options['days'] - 1)
+    for cod in cods:
+      try:
+        repc, msgc  = REPORT_SET[cod], MSG_ASSOC[cod]
+      except KeyError:
+        raise CommandError('No report for the code %s.' % (cod,))
+      tbl, _  = SCHEMA.ensure(msgc, repc)
+      with POOL.transaction() as curz:
+        rebuild(curz, tbl, msgc, since)
+      self.stdout.write('%s: rolled up %s.' % (cod, ('since %s' % (since,)) if since else 'every day'))
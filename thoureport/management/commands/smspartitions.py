@@ -0,0 +1,36 @@
+# vim: expandtab ts=2
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from thoureport.reports.reports import POOL
+from thoureport.smslog import SMS_TABLE, DEFAULT, PARTITIONS_SERVER, server_version, is_partitioned, ensure_partitions, convert, partitions
+from thousand.settings import SMS_PARTITIONS_AHEAD
+
+class Command(BaseCommand):
+  help        = '''Makes the monthly partitions of the SMS log, for this month and the months to come, and for the months of the SMS that went to the default partition. To be run monthly.
+With --convert, first turns the SMS log (as syncdb makes it) into a partitioned table, with its SMS; the log is locked against writes meanwhile.'''
+  option_list = BaseCommand.option_list + (
+    make_option('--convert', action = 'store_true', default = False,
+      help = 'Partition the SMS log, which is not yet.'),
+    make_option('--ahead', type = 'int', default = SMS_PARTITIONS_AHEAD,
+      help = 'How many months to come to make partitions for (default: SMS_PARTITIONS_AHEAD).'),
+  )
+
+  def handle(self, *args, **options):
+    with POOL.transaction() as curz:
+      got = server_version(curz)
+      if got < PARTITIONS_SERVER:
+        raise CommandError('Partitioning the SMS log takes PostgreSQL 11 or later (this server_version_num is %d).' % (got,))
+      if is_partitioned(curz):
+        if options['convert']:
+          raise CommandError('%s is already partitioned.' % (SMS_TABLE,))
+        made  = ensure_partitions(curz, options['ahead'])
+      else:
+        if not options['convert']:
+          raise CommandError('%s is not partitioned; --convert partitions it.' % (SMS_TABLE,))
+        made  = convert(curz, options['ahead'])
+      have  = partitions(curz)
+      curz.execute('SELECT COUNT(*) FROM %s;' % (DEFAULT,))
+      strays, = curz.fetchone()
+    for mth in made:
+      self.stdout.write('Made the partition of %s.' % (mth.strftime('%B %Y'),))
+    self.stdout.write('%s: %d monthly partitions, from %s to %s; %d SMS in the default partition.' % (SMS_TABLE, len(have), min(have).strftime('%B %Y'), max(have).strftime('%B %Y'), strays))
@@ -0,0 +1,177 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+import re
+from timeit import default_timer as clock
+from thoureport.messages.parser import ThouField, ThouFieldError
+from thoureport.metrics import METRICS
+from thousand.settings import METRICS_FIELD_TIMING
+
+TOKEN_SEPARATOR = re.compile(r'\s+')
+
+PARSERS         = {}
+
+def tokenise(txt):
+  'Splits `txt` into its tokens in one pass, as successive `ThouField.pull` calls would, with the offset of each.'
+  toks  = []
+  offs  = []
+  pos   = 0
+  for sep in TOKEN_SEPARATOR.finditer(txt):
+    tok = txt[pos:sep.start()].strip()
+    # Only the very first piece can be empty and still count; `pull` strips what it leaves behind.
+    if tok or pos == 0:
+      toks.append(tok)
+      offs.append(pos)
+    pos = sep.end()
+  tok = txt[pos:].strip()
+  if tok or (pos == 0 and txt):
+    toks.append(tok)
+    offs.append(pos)
+  return (toks, offs)
+
+def remainder(txt, offs, pos):
+  'Returns the part of `txt` that is left unconsumed once the tokens before `pos` have been pulled.'
+  if pos >= len(offs):
+    return ''
+  return txt[offs[pos]:].strip()
+
+def overrides(fldc, meth):
+  'Tells whether the field class `fldc` overrides the `ThouField` method `meth`.'
+  return getattr(fldc, meth).im_func is not getattr(ThouField, meth).im_func
+
+def field_source(ind, many, timed = False, codes = False):
+  'Returns the source lines that pull the field at index `ind` of the message, as `ThouField.pull` does.'
+  # Bound in the namespace, suffixed with `ind`: F the field class, R its entry in `fields`, M its multiplicity,
+  # E and L its validators, S its error suffix, H its `shared`; P is its metrics stage, if `timed`.
+  ind = str(ind)
+  src = []
+  if timed:
+    src.append('  began = clock()')
+  src.extend(['  at  = pos',
+         '  try:',
+         '    got = []',
+         '    err = []'])
+  pad = '    '
+  if many:
+    src.append('    while True:')
+    pad = '      '
+  src.extend([
+    pad + 'if at >= ntok:',
+    pad + '  if not got:',
+    pad + '    err.append(lcod + MISSING)',
+  ])
+  if many:
+    src.append(pad + '  break')
+  else:
+    src.append(pad + 'else:')
+    pad = pad + '  '
+  src.extend([
+    pad + 'tok = toks[at]',
+    pad + 'at  = at + 1',
+    pad + 'if E%s(tok):' % ind,
+    pad + '  lgl = L%s(tok)' % ind,
+    pad + '  if lgl:',
+    pad + '    if type(lgl) == type([]):',
+    pad + '      err.extend(lgl)',
+    pad + '    else:',
+    pad + '      err.append(lgl)',
+    pad + '  else:',
+    pad + ('    got.append(H%s(tok))' % ind if codes else '    got.append(tok)'),
+    pad + 'else:',
+  ])
+  if many:
+    src.extend([
+      pad + '  if got:',
+      pad + '    at = at - 1',
+      pad + '  else:',
+      pad + '    err.append(lcod + S%s)' % ind,
+      pad + '  break',
+    ])
+  else:
+    src.append(pad + '  err.append(lcod + S%s)' % ind)
+  src.extend([
+    '    cur = F%s(got, M%s)' % (ind, ind),
+    '    errors.extend([ThouFieldError(e, R%s) for e in err])' % ind,
+    '    fobs.append(cur)',
+    '    pos = at',
+    '  except Exception, e:',
+    '    errors.append(ThouFieldError(str(e), R%s))' % ind,
+    '    fobs.append(None)',
+  ])
+  if timed:
+    src.append('  observe(P%s, clock() - began)' % ind)
+  return src
+
+def expectation_check(fldc):
+  'Returns the predicate telling whether a token is expected by the field class `fldc`.'
+  if overrides(fldc, 'expected'):
+    return fldc.expected
+  exps  = fldc.expectation_set
+  if not exps:
+    return lambda tok: True
+  return lambda tok: tok.lower() in exps
+
+def legality_check(fldc):
+  'Returns the validator of the field class `fldc`; the abstract default accepts everything.'
+  if overrides(fldc, 'is_legal'):
+    return fldc.is_legal
+  return lambda tok: None
+
+def compile_message(klass, timed = METRICS_FIELD_TIMING):
+  'Builds the single-pass parsing function of the message class `klass`, giving what `process` gives.'
+  name  = 'process_%s' % (klass.__name__,)
+  nmsp  = {'tokenise': tokenise, 'remainder': remainder, 'MISSING': '_missing_fields', 'clock': clock, 'observe': METRICS.observe, 'ThouFieldError': ThouFieldError}
+  src   = ['def %s(klass, cod, msg):' % (name,)]
+  if not klass.fields:
+    # Nothing to pull: all of the text is superfluous.
+    src.extend([
+      '  etc = msg.strip()',
+      '  if etc:',
+      '    return klass(cod, [], [\'Superfluous text: "%s"\' % (etc,)])',
+      '  return klass(cod, [], [])',
+    ])
+    return finish(name, src, nmsp)
+  src.extend([
+           '  toks, offs  = tokenise(msg)',
+           '  ntok        = len(toks)',
+           '  lcod        = cod.lower()',
+           '  pos         = 0',
+           '  errors      = []',
+           '  fobs        = []'])
+  for ind, fld in enumerate(klass.fields):
+    fldc, many  = fld, False
+    if type(fld) == type((1, 2)):
+      fldc, many  = fld[0], fld[1]
+    nmsp['F%d' % ind] = fldc
+    nmsp['R%d' % ind] = fld
+    nmsp['M%d' % ind] = many
+    nmsp['E%d' % ind] = expectation_check(fldc)
+    nmsp['L%d' % ind] = legality_check(fldc)
+    nmsp['S%d' % ind] = ('_invalid_code_field_%s' % (fldc.subname(),)).lower()
+    nmsp['P%d' % ind] = 'pull.%s' % (fldc.__name__,)
+    nmsp['H%d' % ind] = fldc.shared
+    src.extend(field_source(ind, many, timed, bool(fldc.expectation_lookup)))
+  src.extend([
+    '  etc = remainder(msg, offs, pos)',
+    '  if etc:',
+    '    errors.append(\'Superfluous text: "%s"\' % (etc,))',
+    '  return klass(cod, fobs, errors)',
+  ])
+  return finish(name, src, nmsp)
+
+def finish(name, src, nmsp):
+  'Compiles the lines `src` of the function `name` in the namespace `nmsp`, and returns it.'
+  src = '\n'.join(src) + '\n'
+  exec compile(src, '<%s>' % (name,), 'exec') in nmsp
+  ans         = nmsp[name]
+  ans.source  = src
+  return ans
+
+def parser_for(klass):
+  'Returns the compiled parser for the message class `klass`, compiling it on first use.'
+  try:
+    return PARSERS[klass]
+  except KeyError:
+    ans             = compile_message(klass)
+    PARSERS[klass]  = ans
+    return ans
@@ -0,0 +1,101 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+# Synthetic SMS, for benchmarking the parser: every message class in MSG_ASSOC gets valid
+# messages built from its `fields` (with the codes of each field's `expectations()`, and a
+# legal made-up value for the fields that have none), and invalid ones obtained by spoiling
+# a valid one the way phones in the field do (a missing, unexpected or garbled token, text
+# left over, or a code nobody knows).
+
+import random
+from thoureport.messages.rapid1000messages import *
+
+# Legal values for the fields that have no `expectations()`, looked up along the field's classes.
+SAMPLERS  = {
+  IDField:            lambda rnd: ''.join([rnd.choice('0123456789') for _ in range(16)]),
+  PhoneBasedIDField:  lambda rnd: '0' + ''.join([rnd.choice('0123456789') for _ in range(15)]),
+  DateField:          lambda rnd: '%02d.%02d.%04d' % (rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(2010, 2015)),
+  NumberField:        lambda rnd: str(rnd.randint(0, 12)),
+  HeightField:        lambda rnd: 'HT%d' % (rnd.randint(40, 180),),
+  FloatedField:       lambda rnd: 'WT%d.%d' % (rnd.randint(2, 90), rnd.randint(0, 9)),
+  ANCField:           lambda rnd: 'ANC%d' % (rnd.randint(1, 4),),
+  PNCField:           lambda rnd: 'PNC%d' % (rnd.randint(1, 4),),
+  MUACField:          lambda rnd: 'MUAC%d.%d' % (rnd.randint(9, 20), rnd.randint(0, 9)),
+  CodeField:          lambda rnd: rnd.choice(['AB', 'XY', 'ZZ']),
+  ThouField:          lambda rnd: 'x',
+}
+
+# Tokens that no field expects, nor accepts.
+GARBAGE   = ['??', '12.34.56', 'QQ', '-', 'lorem']
+
+def legal_codes(fldc):
+  'Returns the codes in the expectations of the field class `fldc` that its `is_legal` lets through.'
+  return [exp for exp in fldc.expectation_codes if not fldc.is_legal(exp)]
+
+def sample(fldc, rnd, many = False):
+  '''Returns a list of tokens that make a legal value of the field class `fldc`, using the random generator `rnd`.
+For a field that can occur `many` times, it is one to three distinct codes.'''
+  exps  = legal_codes(fldc)
+  if exps:
+    if many:
+      return rnd.sample(exps, rnd.randint(1, min(3, len(exps))))
+    return [rnd.choice(exps)]
+  if fldc.expectation_codes:
+    return [rnd.choice(fldc.expectation_codes)]
+  for kls in fldc.__mro__:
+    if kls in SAMPLERS:
+      return [SAMPLERS[kls](rnd)]
+  return ['x']
+
+def valid_tokens(msgc, rnd):
+  'Returns the list of tokens of a made-up message of the class `msgc`, with a legal value for each of its fields.'
+  ans = []
+  for fld in msgc.fields:
+    if type(fld) == type((1, 2)):
+      ans.extend(sample(fld[0], rnd, fld[1]))
+    else:
+      ans.extend(sample(fld, rnd))
+  return ans
+
+def spoil(toks, rnd):
+  'Returns the tokens `toks` of a valid message, made invalid in one of the ways that they come in.'
+  toks  = list(toks)
+  how   = rnd.choice(['drop', 'swap', 'garble', 'extra', 'truncate'])
+  at    = rnd.randrange(len(toks)) if toks else 0
+  if how == 'drop' and toks:
+    del toks[at]
+  elif how == 'swap' and toks:
+    toks[at]  = rnd.choice(GARBAGE)
+  elif how == 'garble' and toks:
+    toks[at]  = toks[at][:-1] + '#'
+  elif how == 'truncate' and toks:
+    toks      = toks[:at]
+  else:
+    toks.append(rnd.choice(GARBAGE))
+  return toks
+
+def message(cod, msgc, rnd, valid = True, tries = 20):
+  '''Returns the text of a made-up message of the class `msgc` under the code `cod`, valid or not as asked.
+Since fields can be ambiguous (a code can fit both a multiple field and the field after it), a valid one is generated anew until it parses without errors, at most `tries` times.'''
+  for _ in range(tries):
+    toks  = valid_tokens(msgc, rnd)
+    if not valid:
+      toks  = spoil(toks, rnd)
+    txt   = ' '.join([rnd.choice([cod, cod.lower()])] + toks)
+    if bool(ThouMessage.parse(txt).errors) != valid:
+      return txt
+  return txt
+
+def corpus(size, seed = 0, invalid = 0.3, unknown = 0.0, codes = None):
+  '''Generates the benchmark corpus: `size` messages for each of the `codes` (all those in MSG_ASSOC by default), a fraction `invalid` of which are spoilt, plus a fraction `unknown` (of the total) under codes that no class answers to.
+Returns a list of (code, text) pairs, shuffled; the same `seed` always gives the same corpus.'''
+  rnd   = random.Random(seed)
+  ans   = []
+  for cod in sorted(codes or MSG_ASSOC):
+    msgc  = MSG_ASSOC[cod]
+    bad   = int(round(size * invalid))
+    ans.extend([(cod, message(cod, msgc, rnd, ind >= bad)) for ind in range(size)])
+  for _ in range(int(round(len(ans) * unknown))):
+    ans.append(('?', '%s %s' % (rnd.choice(['XYZ', 'HELLO', 'ok', '']), ' '.join(valid_tokens(rnd.choice(MSG_ASSOC.values()), rnd)))))
+  rnd.shuffle(ans)
+  return ans
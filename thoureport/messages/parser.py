@@ -2,14 +2,61 @@
 # vim: expandtab ts=2
 
 from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+import datetime
+import decimal
 import re
 import psycopg2
+from thousand.settings import CODE_BITMASKS
 
-class ThouField:
+def sql_literal(val):
+  'Writes the Python value `val` (None, a boolean, a number, a date or a string) as an SQL literal.'
+  if val is None:
+    return 'NULL'
+  if type(val) == type(True):
+    return 'TRUE' if val else 'FALSE'
+  if isinstance(val, (int, long, float, decimal.Decimal)):
+    return str(val)
+  if isinstance(val, datetime.date):
+    return "DATE '%s'" % (val.isoformat(),)
+  return "'%s'" % (val.replace("'", "''"),)
+
+# An error of a message about one of its fields: the error `code` (as StoredResponse knows it), and the entry of the field in the `fields` of the message.
+ThouFieldError  = namedtuple('ThouFieldError', ['code', 'field'])
+
+class ThouFieldType(type):
+  '''Metaclass of the message fields.
+Every field class gets its `expectations()` indexed as it is created, so that the per-token lookups need not walk (or rebuild) the list of codes.
+A field class that does not declare its `__slots__` gets none, so that its objects have no `__dict__`.'''
+  def __new__(meta, name, bases, dct):
+    dct.setdefault('__slots__', ())
+    return super(ThouFieldType, meta).__new__(meta, name, bases, dct)
+
+  def __init__(self, name, bases, dct):
+    super(ThouFieldType, self).__init__(name, bases, dct)
+    self.index_expectations()
+
+class ThouField(object):
   '''Class defining the field of a "RapidSMS 1000 Days" message field.
 Has the ability to parse itself from a message string, conditionally pulling several of itself before giving up.
 It also supplies contextual information about its unsuccessful parsing.'''
   # __metaclass__   = ABCMeta
+  __metaclass__         = ThouFieldType
+  # A message can hold hundreds of thousands of these (as when replaying), so they have no `__dict__`.
+  __slots__             = ('working_value', 'several_fields', 'converted')
+  expectation_codes     = ()
+  expectation_set       = frozenset()
+  expectation_ordinals  = {}
+  expectation_lookup    = {}
+  expectation_values    = {}
+  # With two expected codes, whether the column is a BOOLEAN (TRUE for the first code) rather than an ordinal.
+  db_boolean            = False
+  # Whether the column of the field is indexed, for the fields that reports are looked up by (like the IDs and dates).
+  indexed               = False
+  # Whether the field holds the ID of the patient, by which the reports go into the patient timeline.
+  identifies            = False
+  # For a multiple field stored as a bitmask, whether each of its codes gets a partial index of the rows that have it (worth it for rare codes that are looked up by themselves).
+  indexed_codes         = False
 
   @staticmethod
   def pull(self, cod, txt, many = False):
@@ -39,7 +86,7 @@ Returns a triple: the resulting Message object, the array of error codes, and th
           else:
             err.append(errs)
         else:
-          got.append(ans)
+          got.append(self.shared(ans))
       else:
         if many and got:
           etc = prv
@@ -66,12 +113,35 @@ Returns a triple: the resulting Message object, the array of error codes, and th
   def expected(self, fld):
     '''This method is to be extended if the `expectations` mechanism is almost sufficient, but requires some elaborate validation.
 This default one works best on the simple codes that we have, not every possible thing.'''
-    exps  = self.expectations()
-    if not exps: return True
-    for exp in exps:
-      if exp.lower() == fld.lower():
-        return True
-    return False
+    if not self.expectation_set: return True
+    return fld.lower() in self.expectation_set
+
+  @classmethod
+  def index_expectations(self):
+    '''Precomputes the lookups over `expectations()`: the codes themselves (`expectation_codes`), their lower-cased set (`expectation_set`), the ordinal of each code (`expectation_ordinals`), the code for each lower-cased one (`expectation_lookup`), and the value stored for each lower-cased one (`expectation_values`).
+Called once, when the field class is created; a class whose `expectations()` can change has to call it again.'''
+    codes = tuple(self.expectations() or [])
+    ords  = {}
+    lkup  = {}
+    for ind, exp in enumerate(codes):
+      ords.setdefault(exp, ind)
+      lkup.setdefault(exp.lower(), exp)
+    self.expectation_codes    = codes
+    self.expectation_set      = frozenset(lkup)
+    self.expectation_ordinals = ords
+    self.expectation_lookup   = lkup
+    self.expectation_values   = dict([(low, (ords[exp] == 0) if self.db_boolean else ords[exp]) for low, exp in lkup.items()])
+
+  @classmethod
+  def shared(self, tok):
+    'Returns the token `tok`, as the very string of the expected code if it is one (as it was given, case and all), so that the tokens of the codes in all the messages share their strings.'
+    exp = self.expectation_lookup.get(tok.lower())
+    return exp if exp == tok else tok
+
+  @classmethod
+  def canonical(self, fld):
+    'Returns the expected code that `fld` stands for (they are matched regardless of case), or `fld` itself.'
+    return self.expectation_lookup.get(fld.lower(), fld)
 
   @classmethod
   def fixed_for_db(self, val):
@@ -81,16 +151,105 @@ TODO: This only passes because we are using simple, plain codes in testing.'''
       return 'NULL'
     if type(val) in [type(x) for x in [1, 1.0]]:
       return str(val)
-    if val in self.expectations():
-      return self.fixed_for_db(self.expectations().index(val))
+    if val in self.expectation_ordinals:
+      return self.fixed_for_db(self.expectation_ordinals[val])
     if type(val) == type(''):
       return str("'%s'" % (val,)) # TODO: Proper SQL escapes, valid for current engine.
 
   @classmethod
   def dbtype(self, it = None):
     '''Field-level specificiation of the SQL data type to give to the database column that will hold the data held by this field.
-TODO: At present, every field is supposed to be a TEXT. This is clearly false in the case of dates, for instance.'''
-    return 'TEXT'    # TODO. Force them to adapt this per ThouField?
+A field with expectations stores the ordinal of its code (or, if `db_boolean`, whether it is the first code); other fields override this along with `to_db`.'''
+    if self.expectation_codes:
+      return 'BOOLEAN' if self.db_boolean else 'SMALLINT'
+    return 'TEXT'
+
+  @classmethod
+  def to_db(self, fld):
+    '''Converts the (legal) token `fld` into the value that its column stores, of the type given by `dbtype`.
+Called at most once for every token of a field (see `db_values`).'''
+    if self.expectation_codes:
+      return self.expectation_values.get(fld.lower())
+    return fld
+
+  @classmethod
+  def from_db(self, val):
+    'Turns the value `val` read from the column of this field back into what the SMS said (the expected code, rather than its ordinal).'
+    if self.expectation_codes and val is not None and not isinstance(val, basestring):
+      if self.db_boolean:
+        return self.expectation_codes[0 if val else 1]
+      if 0 <= val < len(self.expectation_codes):
+        return self.expectation_codes[val]
+    return val
+
+  @classmethod
+  def code_sql(self, col):
+    'Returns the SQL expression giving the expected code that the value of the column `col` stands for.'
+    whens = ['WHEN %s THEN %s' % (sql_literal(self.to_db(exp)), sql_literal(exp)) for exp, _ in sorted(self.expectation_ordinals.items(), key = lambda x: x[1])]
+    return 'CASE %s %s END' % (col, ' '.join(whens))
+
+  @classmethod
+  def cast_sql(self, col):
+    '''Returns the SQL expression converting the value of the column `col`, stored as TEXT (as the SMS said it), into the value that `to_db` gives.
+It is what migrating the columns made before they were typed uses.'''
+    if self.expectation_codes:
+      whens = ['WHEN %s THEN %s' % (sql_literal(low), sql_literal(self.to_db(low))) for low in sorted(self.expectation_lookup)]
+      return 'CASE LOWER(%s) %s END' % (col, ' '.join(whens))
+    return col
+
+  @classmethod
+  def bit(self, fld):
+    'Returns the bit standing for the expected code `fld` in the bitmask of a multiple field: that of the ordinal of the code.'
+    try:
+      return 1 << self.expectation_ordinals[self.canonical(fld)]
+    except KeyError:
+      raise ValueError, ('%s is not a code of %s.' % (fld, self.__name__))
+
+  @classmethod
+  def to_mask(self, flds):
+    'Returns the bitmask of the (legal) codes `flds`, as the column of a multiple field stores them with `CODE_BITMASKS`.'
+    ans = 0
+    for fld in flds:
+      ans = ans | self.bit(fld)
+    return ans
+
+  @classmethod
+  def from_mask(self, val):
+    'Returns the list of the codes in the bitmask `val`, in the order of `expectations()` (None if it is NULL).'
+    if val is None:
+      return None
+    return [exp for exp, ind in sorted(self.expectation_ordinals.items(), key = lambda x: x[1]) if val & (1 << ind)]
+
+  @classmethod
+  def mask_dbtype(self):
+    'Returns the SQL data type of the bitmask column of a multiple field, wide enough for a bit per code (up to 63 of them).'
+    return 'INTEGER' if len(self.expectation_codes) <= 31 else 'BIGINT'
+
+  @classmethod
+  def has_sql(self, flds, every = False):
+    '''Returns the SQL predicate true of the report rows in which this multiple field has any of the codes `flds` (or, with `every`, all of them).
+Each code is tested on its own: with `CODE_BITMASKS`, as `(column & bit) <> 0`, which is the predicate of its partial index (see `indexes`), so that several codes can be looked up with the indexes of each; otherwise, with the column of the code.'''
+    sub   = self.subname()
+    if CODE_BITMASKS:
+      tsts  = ['(%s & %d) <> 0' % (sub, self.bit(fld)) for fld in flds]
+    else:
+      tsts  = ['%s_%s' % (sub, self.canonical(fld).lower()) for fld in flds]
+    return '(%s)' % ((' AND ' if every else ' OR ').join(tsts) or 'FALSE',)
+
+  @classmethod
+  def indexes(self, tbl, several = False):
+    '''Returns the list of the (name, statement) pairs of the indexes that this field (taken `several` times, if so) wants in the report table `tbl`.
+That is the index of its column if it is `indexed` and, for a multiple field stored as a bitmask with `indexed_codes`, the partial index of each of its codes.'''
+    sub = self.subname()
+    if not several:
+      return [('%s_%s' % (tbl, sub), 'CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s);' % (tbl, sub, tbl, sub))] if self.indexed else []
+    if not (CODE_BITMASKS and self.indexed_codes):
+      return []
+    ans = []
+    for exp, _ in sorted(self.expectation_ordinals.items(), key = lambda x: x[1]):
+      nom = '%s_%s_%s' % (tbl, sub, exp.lower())
+      ans.append((nom, 'CREATE INDEX IF NOT EXISTS %s ON %s (created_at) WHERE %s;' % (nom, tbl, self.has_sql([exp]))))
+    return ans
 
   @classmethod
   def dbvalue(self, it, kasa):
@@ -108,14 +267,23 @@ TODO: Currently gives no heed to the opinions of the field itself.'''
   @classmethod
   def subname(self):
     'Returns the name of this field as it would be used in composing a column name.'
-    return str(self).split('.')[-1].lower()
+    return self.__name__.lower()
 
   @classmethod
   def display(self):
     'Returns the descriptive name of this field (useful for displaying database columns without listing the unsigtly column name).'
-    return re.sub(r'field$', '', str(self).split('.')[-1].lower())
+    return re.sub(r'field$', '', self.__name__.lower())
 
   def __init__(self, val, many):
     'Initialise the field and its associated value `val`, specifying whether it is one of `many` associated as a group with the message.'
     self.working_value  = val
     self.several_fields = many
+    self.converted      = None
+
+  @property
+  def db_values(self):
+    '''The values of the column of this field, converted from its tokens by `to_db` once, when they are first needed (so that messages which are not saved do not pay for it).
+A multiple field has none: each of its codes has a column of its own.'''
+    if self.converted is None:
+      self.converted  = [] if self.several_fields else map(self.to_db, self.working_value)
+    return self.converted
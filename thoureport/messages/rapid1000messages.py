@@ -2,9 +2,31 @@
 # vim: expandtab ts=2
 
 from abc import ABCMeta, abstractmethod
+from collections import Mapping
+import datetime
 import re
+from timeit import default_timer as clock
 from thoureport.messages.parser import *
-from thoureport.reports.reports import THE_DATABASE as db
+from thoureport.messages.compiler import parser_for
+from thoureport.metrics import METRICS
+from thoureport.reports.schema import SCHEMA
+from thousand.settings import CODE_BITMASKS
+
+# The validators' patterns, compiled once rather than on every field.
+DATE_PATTERN      = re.compile(r'(\d{2})\.(\d{2})\.(\d{4})')
+NUMBER_PATTERN    = re.compile(r'\d+')
+CODE_PATTERN      = re.compile(r'\w+')
+FLOATED_PATTERN   = re.compile(r'\w+\d+(\.\d+)?')
+NUMBERED_PATTERN  = re.compile(r'\w+\d+')
+PHONE_ID_PATTERN  = re.compile(r'0\d{15}')
+VISIT_PATTERN     = re.compile(r'\w+\d')
+MUAC_PATTERN      = re.compile(r'MUAC\d+(\.\d+)')
+# The number that a legal numbered (or floated) code carries, after its letters.
+LEADING_DIGITS    = re.compile(r'\D*(\d+)')
+LEADING_DECIMAL   = re.compile(r'\D*(\d+(?:\.\d+)?)')
+
+# The largest number that a SMALLINT column holds.
+SMALLINT_MAX      = 32767
 
 def first_cap(s):
   '''Capitalises the first letter (without assaulting the others like Ruby's #capitalize does).'''
@@ -13,6 +35,9 @@ def first_cap(s):
 
 class IDField(ThouField):
   'The commonly-used ID field.'
+  indexed     = True
+  identifies  = True
+
   @classmethod
   def is_legal(self, ans):
     'For now, checks are limited to length assurance.'
@@ -20,26 +45,57 @@ class IDField(ThouField):
 
 class DateField(ThouField):
   'The descriptor for valid message fields.'
+  indexed = True
+
   @classmethod
   def is_legal(self, fld):
-    ans = re.match(r'(\d{2})\.(\d{2})\.(\d{4})')
+    ans = DATE_PATTERN.match(fld)
     if not ans: return 'pre_4'
-    gps = ans.groups()
-    return [] # Check that it is a valid date. TODO. Move to semantics part?
+    try:
+      self.to_db(fld)
+    except ValueError:
+      return 'pre_4'
+    return []
+
+  @classmethod
+  def dbtype(self, it = None):
+    return 'DATE'
+
+  @classmethod
+  def to_db(self, fld):
+    'The date, which comes as DD.MM.YYYY.'
+    dd, mm, yy  = DATE_PATTERN.match(fld).groups()
+    return datetime.date(int(yy), int(mm), int(dd))
+
+  @classmethod
+  def cast_sql(self, col):
+    return "CASE WHEN %s ~ '^\\d{2}\\.\\d{2}\\.\\d{4}' THEN TO_DATE(SUBSTRING(%s FROM 1 FOR 10), 'DD.MM.YYYY') END" % (col, col)
 
 class NumberField(ThouField):
   'The descriptor for number fields.'
   @classmethod
   def is_legal(self, fld):
-    'Basically a regex.'
-    return [] if re.match(r'\d+', fld) else 'bad_number'
+    'Basically a regex, and a number that fits its column.'
+    return [] if NUMBER_PATTERN.match(fld) and self.to_db(fld) <= SMALLINT_MAX else 'bad_number'
+
+  @classmethod
+  def dbtype(self, it = None):
+    return 'SMALLINT'
+
+  @classmethod
+  def to_db(self, fld):
+    return int(NUMBER_PATTERN.match(fld).group())
+
+  @classmethod
+  def cast_sql(self, col):
+    return "SUBSTRING(%s FROM '^\\d+')::SMALLINT" % (col,)
 
 class CodeField(ThouField):
   'This should match basically any simple code, plain and numbered.'
   @classmethod
   def is_legal(self, fld):
     'Basically a simple regex.'
-    return [] if re.match(r'\w+', fld) else 'what_code'
+    return [] if CODE_PATTERN.match(fld) else 'what_code'
 
 class GravidityField(NumberField):
   'Gravity is a number.'
@@ -73,6 +129,8 @@ class SymptomCodeField(CodeField):
 
 class RedSymptomCodeField(SymptomCodeField):
   'Field for codes associated with symptoms.'
+  indexed_codes = True
+
   @classmethod
   def expectations(self):
     'These are the codes in red alerts.'
@@ -90,14 +148,52 @@ class FloatedField(CodeField):
   @classmethod
   def is_legal(self, fld):
     'Basically a regex.'
-    return [] if re.match(r'\w+\d+(\.\d+)?', fld) else 'bad_floated_field'
+    return [] if FLOATED_PATTERN.match(fld) else 'bad_floated_field'
+
+  @classmethod
+  def dbtype(self, it = None):
+    'The number that the code carries.'
+    return 'NUMERIC'
+
+  @classmethod
+  def to_db(self, fld):
+    # A float, which writes as the same decimal, and is much cheaper to make than a Decimal.
+    return float(LEADING_DECIMAL.match(fld).group(1))
+
+  @classmethod
+  def cast_sql(self, col):
+    return "SUBSTRING(%s FROM '^\\D*(\\d+(?:\\.\\d+)?)')::NUMERIC" % (col,)
 
 class NumberedField(CodeField):
   'Field for codes that carry whole numbers.'
   @classmethod
   def is_legal(self, fld):
-    'Basically a regex.'
-    return [] if re.match(r'\w+\d+', fld) else 'bad_numbered_field'
+    'Basically a regex, and a number that fits its column.'
+    return [] if NUMBERED_PATTERN.match(fld) and self.number(fld) <= SMALLINT_MAX else 'bad_numbered_field'
+
+  @classmethod
+  def number(self, fld):
+    'The number that the code `fld` carries.'
+    return int(LEADING_DIGITS.match(fld).group(1))
+
+  @classmethod
+  def dbtype(self, it = None):
+    'The number that the code carries, unless the codes are expected ones.'
+    if self.expectation_codes:
+      return super(NumberedField, self).dbtype(it)
+    return 'SMALLINT'
+
+  @classmethod
+  def to_db(self, fld):
+    if self.expectation_codes:
+      return super(NumberedField, self).to_db(fld)
+    return self.number(fld)
+
+  @classmethod
+  def cast_sql(self, col):
+    if self.expectation_codes:
+      return super(NumberedField, self).cast_sql(col)
+    return "SUBSTRING(%s FROM '^\\D*(\\d+)')::SMALLINT" % (col,)
 
 class HeightField(NumberedField):
   'Field for height codes.'
@@ -107,9 +203,10 @@ class WeightField(FloatedField):
   'Field for weight codes.'
   pass
 
-#TODO:  DB value for 2-long expectations() should be Bool.
 class ToiletField(CodeField):
   'Field for codes concerning toilets.'
+  db_boolean  = True
+
   @classmethod
   def expectations(self):
     'Toilet or no toilet?'
@@ -117,6 +214,8 @@ class ToiletField(CodeField):
 
 class HandwashField(CodeField):
   'Field for codes concerning handwwashing basic.'
+  db_boolean  = True
+
   @classmethod
   def expectations(self):
     'Hand-wash or no hand-wash?'
@@ -127,28 +226,28 @@ class PhoneBasedIDField(IDField):
   @classmethod
   def is_legal(self, fld):
     'Basic regex.'
-    return [] if re.match(r'0\d{15}', fld) else 'bad_phone_id'
+    return [] if PHONE_ID_PATTERN.match(fld) else 'bad_phone_id'
 
 class ANCField(NumberedField):
   'Ante-Natal Care visit number is a ... number.'
   @classmethod
   def is_legal(self, fld):
     'Matches the code, not insisting on the string that precedes the number.'
-    return [] if re.match(r'\w+\d', fld) else 'anc_code'
+    return [] if VISIT_PATTERN.match(fld) and self.number(fld) <= SMALLINT_MAX else 'anc_code'
 
 class PNCField(NumberedField):
   'Post-Natal Care visit number is a ... number.'
   @classmethod
   def is_legal(self, fld):
     'Matches the code, not insisting on the string that precedes the number.'
-    return [] if re.match(r'\w+\d', fld) else 'pnc_code'
+    return [] if VISIT_PATTERN.match(fld) and self.number(fld) <= SMALLINT_MAX else 'pnc_code'
 
 class NBCField(NumberedField):
   'New-Born Care visit number is a ... number.'
   @classmethod
   def is_legal(self, fld):
     'Matches the code, not insisting on the string that precedes the number.'
-    return [] if re.match(r'\w+\d', fld) else 'nbc_code'
+    return [] if VISIT_PATTERN.match(fld) and self.number(fld) <= SMALLINT_MAX else 'nbc_code'
 
   @classmethod
   def expectations(self):
@@ -219,7 +318,7 @@ class MUACField(FloatedField):
   @classmethod
   def is_legal(self, fld):
     'Regex alert.'
-    return [] if re.match(r'MUAC\d+(\.\d+)', fld) else 'bad_muac_code'
+    return [] if MUAC_PATTERN.match(fld) else 'bad_muac_code'
 
 class DeathField(CodeField):
   'Field for describing death codes.'
@@ -233,10 +332,65 @@ class ThouMsgError:
   def __init__(self, errors):
     self.errors     = errors
 
-class ThouMessage:
-  '''Base class describing the standard RapidSMS 1000 Days message.'''
-  fields  = []
-  created = False
+class ThouMessageType(type):
+  '''Metaclass of the messages.
+A message class that does not declare its `__slots__` gets none, so that its objects have no `__dict__`, and every message class gets the layout of its fields as it is created (see `index_fields`).'''
+  def __new__(meta, name, bases, dct):
+    dct.setdefault('__slots__', ())
+    return super(ThouMessageType, meta).__new__(meta, name, bases, dct)
+
+  def __init__(self, name, bases, dct):
+    super(ThouMessageType, self).__init__(name, bases, dct)
+    self.index_fields()
+
+class ThouEntries(Mapping):
+  '''The `entries` of a message: its field objects by their `subname`, as a read-only hash over the tuple of them that the message holds (one per entry of its `fields`, None for a field that could not be pulled).
+A field that comes more than once is the last of them, and one that could not be pulled is not there.'''
+  __slots__ = ('order', 'layout', 'fobs')
+
+  def __init__(self, order, layout, fobs):
+    self.order  = order
+    self.layout = layout
+    self.fobs   = fobs
+
+  def __getitem__(self, sub):
+    try:
+      fob = self.fobs[self.layout[sub]]
+    except IndexError:
+      fob = None
+    if fob is None:
+      raise KeyError, sub
+    return fob
+
+  def __iter__(self):
+    for sub, ind in self.order:
+      if ind < len(self.fobs) and self.fobs[ind] is not None:
+        yield sub
+
+  def __len__(self):
+    return len([1 for sub in self])
+
+class ThouMessage(object):
+  '''Base class describing the standard RapidSMS 1000 Days message.
+A message holds its `code`, its `errors` (ThouFieldError pairs, or the text of the superfluous text), and a tuple of its field objects in the order of its `fields`, which `entries` gives by field.'''
+  __metaclass__ = ThouMessageType
+  __slots__     = ('code', 'errors', 'fobs')
+  fields        = []
+
+  @classmethod
+  def index_fields(self):
+    '''Lays out the field objects of the messages of this class: `layout` gives the index in `fields` of each field (by its `subname`; the last one, where a field comes more than once), and `field_order` the (subname, index) pairs in the order of `fields`.
+Called once, when the message class is created; a class whose `fields` change has to call it again.'''
+    layout  = {}
+    for ind, fld in enumerate(self.fields):
+      layout[(fld[0] if type(fld) == type((1, 2)) else fld).subname()] = ind
+    self.layout       = layout
+    self.field_order  = tuple(sorted(layout.items(), key = lambda x: x[1]))
+
+  @property
+  def entries(self):
+    'The field objects of this message, by their `subname` (see ThouEntries).'
+    return ThouEntries(self.field_order, self.layout, self.fobs)
 
   # @staticmethod
   @classmethod
@@ -248,36 +402,47 @@ class ThouMessage:
     for fld in self.fields:
       if type(fld) == type((1, 2)):
         fldc  = fld[0]
-        col   = str(fldc).split('.')[-1].lower()
-        for exp in fldc.expectations():
-          subans  = ('%s_%s' % (col, exp.lower()), '%s DEFAULT %s' % (fldc.dbtype(), fldc.default_dbvalue()), fldc, exp)
+        col   = fldc.subname()
+        # Either a bitmask of the codes there, or a column per expected code, TRUE when the code is there.
+        if CODE_BITMASKS:
+          cols.append((col, '%s DEFAULT %s' % (fldc.mask_dbtype(), fldc.default_dbvalue()), fldc, first_cap(fldc.display())))
+          continue
+        for exp in fldc.expectation_codes:
+          subans  = ('%s_%s' % (col, exp.lower()), 'BOOLEAN DEFAULT %s' % (fldc.default_dbvalue(),), fldc, exp)
           cols.append(subans)
       else:
-        col = str(fld).split('.')[-1].lower()
+        col = fld.subname()
         cols.append((col, '%s DEFAULT %s' % (fld.dbtype(), fld.default_dbvalue()), fld, first_cap(fld.display())))
     return (str(repc).split('.')[-1].lower() + 's', cols)
 
   @classmethod
+  def decoders(self, repc):
+    '''Returns, for each column of the `creation_sql` for the report class `repc`, the function that turns a value read from it back into what the SMS said.
+The columns of a field's codes give the code where they are TRUE, and the bitmask of a multiple field gives its codes, separated by spaces.'''
+    ans   = []
+    mlts  = self.multiples()
+    for col, _, fldc, etc in self.creation_sql(repc)[1]:
+      if not isinstance(fldc, type):
+        ans.append(lambda val: val)
+      elif col != fldc.subname():
+        ans.append(lambda val, exp = etc: exp if val else None)
+      elif fldc in mlts:
+        ans.append(lambda val, fldc = fldc: ' '.join(fldc.from_mask(val or 0)) or None)
+      else:
+        ans.append(fldc.from_db)
+    return ans
+
+  @classmethod
+  def multiples(self):
+    'Returns the set of the field classes of which this message takes several.'
+    return set([fld[0] for fld in self.fields if type(fld) == type((1, 2))])
+
+  @classmethod
+  @METRICS.timed('create_in_db')
   def create_in_db(self, repc):
-    try:
-      tbl, cols = stuff = self.creation_sql(repc)
-      if self.created: return stuff
-      curz  = db.cursor()
-      curz.execute('SELECT TRUE FROM information_schema.tables WHERE table_name = %s', (tbl,))
-      if not curz.fetchone():
-        curz.execute('CREATE TABLE %s (indexcol SERIAL NOT NULL);' % (tbl,))
-        curz.close()
-        return self.create_in_db(repc)
-      for col in cols:
-        curz.execute('SELECT TRUE FROM information_schema.columns WHERE table_name = %s AND column_name = %s', (tbl, col[0]))
-        if not curz.fetchone():
-          curz.execute('ALTER TABLE %s ADD COLUMN %s %s;' % (tbl, col[0], col[1]))
-      curz.close()
-      db.commit()
-      self.created  = True
-      return stuff
-    except Exception, e:
-      raise Exception, ('Table creation: ' + str(e))
+    '''Makes sure that the table for the report class `repc` exists with all of its columns, and returns its `creation_sql`.
+The schema registry answers from memory once it has loaded the catalog.'''
+    return SCHEMA.ensure(self, repc)
 
   @staticmethod
   def pull_code(msg):
@@ -310,6 +475,23 @@ class ThouMessage:
       pass
     return erh(pz)
 
+  @staticmethod
+  def parse_many(pairs, hsh):
+    '''Parses a batch of messages, given as a list of (phone, text) pairs, coupling each of them with its report class from `hsh` (as in `parse_report`).
+Returns a list of (phone, Message object, report object) triples in the same order; the report is None for unknown messages, for messages with errors, and for messages with no report class in `hsh`.
+The reports can then be written together with `ThouReport.save_many`.'''
+    nch = ThouMessage.caseless_hash(hsh)
+    ans = []
+    for phone, txt in pairs:
+      pz  = ThouMessage.parse(txt)
+      rep = None
+      if pz.__class__ != UnknownMessage and not pz.errors:
+        repc  = nch.get(pz.code.lower())
+        if repc:
+          rep = repc(pz)
+      ans.append((phone, pz, rep))
+    return ans
+
   @staticmethod
   def parse(msg):
     code, rem = ThouMessage.pull_code(msg.strip())
@@ -318,11 +500,29 @@ class ThouMessage:
       klass     = MSG_ASSOC[code.upper()]
     except KeyError:
       pass
-    return klass.process(klass, code, rem)
+    if not METRICS.on:
+      return parser_for(klass)(klass, code, rem)
+    began     = clock()
+    ans       = parser_for(klass)(klass, code, rem)
+    METRICS.observe('parse', clock() - began, ThouMessage.tally(ans))
+    return ans
+
+  @staticmethod
+  def tally(msg):
+    'Returns the keys of the metrics counters that the Message object `msg` counts under: its code (or unknown), and each of its errors.'
+    if msg.__class__ == UnknownMessage:
+      ans = [METRICS.key('unknown_messages')]
+    else:
+      ans = [METRICS.key('messages', code = msg.code.upper())]
+    for er in msg.errors:
+      ans.append(METRICS.key('errors', error = er.code if isinstance(er, ThouFieldError) else 'superfluous_text'))
+    return ans
 
   # “Private”
   @staticmethod
   def process(klass, cod, msg):
+    '''Parses `msg` field by field with `ThouField.pull`.
+This is the reference behaviour; `parse` runs the equivalent single-pass parser that `compiler.compile_message` builds for each class.'''
     errors  = []
     fobs    = []
     etc     = msg
@@ -330,24 +530,23 @@ class ThouMessage:
       try:
         if type(fld) == type((1, 2)):
           cur, err, etc  = fld[0].pull(fld[0], cod, etc, fld[1])
-          errors.extend([(e, fld) for e in err])
+          errors.extend([ThouFieldError(e, fld) for e in err])
         else:
           cur, err, etc  = fld.pull(fld, cod, etc)
-          errors.extend([(e, fld) for e in err])
+          errors.extend([ThouFieldError(e, fld) for e in err])
         fobs.append(cur)
       except Exception, err:
-        errors.append((str(err), fld))
+        errors.append(ThouFieldError(str(err), fld))
+        fobs.append(None)
     if etc.strip():
       errors.append('Superfluous text: "%s"' % (etc.strip(),))
     return klass(cod, fobs, errors)
 
   def __init__(self, cod, fobs, errs):
-    self.code     = cod
-    self.errors   = errs
-    def as_hash(p, n):
-      p[n.__class__.subname()] = n
-      return p
-    self.entries  = reduce(as_hash, fobs, {})
+    'Initialised with the code `cod` of the message (sharing the string of a known code), its field objects `fobs`, one per entry of its `fields`, and its errors `errs`.'
+    self.code   = MESSAGE_CODES.get(cod, cod)
+    self.errors = errs
+    self.fobs   = tuple(fobs)
 
   def __enter__(self):
     self.errors = self.errors.extend(self.semantics_check())
@@ -471,3 +670,6 @@ MSG_ASSOC = {
 
   'REV':  RevMessage,
 }
+
+# The message codes as they are usually written (in capitals, or in lower case), so that the messages share them.
+MESSAGE_CODES = dict([(cod, cod) for cod in MSG_ASSOC] + [(cod.lower(), cod.lower()) for cod in MSG_ASSOC])
@@ -0,0 +1,157 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+# In-process measurements of the ingest pipeline: a latency histogram for every stage
+# (parsing, each field of the compiled parsers if asked for, table checks, report saves,
+# response look-ups, reply rendering, requests), and counters (messages by code, errors by
+# code, unknown messages). Every process keeps its own; /metrics shows those of the
+# process that answers, in the Prometheus text format.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer as clock
+from thousand.settings import METRICS_ON
+import threading
+import time
+
+# Upper bounds (in seconds) of the histogram buckets; the last bucket is unbounded.
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class ThouHistogram:
+  'Counts of durations in the buckets `bounds`, with their sum. Not locked by itself: `ThouMetrics` locks around it.'
+  def __init__(self, bounds = BUCKETS):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.total  = 0.0
+    self.count  = 0
+
+  def observe(self, secs):
+    'Records a duration of `secs` seconds.'
+    self.counts[bisect_left(self.bounds, secs)] += 1
+    self.total  = self.total + secs
+    self.count  = self.count + 1
+
+  def cumulative(self):
+    'Returns the list of the (upper bound, count of durations up to it) pairs, the last bound being None (unbounded).'
+    ans = []
+    got = 0
+    for bnd, cnt in zip(list(self.bounds) + [None], self.counts):
+      got = got + cnt
+      ans.append((bnd, got))
+    return ans
+
+  def quantile(self, q):
+    'Estimates the `q` quantile (0 to 1) as the upper bound of the bucket it falls in; None if there is nothing yet, or if it is past the last bound.'
+    if not self.count:
+      return None
+    for bnd, got in self.cumulative():
+      if got >= q * self.count:
+        return bnd
+
+def label_value(val):
+  'Escapes `val` for a label of the text format.'
+  return unicode(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(pairs):
+  'Formats the (name, value) `pairs` as the labels of a sample.'
+  if not pairs:
+    return ''
+  return '{%s}' % (','.join(['%s="%s"' % (k, label_value(v)) for k, v in pairs]),)
+
+class ThouMetrics:
+  '''The registry of the stage histograms and of the counters of a process.
+When `on` is false, recording is a no-op.'''
+  def __init__(self, on = True):
+    self.on       = on
+    self.lock     = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    'Forgets everything recorded so far.'
+    with self.lock:
+      self.stages   = {}
+      self.counters = {}
+      self.since    = time.time()
+
+  @staticmethod
+  def key(name, **label):
+    'Returns the key of the counter `name` under the (at most one) `label` given, as in key(\'messages\', code = \'RED\').'
+    return (name, tuple(label.items()))
+
+  def observe(self, stage, secs, keys = ()):
+    'Records that the stage called `stage` took `secs` seconds, and adds one to each of the counters of the `keys` (made by `key`) at the same time.'
+    if not self.on:
+      return
+    with self.lock:
+      hst = self.stages.get(stage)
+      if hst is None:
+        hst                 = ThouHistogram()
+        self.stages[stage]  = hst
+      hst.observe(secs)
+      for key in keys:
+        self.counters[key]  = self.counters.get(key, 0) + 1
+
+  def count(self, name, by = 1, **label):
+    'Adds `by` to the counter `name`, under the (at most one) `label` given.'
+    if not self.on:
+      return
+    key = self.key(name, **label)
+    with self.lock:
+      self.counters[key]  = self.counters.get(key, 0) + by
+
+  @contextmanager
+  def timer(self, stage):
+    'Times the block it scopes as the stage `stage`.'
+    began = clock()
+    try:
+      yield
+    finally:
+      self.observe(stage, clock() - began)
+
+  def timed(self, stage):
+    'Decorator timing every call of the function as the stage `stage`.'
+    def decorator(fn):
+      @wraps(fn)
+      def timed_fn(*args, **kwargs):
+        if not self.on:
+          return fn(*args, **kwargs)
+        began = clock()
+        try:
+          return fn(*args, **kwargs)
+        finally:
+          self.observe(stage, clock() - began)
+      return timed_fn
+    return decorator
+
+  def text(self, gauges = {}, totals = {}):
+    '''Returns everything recorded, in the Prometheus text format, with the extra `gauges` and counter `totals` (hashes of name to value) at the end.'''
+    with self.lock:
+      stgs  = [(stg, hst.cumulative(), hst.total, hst.count) for stg, hst in sorted(self.stages.items())]
+      cnts  = sorted(self.counters.items())
+      since = self.since
+    ans = ['# HELP thou_stage_seconds Time spent in each stage of the ingest pipeline.',
+           '# TYPE thou_stage_seconds histogram']
+    for stg, cml, tot, cnt in stgs:
+      for bnd, got in cml:
+        ans.append('thou_stage_seconds_bucket%s %d' % (labels([('stage', stg), ('le', '+Inf' if bnd is None else repr(bnd))]), got))
+      ans.append('thou_stage_seconds_sum%s %r' % (labels([('stage', stg)]), tot))
+      ans.append('thou_stage_seconds_count%s %d' % (labels([('stage', stg)]), cnt))
+    done  = set()
+    for (name, lbl), cnt in cnts:
+      if name not in done:
+        ans.append('# TYPE thou_%s_total counter' % (name,))
+        done.add(name)
+      ans.append('thou_%s_total%s %d' % (name, labels(lbl), cnt))
+    ans.append('# TYPE thou_metrics_since_seconds gauge')
+    ans.append('thou_metrics_since_seconds %r' % (since,))
+    for name in sorted(gauges):
+      ans.append('# TYPE thou_%s gauge' % (name,))
+      ans.append('thou_%s %s' % (name, gauges[name]))
+    for name in sorted(totals):
+      ans.append('# TYPE thou_%s_total counter' % (name,))
+      ans.append('thou_%s_total %s' % (name, totals[name]))
+    return '\n'.join(ans) + '\n'
+
+METRICS = ThouMetrics(METRICS_ON)
@@ -0,0 +1,38 @@
+# vim: expandtab ts=2
+from django.http import HttpResponse
+from thoureport.metrics import METRICS
+from thousand.settings import METRICS_PROFILE
+from timeit import default_timer as clock
+import cProfile
+import pstats
+import StringIO
+
+# The orders that ?profile=<order> can sort the profile in.
+PROFILE_ORDERS  = ['cumulative', 'time', 'calls', 'name']
+PROFILE_LINES   = 60
+
+class ThouMetricsMiddleware:
+  '''Times every request as the metrics stage "request.<url name>".
+With `METRICS_PROFILE`, a request whose URL has a `profile` parameter (as in /sendsms?profile=time) is run under cProfile, and answered with the profile (sorted as the parameter asks, cumulative time by default) instead of its response.'''
+  def process_request(self, req):
+    req.thou_began  = clock()
+
+  def process_view(self, req, view, args, kwargs):
+    if not (METRICS_PROFILE and 'profile' in req.GET):
+      return None
+    prof  = cProfile.Profile()
+    resp  = prof.runcall(view, req, *args, **kwargs)
+    if getattr(resp, 'streaming', False):
+      prof.runcall(lambda: [x for x in resp.streaming_content])
+    buf   = StringIO.StringIO()
+    ordr  = req.GET['profile'] if req.GET['profile'] in PROFILE_ORDERS else PROFILE_ORDERS[0]
+    stts  = pstats.Stats(prof, stream = buf)
+    stts.sort_stats(ordr).print_stats(PROFILE_LINES)
+    return HttpResponse('%s %s: %s\n\n%s' % (req.method, req.get_full_path(), resp.status_code, buf.getvalue()), content_type = 'text/plain')
+
+  def process_response(self, req, resp):
+    began = getattr(req, 'thou_began', None)
+    if began is not None:
+      mtch  = getattr(req, 'resolver_match', None)
+      METRICS.observe('request.%s' % ((mtch and mtch.url_name) or 'unresolved',), clock() - began)
+    return resp
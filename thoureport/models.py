@@ -1,13 +1,71 @@
 # encoding: utf-8
 
-from django.db import models
+from django.db import connection, models, transaction
+from django.utils import timezone
 from abc import ABCMeta, abstractmethod
+from thoureport.metrics import METRICS
+from thousand.settings import RESPONSE_CACHE_TTL, DEDUP_WINDOW, DEDUP_CLAIM_TIMEOUT
+import datetime
+import hashlib
+import json
+import threading
+import time
+
+class ThouResponseCache:
+  'In-process copy of the `StoredResponse` texts, by code, reloaded once `ttl` seconds old.'
+  def __init__(self, ttl):
+    self.ttl    = ttl
+    self.texts  = None
+    self.loaded = 0
+    self.lock   = threading.Lock()
+
+  def load(self):
+    'Reads all the responses in one query.'
+    ans = {}
+    for cod, txt in StoredResponse.objects.order_by('-id').values_list('code', 'text'):
+      ans[cod]  = txt
+    with self.lock:
+      self.texts  = ans
+      self.loaded = time.time()
+    return ans
+
+  def current(self):
+    'Returns the hash of the texts, (re)loading it if it is missing or stale.'
+    if self.texts is None or time.time() - self.loaded > self.ttl:
+      return self.load()
+    return self.texts
+
+  def get(self, cod):
+    'Returns the cached text for the code `cod`, or None.'
+    return self.current().get(cod)
+
+  def put(self, cod, txt):
+    'Records that the code `cod` now has the text `txt`.'
+    with self.lock:
+      if self.texts is not None:
+        self.texts[cod] = txt
+
+  def forget(self, cod):
+    'Drops the code `cod`, which will be looked up afresh.'
+    with self.lock:
+      if self.texts is not None:
+        self.texts.pop(cod, None)
 
 class StoredResponse(models.Model):
   'This class permits a separation of concerns between the code specifying responses on the one hand, and their content on the other hand.'
   text  = models.TextField()
   code  = models.TextField()
 
+  def save(self, *args, **kwargs):
+    'Saves the response, and updates the response cache with it.'
+    super(StoredResponse, self).save(*args, **kwargs)
+    RESPONSES.put(self.code, self.text)
+
+  def delete(self, *args, **kwargs):
+    'Deletes the response, and drops it from the response cache.'
+    super(StoredResponse, self).delete(*args, **kwargs)
+    RESPONSES.forget(self.code)
+
   @staticmethod
   def fetch_tranform(cod, msg):
     'Fetch a response by code, creating it (with simple default text) if it does not yet exist.'
@@ -15,15 +73,47 @@ class StoredResponse(models.Model):
     return ans
 
   @staticmethod
+  @METRICS.timed('response.fetch')
   def fetch(cod):
     'Fetch a response by code, creating it (with simple default text) if it does not yet exist.'
-    msg = StoredResponse.objects.filter(code = cod)
-    if msg.count():
+    ans = RESPONSES.get(cod)
+    if ans is None:
+      return StoredResponse.fetch_missing(cod)
+    return ans
+
+  @staticmethod
+  @METRICS.timed('response.fetch_many')
+  def fetch_many(cods):
+    'Fetch the responses for all the codes in `cods` at once, creating those that do not yet exist.'
+    txts  = RESPONSES.current()
+    ans   = {}
+    for cod in cods:
+      if cod not in ans:
+        ans[cod]  = txts.get(cod)
+        if ans[cod] is None:
+          ans[cod]  = StoredResponse.fetch_missing(cod)
+    return ans
+
+  @staticmethod
+  def fetch_missing(cod):
+    'Fetch a response that is not in the cache, creating it if it does not yet exist.'
+    msg = StoredResponse.objects.filter(code = cod)[:1]
+    if msg:
+      RESPONSES.put(cod, msg[0].text)
       return msg[0].text
-    else:
-      news  = StoredResponse(text = 'Error code: ' + cod, code = cod)
-      news.save()
-      return StoredResponse.fetch(cod)
+    news  = StoredResponse(text = 'Error code: ' + cod, code = cod)
+    news.save()
+    return news.text
+
+def pool_insert(curz, objs):
+  'Inserts the new objects `objs` of one model with the cursor `curz`, setting their ids.'
+  meta  = objs[0]._meta
+  flds  = [f for f in meta.concrete_fields if not isinstance(f, models.AutoField)]
+  rows  = [curz.mogrify('(%s)' % ', '.join(['%s'] * len(flds)), [f.get_db_prep_save(f.pre_save(obj, True), connection) for f in flds]) for obj in objs]
+  curz.execute('INSERT INTO %s (%s) VALUES %s RETURNING %s;' % (meta.db_table, ', '.join(['"%s"' % f.column for f in flds]), ', '.join(rows), meta.pk.column))
+  for obj, (pk,) in zip(objs, curz.fetchall()):
+    obj.pk  = pk
+  return objs
 
 class StoredSMS(models.Model):
   'Recording every SMS message that comes in. Very simple format.'
@@ -31,6 +121,119 @@ class StoredSMS(models.Model):
   sender  = models.TextField()
   when    = models.DateTimeField(auto_now_add = True)
 
+  class Meta:
+    # The SMS log is paged newest first, on (when, id), for everyone or for one sender.
+    # (Tables made before these: see etc/smslog.sql.) Once the table is partitioned by month
+    # (see thoureport/smslog.py), these are made on every partition.
+    index_together  = (('when', 'id'), ('sender', 'when', 'id'))
+
+class QueuedSMS(models.Model):
+  'An inbound SMS waiting to be processed by the ingestion workers (see `ingestworker`).'
+  STATES    = (('queued', 'Queued'), ('working', 'Working'), ('done', 'Done'), ('failed', 'Failed'))
+  # No constraint in the database: the partitioned SMS log has no key on `id` alone, and archived SMS leave their QueuedSMS behind.
+  sms       = models.ForeignKey(StoredSMS, db_constraint = False)
+  state     = models.CharField(max_length = 8, choices = STATES, default = 'queued', db_index = True)
+  attempts  = models.IntegerField(default = 0)
+  claimed   = models.DateTimeField(null = True)
+  outcome   = models.TextField(blank = True)
+
+  def results(self):
+    'Returns the hash describing where this SMS is in its processing, and how it came out.'
+    ans = {'queued': self.id, 'state': self.state}
+    if self.outcome:
+      ans.update(json.loads(self.outcome))
+    return ans
+
+class DigestLost(Exception):
+  'Raised when the claim on an SMS digest was taken over by another delivery.'
+  pass
+
+class SMSDigest(models.Model):
+  'The digest of an SMS received, by which a re-delivery within `DEDUP_WINDOW` is recognised.'
+  digest    = models.CharField(max_length = 40, unique = True)
+  outcome   = models.TextField(blank = True)
+  received  = models.DateTimeField(auto_now_add = True, db_index = True)
+
+  @staticmethod
+  def normal(txt):
+    'Returns the text `txt` as it is compared with that of earlier SMS: spaces collapsed, in capitals.'
+    return ' '.join(txt.split()).upper()
+
+  @staticmethod
+  def digests(phone, txt, at):
+    'Returns the digests of the SMS `txt` from `phone` at the time `at`: of its time window and the one before.'
+    wnd = int(at // DEDUP_WINDOW)
+    key = u'%s\n%s\n%%d' % (phone.strip(), SMSDigest.normal(txt))
+    return tuple([hashlib.sha1((key % (w,)).encode('utf-8')).hexdigest() for w in (wnd, wnd - 1)])
+
+  @staticmethod
+  def claim(batch):
+    'Claims the SMS of the `batch`, returning (digest, SMSDigest of the earlier delivery or None) pairs.'
+    now   = time.time()
+    dgss  = [SMSDigest.digests(phone, txt, now) for phone, txt in batch]
+    known = set(SMSDigest.objects.filter(digest__in = [dgs for pair in dgss for dgs in pair]).values_list('digest', flat = True))
+    keys  = []
+    new   = []
+    for cur, prv in dgss:
+      if prv in known or cur in known:
+        keys.append(prv if prv in known else cur)
+      else:
+        keys.append(cur)
+        new.append(cur)
+        known.add(cur)
+    mine  = set()
+    curz  = connection.cursor()
+    if new:
+      curz.execute('INSERT INTO %s (digest, outcome, received) SELECT dgs, \'\', NOW() FROM UNNEST(%%s) AS dgs ON CONFLICT (digest) DO NOTHING RETURNING digest' % (SMSDigest._meta.db_table,), (new,))
+      mine  = set([rw[0] for rw in curz.fetchall()])
+    # A claim still without results after DEDUP_CLAIM_TIMEOUT seconds is that of a delivery that died, and is taken over.
+    olds  = list(set(keys) - set(new))
+    if olds:
+      curz.execute('UPDATE %s SET received = NOW() WHERE digest IN %%s AND outcome = \'\' AND received < NOW() - %%s * INTERVAL \'1 second\' RETURNING digest' % (SMSDigest._meta.db_table,), (tuple(olds), DEDUP_CLAIM_TIMEOUT))
+      mine.update([rw[0] for rw in curz.fetchall()])
+    # The first SMS of each digest claimed here is new; the others (a digest claimed by a concurrent delivery in the meantime, among them) are re-deliveries.
+    news  = []
+    for key in keys:
+      news.append(key in mine)
+      mine.discard(key)
+    dups  = list(set([key for key, nw in zip(keys, news) if not nw]))
+    olds  = dict([(sd.digest, sd) for sd in SMSDigest.objects.filter(digest__in = dups)]) if dups else {}
+    return [(key, None if nw else olds.get(key)) for key, nw in zip(keys, news)]
+
+  @staticmethod
+  def settle(curz, outcomes):
+    'Records the `outcomes`, by digest, with the cursor `curz`, raising DigestLost for a digest settled already.'
+    for dgs in outcomes:
+      curz.execute('UPDATE %s SET outcome = %%s WHERE digest = %%s AND outcome = \'\';' % (SMSDigest._meta.db_table,), (json.dumps(outcomes[dgs]), dgs))
+      if curz.rowcount != 1:
+        raise DigestLost, ('The SMS digest %s was claimed again.' % (dgs,))
+
+  @staticmethod
+  def release(dgss):
+    'Forgets those of the digests `dgss` without results, so that their re-deliveries are processed afresh.'
+    SMSDigest.objects.filter(digest__in = dgss, outcome = '').delete()
+
+  @staticmethod
+  def purge():
+    'Deletes the digests too old to be looked up any more, returning how many there were.'
+    old = SMSDigest.objects.filter(received__lt = timezone.now() - datetime.timedelta(seconds = 2 * DEDUP_WINDOW))
+    ans = old.count()
+    old.delete()
+    return ans
+
+  def results(self):
+    'Returns the results of the earlier delivery of this SMS, marked as a `duplicate`.'
+    ans = json.loads(self.outcome) if self.outcome else {}
+    if 'queued' in ans:
+      try:
+        ans = QueuedSMS.objects.get(id = ans['queued']).results()
+      except QueuedSMS.DoesNotExist:
+        pass
+    ans['duplicate']  = True
+    return ans
+
+RESPONSES = ThouResponseCache(RESPONSE_CACHE_TTL)
+
 class SMSError(models.Model):
   pass
   # TODO: link this to StoredSMS.
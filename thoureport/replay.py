@@ -0,0 +1,202 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+# Rebuilding report tables from the SMS log, as after a change to the fields of a message or a
+# fix to the parser. The stored SMS are parsed again, a chunk at a time, by a pool of processes,
+# and their reports written (with the time of their SMS) into shadow tables made like the
+# report tables, which the reports keep going into meanwhile. Every chunk is checkpointed in
+# the transaction that writes its reports, so that an interrupted replay can be resumed.
+# Once all the chunks are done, the shadow tables get their indexes, and then replace the
+# report tables in a single transaction, which also carries over the reports saved since the
+# replay began (as they were saved) and rebuilds the patient timeline and the rollups.
+# A replay of some of the days only keeps the reports of the other days as they are.
+# The SMS that the ingestion workers have yet to process when the replay begins are left out
+# of it: their reports, once they are saved, are carried over like the other new ones.
+
+from thoureport.messages.rapid1000messages import ThouMessage
+from thoureport.models import StoredSMS, QueuedSMS
+from thoureport.reports.events import rebuild_events
+from thoureport.reports.reports import ThouReport, POOL
+from thoureport.reports.rollups import rebuild
+from thoureport.reports.schema import SCHEMA
+import json
+
+RUN_TABLE     = 'sms_replay'
+CHUNKS_TABLE  = 'sms_replay_chunks'
+SKIP_TABLE    = 'sms_replay_skip'
+
+# The replay that a worker process runs chunks of (see `setup`).
+PLAN          = {}
+
+def shadow_name(tbl):
+  'Returns the name of the shadow table of the report table `tbl`.'
+  return '%s_replay' % (tbl,)
+
+def tables(pairs):
+  'Returns the list of the (table, report class, message class) of the (report class, message class) `pairs`, a table once.'
+  ans   = []
+  seen  = set()
+  for repc, msgc in pairs:
+    tbl, _  = SCHEMA.creation_sql(msgc, repc)
+    if tbl not in seen:
+      seen.add(tbl)
+      ans.append((tbl, repc, msgc))
+  return ans
+
+def selection(codes, since, until):
+  'Returns the SQL conditions (with their arguments) choosing the stored SMS of the `codes` (all of them, if empty) received from the day `since` and before the day `until` (if given), other than those left to the ingestion workers (see `begin`).'
+  conds = ['id NOT IN (SELECT id FROM %s)' % (SKIP_TABLE,)]
+  args  = []
+  if codes:
+    conds.append(r"UPPER(SUBSTRING(message FROM '^\s*(\S*)')) IN %s")
+    args.append(tuple(codes))
+  if since:
+    conds.append('"when" >= %s')
+    args.append(since)
+  if until:
+    conds.append('"when" < %s')
+    args.append(until)
+  return (conds, args)
+
+def outside(since, until):
+  'Returns the SQL condition (with its arguments) on the rows of a report table that a replay from the day `since` and before the day `until` leaves as they are; None if it replaces them all.'
+  conds = []
+  args  = []
+  if since:
+    conds.append('created_at < %s')
+    args.append(since)
+  if until:
+    conds.append('created_at >= %s')
+    args.append(until)
+  if not conds:
+    return (None, [])
+  return ('(created_at IS NULL OR %s)' % (' OR '.join(conds),), args)
+
+def common_columns(msgc, repc):
+  'Returns the list of the columns that the table of the message class `msgc` for the report class `repc` has both in the database and in its `creation_sql`, which are those carried over into its shadow.'
+  tbl, cols = SCHEMA.creation_sql(msgc, repc)
+  have      = SCHEMA.columns(tbl)
+  return [col[0] for col in cols if col[0] in have]
+
+def current(curz):
+  'Returns the replay under way, as a hash of its `codes`, `since`, `until`, `sms_mark` and `marks`; None if there is none.'
+  curz.execute("SELECT COUNT(*) FROM pg_tables WHERE schemaname = current_schema() AND tablename = %s;", (RUN_TABLE,))
+  if not curz.fetchone()[0]:
+    return None
+  curz.execute('SELECT codes, since, until, sms_mark, marks FROM %s;' % (RUN_TABLE,))
+  got = curz.fetchone()
+  if not got:
+    return None
+  return {'codes': json.loads(got[0]), 'since': got[1], 'until': got[2], 'sms_mark': got[3], 'marks': json.loads(got[4])}
+
+def begin(curz, reps, msgs, since, until, batch):
+  '''Sets up the replay of the stored SMS of the report classes of the hash `reps` (of code to report class, with their message classes in `msgs`), from the day `since` and before the day `until`, in chunks of `batch` SMS: its shadow tables, without their indexes, and the SMS to replay, checkpointed by chunk.
+The SMS log and the report tables are locked against writes while the last of their rows are noted down; the replay is of the SMS up to there, and the rows saved after there are carried over by `swap`.
+Every stored SMS then has its reports saved (`store_ingest` saves them in the transaction that stores it), but for those queued for the ingestion workers, which are left out of the replay, as their reports are yet to come.'''
+  pairs = [(reps[cod], msgs[cod]) for cod in sorted(reps)]
+  tbls  = tables(pairs)
+  curz.execute('CREATE TABLE %s (codes TEXT NOT NULL, since DATE, until DATE, sms_mark INTEGER NOT NULL, marks TEXT NOT NULL, started TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW());' % (RUN_TABLE,))
+  curz.execute('CREATE TABLE %s (lo INTEGER PRIMARY KEY, hi INTEGER NOT NULL, done BOOLEAN NOT NULL DEFAULT FALSE, sms INTEGER, reports INTEGER);' % (CHUNKS_TABLE,))
+  curz.execute('CREATE TABLE %s (id INTEGER PRIMARY KEY);' % (SKIP_TABLE,))
+  # The SMS log first: a transaction storing SMS goes on to save their reports.
+  curz.execute('LOCK TABLE %s IN SHARE MODE;' % (StoredSMS._meta.db_table,))
+  marks = {}
+  for tbl, repc, msgc in tbls:
+    curz.execute('LOCK TABLE %s IN SHARE MODE;' % (tbl,))
+    curz.execute('SELECT COALESCE(MAX(indexcol), 0) FROM %s;' % (tbl,))
+    marks[tbl], = curz.fetchone()
+  curz.execute('SELECT COALESCE(MAX(id), 0) FROM %s;' % (StoredSMS._meta.db_table,))
+  smark,  = curz.fetchone()
+  curz.execute("INSERT INTO %s (id) SELECT DISTINCT sms_id FROM %s WHERE state IN ('queued', 'working') AND sms_id <= %%s;" % (SKIP_TABLE, QueuedSMS._meta.db_table), (smark,))
+  curz.execute('INSERT INTO %s (codes, since, until, sms_mark, marks) VALUES (%%s, %%s, %%s, %%s, %%s);' % (RUN_TABLE,), (json.dumps(sorted(reps)), since, until, smark, json.dumps(marks)))
+  keep, args  = outside(since, until)
+  for tbl, repc, msgc in tbls:
+    curz.execute(SCHEMA.table_ddl(msgc, repc, shadow_name(tbl)))
+    if keep:
+      cols  = ', '.join(common_columns(msgc, repc))
+      curz.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE indexcol <= %%s AND %s ORDER BY indexcol;' % (shadow_name(tbl), cols, cols, tbl, keep), [marks[tbl]] + args)
+  conds, args = selection(sorted(reps), since, until)
+  where       = ' AND '.join(['id <= %s'] + conds)
+  curz.execute('SELECT id FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY id) AS n FROM %s WHERE %s) AS t WHERE n %%%% %%s = 0 ORDER BY id;' % (StoredSMS._meta.db_table, where), [smark] + args + [batch])
+  bnds  = [0] + [sid for sid, in curz.fetchall()]
+  if bnds[-1] < smark:
+    bnds.append(smark)
+  for lo, hi in zip(bnds, bnds[1:]):
+    curz.execute('INSERT INTO %s (lo, hi) VALUES (%%s, %%s);' % (CHUNKS_TABLE,), (lo, hi))
+
+def pending(curz):
+  'Returns the list of the (lo, hi) SMS id ranges of the replay under way that are yet to be done, and how many were done already.'
+  curz.execute('SELECT lo, hi, done FROM %s ORDER BY lo;' % (CHUNKS_TABLE,))
+  got = curz.fetchall()
+  return ([(lo, hi) for lo, hi, done in got if not done], len([1 for _, _, done in got if done]))
+
+def plan(run, reps):
+  'Returns what a process needs to replay chunks of the replay `run` (as `current` gives it) of the report classes of `reps` (of code to report class).'
+  conds, args = selection(run['codes'], run['since'], run['until'])
+  return {'reps': reps, 'shadows': dict([(tbl, shadow_name(tbl)) for tbl in run['marks']]), 'conds': conds, 'args': args}
+
+def setup(pln):
+  'Readies a worker process to replay chunks of the plan `pln` (made by `plan`).'
+  PLAN.clear()
+  PLAN.update(pln)
+
+def replay_chunk(chunk):
+  '''Replays the stored SMS of the `chunk`, a (lo, hi) range of their ids, into the shadow tables, and checkpoints the chunk in the same transaction; a chunk that is already done is skipped.
+Returns the chunk, with how many SMS it had and how many reports they made.'''
+  lo, hi  = chunk
+  conds   = ['id > %s', 'id <= %s'] + PLAN['conds']
+  with POOL.transaction() as curz:
+    curz.execute('SELECT done FROM %s WHERE lo = %%s FOR UPDATE;' % (CHUNKS_TABLE,), (lo,))
+    if curz.fetchone()[0]:
+      return (chunk, 0, 0)
+    curz.execute('SELECT sender, message, "when"::TIMESTAMP FROM %s WHERE %s ORDER BY id;' % (StoredSMS._meta.db_table, ' AND '.join(conds)), [lo, hi] + PLAN['args'])
+    sms   = curz.fetchall()
+    prsd  = ThouMessage.parse_many([(sndr, msg) for sndr, msg, _ in sms], PLAN['reps'])
+    got   = [(rep, wn) for (_, _, rep), (_, _, wn) in zip(prsd, sms) if rep]
+    ThouReport.insert_many(curz, [rep for rep, _ in got], PLAN['shadows'], [wn for _, wn in got])
+    curz.execute('UPDATE %s SET done = TRUE, sms = %%s, reports = %%s WHERE lo = %%s;' % (CHUNKS_TABLE,), (len(sms), len(got), lo))
+  return (chunk, len(sms), len(got))
+
+def index_shadows(run, pairs):
+  'Gives the shadow tables of the replay `run` the indexes of their report tables (under their own names), now that their rows are in.'
+  with POOL.transaction() as curz:
+    for tbl, repc, msgc in tables(pairs):
+      if tbl in run['marks']:
+        for _, stmt in SCHEMA.index_ddl(msgc, repc, shadow_name(tbl)):
+          curz.execute(stmt)
+
+def swap(run, pairs):
+  '''Replaces the report tables of the replay `run` with their shadow tables, in a single transaction: the reports saved since the replay began are carried over, the shadows and their sequences and indexes take the names of the report tables, and the patient timeline and the rollups (of the days replayed) are rebuilt.
+Returns the hash of how many reports each table has now.'''
+  ans = {}
+  with POOL.transaction() as curz:
+    tbls  = [(tbl, repc, msgc) for tbl, repc, msgc in tables(pairs) if tbl in run['marks']]
+    for tbl, _, _ in tbls:
+      curz.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE;' % (tbl,))
+    for tbl, repc, msgc in tbls:
+      shd   = shadow_name(tbl)
+      cols  = ', '.join(common_columns(msgc, repc))
+      curz.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE indexcol > %%s ORDER BY indexcol;' % (shd, cols, cols, tbl), (run['marks'][tbl],))
+      curz.execute('DROP TABLE %s;' % (tbl,))
+      curz.execute('ALTER TABLE %s RENAME TO %s;' % (shd, tbl))
+      curz.execute("SELECT pg_get_serial_sequence(%s, 'indexcol');", (tbl,))
+      seq,  = curz.fetchone()
+      curz.execute('ALTER SEQUENCE %s RENAME TO %s_indexcol_seq;' % (seq, tbl))
+      curz.execute('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s;', (tbl,))
+      for nom, in curz.fetchall():
+        if nom.startswith(shd):
+          curz.execute('ALTER INDEX %s RENAME TO %s%s;' % (nom, tbl, nom[len(shd):]))
+      rebuild_events(curz, tbl, msgc)
+      rebuild(curz, tbl, msgc, run['since'], run['until'])
+      curz.execute('SELECT COUNT(*) FROM %s;' % (tbl,))
+      ans[tbl], = curz.fetchone()
+    curz.execute('DROP TABLE %s, %s, %s;' % (RUN_TABLE, CHUNKS_TABLE, SKIP_TABLE))
+  SCHEMA.reset()
+  return ans
+
+def abandon(run):
+  'Drops the shadow tables and the checkpoints of the replay `run`, leaving the report tables as they are.'
+  with POOL.transaction() as curz:
+    for tbl in run['marks']:
+      curz.execute('DROP TABLE IF EXISTS %s;' % (shadow_name(tbl),))
+    curz.execute('DROP TABLE %s, %s, %s;' % (RUN_TABLE, CHUNKS_TABLE, SKIP_TABLE))
@@ -0,0 +1,50 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+# The patient timeline: a single narrow table of the reports that name a patient (in a field that
+# `identifies` them), whatever their report table, keyed by the patient and the time of the
+# report, and pointing at the row of the report (its table and indexcol). A patient's history
+# is then one index range, rather than a scan of every report table.
+# It is kept up to date as reports are saved (`record_events`), and can be recomputed from a
+# report table (`rebuild_events`).
+
+EVENTS_TABLE  = 'patient_events'
+
+def events_ddl():
+  'Returns the statement creating the patient events table.'
+  return 'CREATE TABLE %s (patient TEXT NOT NULL, at TIMESTAMP WITHOUT TIME ZONE NOT NULL, tbl TEXT NOT NULL, indexcol INTEGER NOT NULL, PRIMARY KEY (patient, at, tbl, indexcol));' % (EVENTS_TABLE,)
+
+def patient_field(msgc):
+  'Returns the column name of the field of the message class `msgc` that identifies the patient, or None if it has none.'
+  for fld in msgc.fields:
+    if type(fld) != type((1, 2)) and fld.identifies:
+      return fld.subname()
+  return None
+
+def report_patient(msg):
+  'Returns the ID of the patient that the Message object `msg` is about, or None.'
+  sub = patient_field(msg.__class__)
+  fob = msg.entries.get(sub) if sub else None
+  if fob and fob.working_value:
+    return fob.working_value[0]
+  return None
+
+def record_events(curz, evts):
+  '''Adds the events `evts`, as (patient, time, table, indexcol) tuples, with the cursor `curz`.
+Meant to run in the transaction that saves their reports.'''
+  if not evts:
+    return
+  vals  = [curz.mogrify('(%s, %s, %s, %s)', evt) for evt in evts]
+  curz.execute('INSERT INTO %s (patient, at, tbl, indexcol) VALUES %s ON CONFLICT DO NOTHING;' % (EVENTS_TABLE, ', '.join(vals)))
+
+def rebuild_events(curz, tbl, msgc):
+  'Recomputes the events of the report table `tbl` (of the message class `msgc`) from its rows, with the cursor `curz`.'
+  curz.execute('DELETE FROM %s WHERE tbl = %%s;' % (EVENTS_TABLE,), (tbl,))
+  sub = patient_field(msgc)
+  if sub:
+    curz.execute('INSERT INTO %s (patient, at, tbl, indexcol) SELECT %s, created_at, %%s, indexcol FROM %s WHERE %s IS NOT NULL AND created_at IS NOT NULL ON CONFLICT DO NOTHING;' % (EVENTS_TABLE, sub, tbl, sub), (tbl,))
+
+def patient_timeline(curz, patient):
+  'Returns the list of the (time, table, indexcol) events of the patient `patient`, oldest first, with the cursor `curz`.'
+  curz.execute('SELECT at, tbl, indexcol FROM %s WHERE patient = %%s ORDER BY at, tbl, indexcol;' % (EVENTS_TABLE,), (patient,))
+  return curz.fetchall()
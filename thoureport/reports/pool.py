@@ -0,0 +1,170 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+from contextlib import contextmanager
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+import psycopg2
+import threading
+import time
+
+class ThouPoolTimeout(Exception):
+  'Raised when no connection could be checked out of the pool in time.'
+  pass
+
+class ThouPool:
+  'Thread-safe pool of connections to the reports database, opened as they are needed.'
+  def __init__(self, minconn, maxconn, timeout = 10, health_check = 30, **dsn):
+    self.minconn      = minconn
+    self.maxconn      = maxconn
+    self.timeout      = timeout
+    self.health_check = health_check
+    self.dsn          = dsn
+    self.local        = threading.local()
+    self.cond         = threading.Condition()
+    self.busy         = 0
+    self.cursors      = 0
+    self.idle         = []
+    self.counts       = {'checkouts': 0, 'connects': 0, 'waits': 0, 'timeouts': 0, 'discarded': 0, 'commits': 0, 'rollbacks': 0}
+
+  def connect(self):
+    'Opens a new connection to the database.'
+    return psycopg2.connect(**self.dsn)
+
+  def warm(self):
+    'Opens connections until `minconn` of them are open, returning how many it opened.'
+    with self.cond:
+      want  = self.minconn - len(self.idle) - self.busy
+    made  = [(self.connect(), time.time()) for _ in range(max(want, 0))]
+    with self.cond:
+      self.idle.extend(made)
+      self.counts['connects'] = self.counts['connects'] + len(made)
+    return len(made)
+
+  def count(self, what):
+    'Increments the statistic called `what`.'
+    with self.cond:
+      self.counts[what] = self.counts[what] + 1
+
+  def healthy(self, conn, since):
+    'Tells whether the connection `conn`, idle since `since`, is still usable.'
+    if conn.closed:
+      return False
+    if time.time() - since < self.health_check:
+      return True
+    try:
+      curz  = conn.cursor()
+      curz.execute('SELECT 1;')
+      curz.close()
+      conn.rollback()
+      return True
+    except Exception:
+      return False
+
+  def checkout(self):
+    'Takes a healthy connection out of the pool, waiting for one if need be.'
+    with self.cond:
+      began = time.time()
+      if not self.idle and self.busy >= self.maxconn:
+        self.counts['waits'] = self.counts['waits'] + 1
+      while not self.idle and self.busy >= self.maxconn:
+        left  = self.timeout - (time.time() - began)
+        if left <= 0:
+          self.counts['timeouts'] = self.counts['timeouts'] + 1
+          raise ThouPoolTimeout, ('No reports database connection free after %d seconds.' % (self.timeout,))
+        self.cond.wait(left)
+      self.busy = self.busy + 1
+      self.counts['checkouts'] = self.counts['checkouts'] + 1
+      got = self.idle.pop() if self.idle else None
+    try:
+      if got:
+        conn, since = got
+        if self.healthy(conn, since):
+          return conn
+        self.count('discarded')
+        if not conn.closed:
+          conn.close()
+      self.count('connects')
+      return self.connect()
+    except Exception:
+      with self.cond:
+        self.busy = self.busy - 1
+        self.cond.notify()
+      raise
+
+  def checkin(self, conn):
+    'Returns the connection `conn` to the pool, rolling back whatever it left unfinished.'
+    try:
+      if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    except Exception:
+      conn.close()
+    with self.cond:
+      self.busy = self.busy - 1
+      if not conn.closed:
+        self.idle.append((conn, time.time()))
+      self.cond.notify()
+
+  def closeall(self):
+    'Closes the idle connections; to be called before forking.'
+    with self.cond:
+      idle, self.idle = self.idle, []
+    for conn, _ in idle:
+      conn.close()
+
+  def rebind(self, **dsn):
+    'Points the pool at another database, closing the idle connections to the old one.'
+    with self.cond:
+      self.dsn  = dict(self.dsn, **dsn)
+    self.closeall()
+
+  @contextmanager
+  def connection(self):
+    'Scopes the use of a connection; nested in the same thread, the outermost one is reused.'
+    conn  = getattr(self.local, 'conn', None)
+    if conn:
+      yield conn
+      return
+    conn            = self.checkout()
+    self.local.conn = conn
+    try:
+      yield conn
+    finally:
+      self.local.conn = None
+      self.checkin(conn)
+
+  @contextmanager
+  def transaction(self, named = False):
+    'Yields a cursor (server-side if `named`), committing when the block is done; a nested one joins the outer.'
+    outer = getattr(self.local, 'conn', None)
+    with self.connection() as conn:
+      if named:
+        with self.cond:
+          self.cursors  = self.cursors + 1
+          curz          = conn.cursor('thoucursor_%d' % (self.cursors,))
+      else:
+        curz  = conn.cursor()
+      try:
+        try:
+          yield curz
+        finally:
+          if not curz.closed:
+            curz.close()
+        if not outer:
+          conn.commit()
+          self.count('commits')
+      except Exception:
+        if not outer:
+          conn.rollback()
+          self.count('rollbacks')
+        raise
+
+  def stats(self):
+    'Returns a hash of the pool statistics: its bounds, its connections, and the running counts.'
+    with self.cond:
+      ans         = dict(self.counts)
+      ans['idle'] = len(self.idle)
+      ans['busy'] = self.busy
+    ans['min']    = self.minconn
+    ans['max']    = self.maxconn
+    ans['open']   = ans['idle'] + ans['busy']
+    return ans
@@ -2,15 +2,36 @@
 # vim: expandtab ts=2
 
 from thoureport.messages.parser import *
-from thousand.settings import THE_DATABASE
+from thoureport.metrics import METRICS
+from thoureport.reports.events import record_events, report_patient
+from thoureport.reports.pool import ThouPool
+from thoureport.reports.rollups import record, report_measures
+from thousand.settings import CODE_BITMASKS, DATABASES, REPORTS_POOL, ROLLUPS_ON_SAVE, EXPORT_CHUNK
+from collections import Counter
+import array
+import datetime
+import decimal
 import psycopg2
 import re
+import sys
+
+# NumPy, for the ThouTable columns, is slow to import and most processes never make one,
+# so it is only imported with the first column (see `numeric`); None until then, and if
+# it is not installed.
+numpy         = None
+NUMPY_TRIED   = False
 
 __DEFAULTS    = DATABASES['default']
-THE_DATABASE  = psycopg2.connect(database = __DEFAULTS['NAME'],
-                                     user = __DEFAULTS['USER'],
-                                 password = __DEFAULTS['PASSWORD'],
-                                     host = __DEFAULTS['HOST'])
+POOL          = ThouPool(REPORTS_POOL['MIN'], REPORTS_POOL['MAX'],
+                          timeout = REPORTS_POOL['TIMEOUT'],
+                     health_check = REPORTS_POOL['HEALTH_CHECK'],
+                         database = __DEFAULTS['NAME'],
+                             user = __DEFAULTS['USER'],
+                         password = __DEFAULTS['PASSWORD'],
+                             host = __DEFAULTS['HOST'])
+
+# The most rows that `ThouReport.save_many` puts in a single INSERT.
+BULK_ROWS     = 500
 
 # TODO:
 # Load the report(s).
@@ -31,34 +52,117 @@ class ThouReport:
     for fx in ents:
       curfd = ents[fx]
       if curfd.several_fields:
+        if CODE_BITMASKS:
+          cvs[fx] = self.code_mask(curfd.__class__, curfd.working_value)
+          continue
         for vl in curfd.working_value:
-          cvs[('%s_%s' % (fx, vl)).lower()] = vl
+          cvs[('%s_%s' % (fx, vl)).lower()] = True
       else:
         try:
-          cvs[fx] = curfd.working_value[0]
+          cvs[fx] = curfd.db_values[0]
         except IndexError:
           raise Exception, ('No value supplied for column \'%s\' (%s)' % (fx, str(curfd)))
     return cvs
 
-  # TODO: Consider the message field classes' declared default.
-  def save(self):
-    '''This method saves the report object into the table for that report class, returning the index as an integer.
-It is not idempotent at this level; further constraints should be added by inheriting classes.'''
+  def __row(self, curz):
+    '''Returns a triple: the table into which this report goes, the (tuple of) columns that its insertion affects, and their values escaped with the cursor `curz`.'''
     tbl, cols = self.msg.__class__.create_in_db(self.__class__)
     cvs       = self.__insertables(cols)
-    curz      = THE_DATABASE.cursor()
     cpt       = []
     vpt       = []
     for coln, _, escer, _ in cols:
       if coln in cvs:
         cpt.append(coln)
         vpt.append(escer.dbvalue(cvs[coln], curz))
-    qry = 'INSERT INTO %s (%s) VALUES (%s) RETURNING indexcol;' % (tbl, ', '.join(cpt), ', '.join(vpt)) 
-    curz.execute(qry)
-    ans = curz.fetchone()[0]
-    curz.close()
+    return (tbl, tuple(cpt), vpt)
+
+  # TODO: Consider the message field classes' declared default.
+  @METRICS.timed('report.save')
+  def save(self):
+    '''This method saves the report object into the table for that report class (and into the timeline of its patient), returning the index as an integer.
+It is not idempotent at this level; further constraints should be added by inheriting classes.'''
+    self.msg.__class__.create_in_db(self.__class__)
+    with POOL.transaction() as curz:
+      tbl, cpt, vpt   = self.__row(curz)
+      qry = 'INSERT INTO %s (%s) VALUES (%s) RETURNING indexcol, created_at;' % (tbl, ', '.join(cpt), ', '.join(vpt)) 
+      curz.execute(qry)
+      ans, tm = curz.fetchone()
+      pat     = report_patient(self.msg)
+      if pat is not None:
+        record_events(curz, [(pat, tm, tbl, ans)])
+      if ROLLUPS_ON_SAVE:
+        record(curz, tbl, dict([(msr, 1) for msr in report_measures(self.msg)]))
+      return ans
+
+  @classmethod
+  @METRICS.timed('report.save_many')
+  def save_many(self, reps):
+    '''Saves the list of report objects `reps` in a single transaction, returning the list of their indices (in the order of `reps`).
+The reports go in as `insert_many` puts them, and so do their patient events, at most `BULK_ROWS` at a time.'''
+    msrs  = {}
+    evts  = []
+    for rep in reps:
+      rep.msg.__class__.create_in_db(rep.__class__)
+    with POOL.transaction() as curz:
+      got = self.insert_many(curz, reps)
+      for rep, (tbl, ind, tm) in zip(reps, got):
+        pat = report_patient(rep.msg)
+        if pat is not None:
+          evts.append((pat, tm, tbl, ind))
+        if ROLLUPS_ON_SAVE:
+          cnts  = msrs.setdefault(tbl, {})
+          for msr in report_measures(rep.msg):
+            cnts[msr] = cnts.get(msr, 0) + 1
+      for sht in range(0, len(evts), BULK_ROWS):
+        record_events(curz, evts[sht:sht + BULK_ROWS])
+      for tbl in sorted(msrs):
+        record(curz, tbl, msrs[tbl])
+    return [ind for _, ind, _ in got]
+
+  @classmethod
+  def insert_many(self, curz, reps, tables = {}, times = None):
+    '''Inserts the list of report objects `reps` with the cursor `curz`, and nothing else (neither patient events nor rollups), returning the list of their (table, index, creation time), in the order of `reps`.
+The reports are grouped by table and by the columns they affect, and each group goes in with multi-row INSERTs of at most `BULK_ROWS` rows.
+A report goes into the table that `tables` maps its own table to, if it does, and is created at the time given for it in `times` (a list in the order of `reps`), if there is one.'''
+    ans   = [None] * len(reps)
+    tbls  = [None] * len(reps)
+    grps  = {}
+    for ind, rep in enumerate(reps):
+      tbl, cpt, vpt = rep.__row(curz)
+      tbls[ind]     = tbl
+      if times is not None:
+        cpt = cpt + ('created_at',)
+        vpt = vpt + [curz.mogrify('%s', (times[ind],))]
+      grps.setdefault((tables.get(tbl, tbl), cpt), []).append((ind, vpt))
+    for (tbl, cpt), rows in grps.items():
+      for sht in range(0, len(rows), BULK_ROWS):
+        them  = rows[sht:sht + BULK_ROWS]
+        qry   = 'INSERT INTO %s (%s) VALUES %s RETURNING indexcol, created_at;' % (tbl, ', '.join(cpt), ', '.join(['(%s)' % (', '.join(vpt),) for _, vpt in them]))
+        curz.execute(qry)
+        for (ind, _), got in zip(them, curz.fetchall()):
+          ans[ind]  = (tbls[ind], got[0], got[1])
     return ans
 
+  @staticmethod
+  def code_mask(fldc, codes):
+    'Returns the bitmask in which the multiple field class `fldc` stores the `codes` (with `CODE_BITMASKS`).'
+    return fldc.to_mask(codes)
+
+  @staticmethod
+  def has_code(fldc, code):
+    'Returns the SQL predicate true of the rows whose multiple field of class `fldc` has the code `code`, whichever way the codes are stored.'
+    return fldc.has_sql([code])
+
+  @staticmethod
+  def has_any(fldc, codes):
+    'Returns the SQL predicate true of the rows whose multiple field of class `fldc` has any of the `codes`.'
+    return fldc.has_sql(codes)
+
+  @staticmethod
+  def has_all(fldc, codes):
+    'Returns the SQL predicate true of the rows whose multiple field of class `fldc` has all of the `codes`.'
+    return fldc.has_sql(codes, True)
+
   @classmethod
   def describe(self, tn):
     if not cvs:
@@ -129,27 +233,367 @@ It is not idempotent at this level; further constraints should be added by inher
     with ThouMessage.parse(msgtxt) as msg:
       return self(msg)
 
+# How a ThouTable column of each kind is stored: the array.array type code, and the NumPy
+# dtype used instead when NumPy is there. The codes of a field are their ordinals (-1 for
+# NULL) against the codes of the field, a bitmask is 0 for NULL, numbers are NaN for NULL,
+# and dates and times are NaT for NULL (without NumPy: the ordinal of the day, 0 for NULL,
+# and microseconds since 1970, NULL_TIME for NULL). Text is kept as a list.
+STORAGE   = {
+  'code':   ('h', 'int16'),
+  'mask':   ('l', 'int64'),
+  'flag':   ('b', 'bool'),
+  'number': ('d', 'float64'),
+  'date':   ('l', 'datetime64[D]'),
+  'time':   ('l', 'datetime64[us]'),
+}
+EPOCH     = datetime.datetime(1970, 1, 1)
+NULL_TIME = -sys.maxint - 1
+NAN       = float('nan')
+# The NumPy units of the date buckets that ThouTable.buckets makes.
+BUCKETS   = {'day': 'D', 'week': 'D', 'month': 'M', 'year': 'Y'}
+
+def numeric():
+  'Imports NumPy, the first time, and returns it (None if it is not installed).'
+  global numpy, NUMPY_TRIED
+  if not NUMPY_TRIED:
+    try:
+      import numpy
+    except ImportError:
+      numpy = None
+    NUMPY_TRIED = True
+  return numpy
+
+def column_kind(col, mlts):
+  'Returns the (kind, field class, code) of the column `col` (as in `creation_sql`) in a ThouTable, `mlts` being the multiple fields of its message class.'
+  name, decl, fldc, etc = col
+  typ = decl.split()[0].upper()
+  if not isinstance(fldc, type):
+    return ('time', None, None)
+  if fldc in mlts:
+    return ('mask', fldc, None) if name == fldc.subname() else ('flag', fldc, etc)
+  if fldc.expectation_codes:
+    return ('code', fldc, None)
+  if typ == 'DATE':
+    return ('date', fldc, None)
+  if typ == 'TIMESTAMP':
+    return ('time', fldc, None)
+  if typ in ('SMALLINT', 'INTEGER', 'BIGINT', 'NUMERIC', 'REAL', 'DOUBLE'):
+    return ('number', fldc, None)
+  return ('text', fldc, None)
+
+def value_kind(val):
+  'Returns the kind of ThouTable column that holds values like `val`, for columns that are not those of a report table.'
+  if isinstance(val, bool):
+    return 'flag'
+  if isinstance(val, datetime.datetime):
+    return 'time'
+  if isinstance(val, datetime.date):
+    return 'date'
+  if isinstance(val, (int, long, float, decimal.Decimal)):
+    return 'number'
+  return 'text'
+
+class ThouColumn:
+  '''A column of a ThouTable: its `name`, its `kind` (see STORAGE) and its `data`, an array of that kind; for the columns of a field, its class `fldc` (whose codes are what the ordinals of a code column stand for), and for the flag of a code of a multiple field, that `code`.
+Rows are added a chunk at a time (`extend`), and the chunks joined up when the data are next asked for.'''
+  def __init__(self, name, kind, fldc = None, code = None, integral = False):
+    numeric()
+    self.name     = name
+    self.kind     = kind
+    self.fldc     = fldc
+    self.code     = code
+    self.codes    = tuple(fldc.expectation_codes) if fldc else ()
+    self.integral = integral
+    self.chunks   = []
+    self.stored   = self.store([])
+
+  @property
+  def data(self):
+    'The values of the column, as stored (see STORAGE).'
+    if self.chunks:
+      parts, self.chunks  = self.chunks, []
+      if numpy is not None and self.kind != 'text':
+        self.stored = numpy.concatenate([self.stored] + parts)
+      else:
+        for part in parts:
+          self.stored.extend(part)
+    return self.stored
+
+  def __len__(self):
+    return len(self.data)
+
+  def encode(self, val):
+    'Returns what the column stores for the value `val`, as read from the database.'
+    knd = self.kind
+    if knd == 'code':
+      if val is None:
+        return -1
+      if isinstance(val, bool):
+        return 0 if val else 1
+      if isinstance(val, basestring):
+        return self.fldc.expectation_ordinals.get(self.fldc.canonical(val), -1)
+      return val
+    if knd == 'mask':
+      return val or 0
+    if knd == 'flag':
+      return bool(val)
+    if knd == 'number':
+      return NAN if val is None else float(val)
+    if knd == 'text' or numpy is not None:
+      return val
+    if knd == 'date':
+      return val.toordinal() if val else 0
+    if val is None:
+      return NULL_TIME
+    dlt = val - EPOCH
+    return (dlt.days * 86400 + dlt.seconds) * 1000000 + dlt.microseconds
+
+  def store(self, vals):
+    'Returns the values `vals` (as `encode` gives them) stored as the kind of this column.'
+    if self.kind == 'text':
+      return list(vals)
+    typc, dtyp  = STORAGE[self.kind]
+    if numpy is not None:
+      return numpy.array(vals, dtype = dtyp)
+    return array.array(typc, vals)
+
+  def extend(self, vals):
+    'Adds the values `vals`, as read from the database, at the end of the column.'
+    self.chunks.append(self.store([self.encode(val) for val in vals]))
+
+  def decode(self, val):
+    'Turns the stored value `val` back into what the SMS said, as `ThouMessage.decoders` do (numbers come back as floats, unless their column is of integers).'
+    knd = self.kind
+    if knd == 'code':
+      return self.codes[val] if 0 <= val < len(self.codes) else None
+    if knd == 'mask':
+      return ' '.join(self.fldc.from_mask(int(val))) or None
+    if knd == 'flag':
+      return self.code if val else None
+    if knd == 'number':
+      if val != val:
+        return None
+      return int(val) if self.integral else float(val)
+    if knd == 'text':
+      return val
+    if numpy is not None:
+      return None if numpy.isnat(val) else val.astype(object)
+    if knd == 'date':
+      return datetime.date.fromordinal(val) if val else None
+    return None if val == NULL_TIME else EPOCH + datetime.timedelta(microseconds = val)
+
+  def values(self):
+    'Returns the list of the values of the column, decoded.'
+    return [self.decode(val) for val in self.data]
+
+  def has(self, code):
+    'Returns the vector of the rows that have the code `code` (in a code column, a bitmask or the flag of the code), as booleans.'
+    if self.kind not in ('code', 'mask', 'flag'):
+      raise ValueError, ('%s holds no codes.' % (self.name,))
+    exp = self.fldc.canonical(code)
+    dat = self.data
+    if self.kind == 'flag':
+      if exp != self.code:
+        return numpy.zeros(len(dat), dtype = bool) if numpy is not None else [False] * len(dat)
+      return dat if numpy is not None else [bool(val) for val in dat]
+    if exp not in self.fldc.expectation_ordinals:
+      raise ValueError, ('%s is not a code of %s.' % (code, self.name))
+    if self.kind == 'mask':
+      bit = self.fldc.bit(exp)
+      return (dat & bit) != 0 if numpy is not None else [(val & bit) != 0 for val in dat]
+    ind = self.fldc.expectation_ordinals[exp]
+    return dat == ind if numpy is not None else [val == ind for val in dat]
+
+  def select(self, which):
+    'Returns a new column of the rows of this one that the vector of booleans `which` picks.'
+    ans         = ThouColumn(self.name, self.kind, self.fldc, self.code, self.integral)
+    if numpy is not None and self.kind != 'text':
+      ans.stored  = self.data[numpy.asarray(which, dtype = bool)]
+    else:
+      ans.stored  = self.store([val for val, yes in zip(self.data, which) if yes])
+    return ans
+
 class ThouTable:
+  '''A result set held by column (see ThouColumn): the codes of a field are dictionary-encoded (as the ordinals that the column of the field stores), numbers, dates and times are typed arrays (NumPy ones, if NumPy is there), and only text is kept as Python objects.
+`table['name']` is the column `name` itself, as stored; `table[n]` is the row `n`, decoded; `table['name':row]` is the value of the column `name` in the `row`, either a row number or a row as `rows` gives them.'''
   def __init__(self, cols, rows = None):
-    self.names  = cols
-    self.__set_names()
-    self.query  = rows
-
-  def __set_names(self):
-    dem         = self.names
-    self.names  = {}
-    notI        = 0
-    for x in dem:
-      self.names[x] = notI
-      notI          = notI + 1
+    '''Made with the columns `cols`, either ThouColumn objects or names (whose kinds are then taken from the values of the first of the `rows`), and the `rows`, tuples in the order of `cols`.'''
+    self.columns  = cols
+    self.names    = dict([(col if isinstance(col, basestring) else col.name, ind) for ind, col in enumerate(cols)])
+    if rows:
+      self.add(rows)
 
-  def rows(self):
-    return self.query
+  @classmethod
+  def report_columns(self, msgc, repc):
+    'Returns the (empty) ThouColumn objects of the columns of the table of the message class `msgc` for the report class `repc`.'
+    mlts  = msgc.multiples()
+    ans   = []
+    for col in msgc.creation_sql(repc)[1]:
+      knd, fldc, cod  = column_kind(col, mlts)
+      ans.append(ThouColumn(col[0], knd, fldc, cod, col[1].split()[0].upper() in ('SMALLINT', 'INTEGER', 'BIGINT')))
+    return ans
+
+  @classmethod
+  def from_report(self, msgc, repc, since = None, until = None, chunk = EXPORT_CHUNK):
+    '''Reads the rows of the table of the message class `msgc` for the report class `repc` (those created from `since` and before `until`, if given), oldest first, into a ThouTable.
+They are fetched `chunk` at a time from a server-side cursor, and every chunk is stored by column before the next is read, so that the rows are never all held as tuples.'''
+    tbl, cols = msgc.create_in_db(repc)
+    ans       = self(self.report_columns(msgc, repc))
+    conds     = []
+    args      = []
+    if since:
+      conds.append('created_at >= %s')
+      args.append(since)
+    if until:
+      conds.append('created_at < %s')
+      args.append(until)
+    qry = 'SELECT %s FROM %s%s ORDER BY indexcol' % (', '.join([col[0] for col in cols]), tbl, (' WHERE ' + ' AND '.join(conds)) if conds else '')
+    with POOL.transaction(named = True) as curz:
+      curz.itersize = chunk
+      curz.execute(qry, args)
+      while True:
+        got = curz.fetchmany(chunk)
+        if not got:
+          break
+        ans.add(got)
+    return ans
+
+  def add(self, rows):
+    'Adds the `rows` (tuples in the order of the columns) at the end of the table.'
+    rows  = list(rows)
+    if not rows:
+      return
+    for ind, col in enumerate(self.columns):
+      if isinstance(col, basestring):
+        knd               = 'text'
+        for rw in rows:
+          if rw[ind] is not None:
+            knd = value_kind(rw[ind])
+            break
+        self.columns[ind] = ThouColumn(col, knd, integral = all([isinstance(rw[ind], (int, long)) for rw in rows if rw[ind] is not None]))
+    for col, vals in zip(self.columns, zip(*rows)):
+      col.extend(vals)
+
+  def __len__(self):
+    return len(self.columns[0]) if self.columns and not isinstance(self.columns[0], basestring) else 0
+
+  def column(self, name):
+    'Returns the ThouColumn called `name`.'
+    try:
+      return self.columns[self.names[name]]
+    except KeyError:
+      raise NameError, ('No column called "%s" (has: %s).' % (name, ', '.join(sorted(self.names))))
 
   def __getitem__(self, them):
+    if isinstance(them, basestring):
+      return self.column(them).data
+    if isinstance(them, (int, long)):
+      return tuple([col.decode(col.data[them]) for col in self.columns])
     if type(them) != slice:
-      raise ValueError, 'Should be a slice [column-name:row]'
-    try:
-      return them.stop[self.names[them.start]]
-    except ValueError:
-      raise NameError, ('No column called "%s" (has: %s).' % (colnm, ', '.join(cols)))
+      raise ValueError, 'Should be a column name, a row number, or a slice [column-name:row]'
+    col = self.column(them.start)
+    if isinstance(them.stop, (int, long)):
+      return col.decode(col.data[them.stop])
+    return them.stop[self.names[them.start]]
+
+  def rows(self):
+    'Returns the list of the rows, decoded, as tuples.'
+    return zip(*[col.values() for col in self.columns])
+
+  def has(self, name, code):
+    'Returns the vector of the rows whose column `name` has the code `code`, as booleans.'
+    return self.column(name).has(code)
+
+  def select(self, which):
+    'Returns a new ThouTable of the rows that the vector of booleans `which` picks.'
+    return ThouTable([col.select(which) for col in self.columns])
+
+  def counts(self, name):
+    '''Returns the hash of the number of rows with each code of the column `name` (a field\'s code, a bitmask, or the flag of a code); that of the number of rows with each value, for the other columns.
+NULLs are not counted.'''
+    col = self.column(name)
+    dat = col.data
+    if col.kind == 'mask':
+      return dict([(exp, cnt) for exp, cnt in [(exp, self.count(col.has(exp))) for exp in col.codes] if cnt])
+    if col.kind == 'flag':
+      cnt = self.count(dat)
+      return {col.code: cnt} if cnt else {}
+    if col.kind == 'code' and numpy is not None:
+      cnts  = numpy.bincount(dat[dat >= 0].astype(numpy.int64), minlength = len(col.codes))
+      return dict([(col.codes[ind], int(cnt)) for ind, cnt in enumerate(cnts) if cnt])
+    cnts  = Counter(col.values())
+    cnts.pop(None, None)
+    return dict(cnts)
+
+  @staticmethod
+  def count(which):
+    'Returns how many of the vector of booleans `which` are true.'
+    return int(numpy.count_nonzero(which)) if numpy is not None else sum([1 for yes in which if yes])
+
+  def buckets(self, name, unit = 'day'):
+    '''Returns the vector of the day, week (starting on Monday), month or year (as `unit` says) of the date or time column `name`, each given as its first day: datetime64 values with NumPy (NaT for NULL), dates without (None for NULL).'''
+    col = self.column(name)
+    if col.kind not in ('date', 'time'):
+      raise ValueError, ('%s is neither a date nor a time.' % (name,))
+    if unit not in BUCKETS:
+      raise ValueError, ('No %s buckets (there are: %s).' % (unit, ', '.join(sorted(BUCKETS))))
+    if numpy is not None:
+      got = col.data.astype('datetime64[%s]' % (BUCKETS[unit],))
+      if unit == 'week':
+        got = got - ((got.astype(numpy.int64) + 3) % 7).astype('timedelta64[D]')
+      return got
+    ans = []
+    for val in col.values():
+      if val is None:
+        ans.append(None)
+        continue
+      if isinstance(val, datetime.datetime):
+        val = val.date()
+      if unit == 'week':
+        val = val - datetime.timedelta(days = val.weekday())
+      elif unit == 'month':
+        val = val.replace(day = 1)
+      elif unit == 'year':
+        val = val.replace(month = 1, day = 1)
+      ans.append(val)
+    return ans
+
+  def group_by(self, *names, **opts):
+    '''Returns the hash of the number of rows for each combination of the values of the columns `names`, by tuples of those values (decoded).
+A date or time column is taken by its buckets of the `unit` (as in `buckets`) given (days, if none), and `where`, a vector of booleans, restricts the rows counted. Bitmasks, whose rows can have several codes, are counted with `counts` instead.'''
+    unit  = opts.get('unit', 'day')
+    where = opts.get('where')
+    for name in names:
+      if self.column(name).kind == 'mask':
+        raise ValueError, ('%s can have several codes; see `counts`.' % (name,))
+    if numpy is None:
+      lbls  = [self.buckets(name, unit) if self.column(name).kind in ('date', 'time') else self.column(name).values() for name in names]
+      keys  = zip(*lbls)
+      if where is not None:
+        keys  = [key for key, yes in zip(keys, where) if yes]
+      return dict(Counter(keys))
+    keys  = []
+    decs  = []
+    for name in names:
+      key, dec  = self.__keys(name, unit)
+      keys.append(key if where is None else key[numpy.asarray(where, dtype = bool)])
+      decs.append(dec)
+    if not len(keys[0]):
+      return {}
+    got, cnts = numpy.unique(numpy.stack(keys, axis = 1), axis = 0, return_counts = True)
+    return dict([(tuple([dec(k) for dec, k in zip(decs, rw)]), int(cnt)) for rw, cnt in zip(got, cnts)])
+
+  def __keys(self, name, unit):
+    'Returns the column `name` as a vector of integers that `group_by` counts by, with the function turning such an integer back into its value (NumPy only).'
+    col = self.column(name)
+    if col.kind in ('code', 'flag'):
+      return (col.data.astype(numpy.int64), lambda k: col.decode(k))
+    if col.kind in ('date', 'time'):
+      bnd = 'datetime64[%s]' % (BUCKETS[unit],)
+      nat = numpy.datetime64('NaT').astype(numpy.int64)
+      return (self.buckets(name, unit).astype(numpy.int64), lambda k: None if k == nat else numpy.array(k).astype(bnd).astype(object).item())
+    vals  = col.values()
+    seen  = {}
+    keys  = numpy.array([seen.setdefault(val, len(seen)) for val in vals], dtype = numpy.int64)
+    back  = dict([(ind, val) for val, ind in seen.items()])
+    return (keys, lambda k: back[k])
@@ -0,0 +1,78 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+# Per-day aggregates of the report tables: every report table `t` has a rollup table `t_daily`
+# holding, for each day, the number of reports (under the field and code 'all'), and the number
+# of reports bearing each code of the code fields of its message.
+# They are kept up to date as reports are saved (`record`), and can be recomputed from the
+# report table for any range of days (`rebuild`).
+
+TOTAL = 'all'
+
+def rollup_table(tbl):
+  'Returns the name of the rollup table of the report table `tbl`.'
+  return '%s_daily' % (tbl,)
+
+def rollup_ddl(tbl):
+  'Returns the statement creating the rollup table of the report table `tbl`.'
+  return 'CREATE TABLE %s (day DATE NOT NULL, field TEXT NOT NULL, code TEXT NOT NULL, total INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (day, field, code));' % (rollup_table(tbl),)
+
+def literal(txt):
+  'Quotes `txt` as an SQL string literal.'
+  return "'%s'" % (txt.replace("'", "''"),)
+
+def measures(msgc):
+  '''Returns the list of the (field, code) pairs of SQL expressions that classify a row of the table of the message class `msgc` for its rollup.
+A row counts once for every pair whose field is not NULL.'''
+  ans = [(literal(TOTAL), literal(TOTAL))]
+  for fld in msgc.fields:
+    if type(fld) == type((1, 2)):
+      fldc  = fld[0]
+      sub   = fldc.subname()
+      for exp in fldc.expectation_codes:
+        ans.append(('CASE WHEN %s THEN %s END' % (fldc.has_sql([exp]), literal(sub)), literal(exp)))
+    elif fld.expectation_codes:
+      col = fld.subname()
+      ans.append(('CASE WHEN %s IS NOT NULL THEN %s END' % (col, literal(col)), fld.code_sql(col)))
+  return ans
+
+def report_measures(msg):
+  'Returns the set of the (field, code) pairs under which the Message object `msg` counts in its rollup.'
+  ans   = set([(TOTAL, TOTAL)])
+  ents  = msg.entries
+  for sub in ents:
+    fob   = ents[sub]
+    fldc  = fob.__class__
+    if fob.several_fields:
+      ans.update([(sub, fldc.canonical(vl)) for vl in fob.working_value])
+    elif fldc.expectation_codes and fob.working_value:
+      ans.add((sub, fldc.canonical(fob.working_value[0])))
+  return ans
+
+def record(curz, tbl, counts):
+  '''Adds the `counts` (a hash of (field, code) to number of reports) to today's rollup of the report table `tbl`, with the cursor `curz`.
+Meant to run in the transaction that saves the reports; the rows are upserted in a fixed order, so that concurrent savers cannot deadlock.'''
+  if not counts:
+    return
+  rtb   = rollup_table(tbl)
+  vals  = [curz.mogrify('(CURRENT_DATE, %s, %s, %s)', (fld, cod, counts[(fld, cod)])) for fld, cod in sorted(counts)]
+  curz.execute('INSERT INTO %s (day, field, code, total) VALUES %s ON CONFLICT (day, field, code) DO UPDATE SET total = %s.total + EXCLUDED.total;' % (rtb, ', '.join(vals), rtb))
+
+def rebuild(curz, tbl, msgc, since = None, until = None):
+  '''Recomputes the rollup of the report table `tbl` (of the message class `msgc`) for the days from `since` and before `until` (all of them, if None), with the cursor `curz`.
+The report table is read once; the rollup table is locked meanwhile, so that the reports saved concurrently are neither lost nor counted twice.'''
+  rtb   = rollup_table(tbl)
+  days  = []
+  args  = []
+  if since:
+    days.append('%s >= %%s')
+    args.append(since)
+  if until:
+    days.append('%s < %%s')
+    args.append(until)
+  curz.execute('LOCK TABLE %s IN EXCLUSIVE MODE;' % (rtb,))
+  where = ' AND '.join([d % ('day',) for d in days])
+  curz.execute('DELETE FROM %s%s;' % (rtb, (' WHERE ' + where) if where else ''), args)
+  vals  = ', '.join(['(%s, %s)' % pair for pair in measures(msgc)])
+  conds = ['m.field IS NOT NULL', 'created_at IS NOT NULL'] + [d % ('created_at',) for d in days]
+  curz.execute('INSERT INTO %s (day, field, code, total) SELECT created_at::DATE, m.field, m.code, COUNT(*) FROM %s CROSS JOIN LATERAL (VALUES %s) AS m (field, code) WHERE %s GROUP BY 1, 2, 3;' % (rtb, tbl, vals, ' AND '.join(conds)), args)
@@ -0,0 +1,180 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+from thoureport.reports.reports import POOL
+from thoureport.reports.events import EVENTS_TABLE, events_ddl
+from thoureport.reports.rollups import rollup_ddl, rollup_table
+import threading
+
+def column_type(decl):
+  'Returns the type of the column declared by `decl` (as in `creation_sql`), as the catalog names it.'
+  return decl.split(' DEFAULT ')[0].lower()
+
+class ThouSchema:
+  'In-process registry of the report tables and their columns, read from the catalog once.'
+  def __init__(self):
+    self.pairs    = []
+    self.sqls     = {}
+    self.catalog  = None
+    self.indices  = {}
+    self.ready    = set()
+    self.lock     = threading.RLock()
+
+  def register(self, reps, msgs):
+    'Registers the (report class, message class) pairs of the hashes `reps` and `msgs`, by code.'
+    for cod in reps:
+      msgc  = msgs.get(cod)
+      if msgc and (reps[cod], msgc) not in self.pairs:
+        self.pairs.append((reps[cod], msgc))
+
+  def creation_sql(self, msgc, repc):
+    'The (memoised) `creation_sql` of the message class `msgc` for the report class `repc`.'
+    try:
+      return self.sqls[(msgc, repc)]
+    except KeyError:
+      ans                     = msgc.creation_sql(repc)
+      self.sqls[(msgc, repc)] = ans
+      return ans
+
+  def load(self):
+    'Reads the columns and indexes of the registered, rollup and events tables from the catalog.'
+    tbls  = list(set([self.creation_sql(msgc, repc)[0] for repc, msgc in self.pairs]))
+    tbls  = tbls + [rollup_table(tbl) for tbl in tbls] + [EVENTS_TABLE]
+    ans   = {}
+    idxs  = {}
+    if tbls:
+      with POOL.transaction() as curz:
+        curz.execute('SELECT table_name, column_name, data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name IN %s', (tuple(tbls),))
+        for tbl, col, typ in curz.fetchall():
+          ans.setdefault(tbl, {})[col] = typ
+        curz.execute('SELECT tablename, indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename IN %s', (tuple(tbls),))
+        for tbl, nom in curz.fetchall():
+          idxs.setdefault(tbl, set()).add(nom)
+    self.catalog  = ans
+    self.indices  = idxs
+    return ans
+
+  def table_ddl(self, msgc, repc, tbl = None):
+    'Returns the CREATE TABLE of the message class `msgc` for the report class `repc` (named `tbl`, if given).'
+    nom, cols = self.creation_sql(msgc, repc)
+    return 'CREATE TABLE %s (%s);' % (tbl or nom, ', '.join(['indexcol SERIAL PRIMARY KEY'] + ['%s %s' % (col[0], col[1]) for col in cols]))
+
+  def index_ddl(self, msgc, repc, tbl = None):
+    'Returns the (name, statement) pairs of the indexes, other than the primary key, of that table.'
+    nom, cols = self.creation_sql(msgc, repc)
+    tbl       = tbl or nom
+    mlts      = msgc.multiples()
+    ans       = [('%s_created_at' % (tbl,), 'CREATE INDEX IF NOT EXISTS %s_created_at ON %s (created_at);' % (tbl, tbl))]
+    seen      = set()
+    for col in cols:
+      if isinstance(col[2], type) and col[2] not in seen:
+        seen.add(col[2])
+        ans.extend(col[2].indexes(tbl, col[2] in mlts))
+    return ans
+
+  def missing_indexes(self, pairs):
+    'Returns the (table, name, statement) triples of the indexes that the tables of `pairs` lack.'
+    ans   = []
+    seen  = set()
+    for repc, msgc in pairs:
+      tbl, _  = self.creation_sql(msgc, repc)
+      have    = self.indices.get(tbl, set())
+      pkey    = ('%s_pkey' % (tbl,), 'ALTER TABLE %s ADD PRIMARY KEY (indexcol);' % (tbl,))
+      for nom, stmt in [pkey] + self.index_ddl(msgc, repc):
+        if nom not in have and nom not in seen:
+          ans.append((tbl, nom, stmt))
+          seen.add(nom)
+    return ans
+
+  def missing_ddl(self, pairs):
+    'Returns the DDL statements bringing the tables of the (report class, message class) `pairs` up to date.'
+    # Indexes missing from existing columns are left to `manage.py reportindexes`, which builds them without locking.
+    ans   = []
+    known = {}
+    if pairs and EVENTS_TABLE not in self.catalog:
+      ans.append(events_ddl())
+    for repc, msgc in pairs:
+      tbl, cols = self.creation_sql(msgc, repc)
+      if tbl not in known:
+        known[tbl]  = set(self.catalog.get(tbl, []))
+        if rollup_table(tbl) not in self.catalog:
+          ans.append(rollup_ddl(tbl))
+      mlts  = msgc.multiples()
+      if not known[tbl]:
+        ans.append(self.table_ddl(msgc, repc))
+        known[tbl].update(['indexcol'] + [col[0] for col in cols])
+        ans.extend([stmt for _, stmt in self.index_ddl(msgc, repc)])
+        continue
+      for col in cols:
+        if col[0] not in known[tbl]:
+          ans.append('ALTER TABLE %s ADD COLUMN %s %s;' % (tbl, col[0], col[1]))
+          known[tbl].add(col[0])
+          if isinstance(col[2], type):
+            ans.extend([stmt for _, stmt in col[2].indexes(tbl, col[2] in mlts)])
+    return ans
+
+  def stale(self, pairs):
+    'Returns the (table, column, type, declared type) of the columns of `pairs` not of their declared type.'
+    ans   = []
+    seen  = set()
+    for repc, msgc in pairs:
+      tbl, cols = self.creation_sql(msgc, repc)
+      have      = self.catalog.get(tbl, {})
+      for col in cols:
+        want  = column_type(col[1])
+        if col[0] in have and have[col[0]] != want and (tbl, col[0]) not in seen:
+          ans.append((tbl, col, have[col[0]], want))
+          seen.add((tbl, col[0]))
+    return ans
+
+  def apply(self, pairs):
+    'Runs the DDL missing for the `pairs` in one transaction, re-reading the catalog if there was any.'
+    ddl = self.missing_ddl(pairs)
+    if ddl:
+      try:
+        with POOL.transaction() as curz:
+          for stmt in ddl:
+            curz.execute(stmt)
+      except Exception, e:
+        raise Exception, ('Table creation: ' + str(e))
+      self.load()
+    stl = self.stale(pairs)
+    if stl:
+      raise Exception, ('Columns of the wrong type (run `manage.py retypecolumns`): %s' % (', '.join(['%s.%s is %s, not %s' % (tbl, col[0], have, want) for tbl, col, have, want in stl]),))
+    self.ready.update(pairs)
+
+  def prepare(self):
+    'Loads the catalog and creates what is missing, for all the registered pairs.'
+    with self.lock:
+      self.load()
+      self.apply(self.pairs)
+
+  def ensure(self, msgc, repc):
+    'Returns the `creation_sql` of `msgc` for `repc`, having made sure that its table is in the database.'
+    stuff = self.creation_sql(msgc, repc)
+    if (repc, msgc) in self.ready:
+      return stuff
+    with self.lock:
+      if self.catalog is None:
+        self.register({None: repc}, {None: msgc})
+        self.prepare()
+      else:
+        if (repc, msgc) not in self.pairs:
+          self.register({None: repc}, {None: msgc})
+          self.load()
+        self.apply([(repc, msgc)])
+    return stuff
+
+  def reset(self):
+    'Forgets the catalog, so that the next use reads it again.'
+    with self.lock:
+      self.catalog  = None
+      self.ready    = set()
+
+  def columns(self, tbl):
+    'Returns the hash of the columns of the table `tbl` (to their data types), as known to the registry.'
+    if self.catalog is None:
+      self.prepare()
+    return self.catalog.get(tbl, {})
+
+SCHEMA  = ThouSchema()
@@ -0,0 +1,214 @@
+# encoding: utf-8
+# vim: expandtab ts=2
+
+# The SMS log (StoredSMS), range-partitioned by the month of `when` (in UTC), so that the
+# pages of the log, which are all about the recent SMS, only read the recent partitions,
+# and so that the old months can be taken out whole: `archive_month` writes a month out
+# as gzipped JSON lines (one SMS per line), then drops its partition.
+# The partitioned table has the same name and columns, so the StoredSMS model is none the
+# wiser; its primary key has to include `when`, though, and no foreign key can point at
+# `id` alone (QueuedSMS.sms has no constraint in the database for that reason).
+# SMS that fall in no month's partition (as when `ensure_partitions` has not been run in
+# time) go to the default partition, and are moved into their month when it is made.
+
+from datetime import date
+from django.utils import timezone
+from thoureport.models import StoredSMS, QueuedSMS
+from thoureport.reports.reports import POOL
+import glob
+import gzip
+import json
+import os
+import re
+
+SMS_TABLE = StoredSMS._meta.db_table
+DEFAULT   = '%s_default' % (SMS_TABLE,)
+MONTHLY   = re.compile(r'^%s_(\d{4})(\d{2})$' % (SMS_TABLE,))
+# The SMS of a month on their way to its archive (see `append_file`).
+PARTIAL   = re.compile(r'^sms-(\d{4})-(\d{2})\.ndjson\.gz\.partial(\.\d+)?$')
+
+# The pages of the SMS log read on these; they are made on the partitioned table, and so on every partition.
+SMS_INDEXES = [('%s_when_id' % (SMS_TABLE,), '("when", id)'),
+               ('%s_sender_when_id' % (SMS_TABLE,), '(sender, "when", id)')]
+
+def month_of(dt):
+  'Returns the first day of the month of the date (or time) `dt`.'
+  return date(dt.year, dt.month, 1)
+
+def add_months(mth, n):
+  'Returns the first day of the month `n` months after (before, if negative) that of `mth`.'
+  got = mth.year * 12 + mth.month - 1 + n
+  return date(got // 12, got % 12 + 1, 1)
+
+def partition_name(mth):
+  'Returns the name of the partition of the month `mth`.'
+  return '%s_%04d%02d' % (SMS_TABLE, mth.year, mth.month)
+
+def bound(mth):
+  'Returns the SQL literal of the start of the month `mth`, in UTC.'
+  return "'%s 00:00:00+00'" % (mth.isoformat(),)
+
+# The partitioning here (default partition, indexes made on the partitioned table) takes PostgreSQL 11.
+PARTITIONS_SERVER = 110000
+
+def server_version(curz):
+  'Returns the version of the database server, as a number (90500 for 9.5, 110000 for 11.0).'
+  curz.execute('SHOW server_version_num;')
+  return int(curz.fetchone()[0])
+
+def is_partitioned(curz):
+  'Tells whether the SMS log is already partitioned.'
+  curz.execute('SELECT COUNT(*) FROM pg_partitioned_table WHERE partrelid = %s::regclass;', (SMS_TABLE,))
+  return curz.fetchone()[0] > 0
+
+def partitions(curz):
+  'Returns the hash of the monthly partitions of the SMS log, by their month (the default partition is left out).'
+  curz.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass;', (SMS_TABLE,))
+  ans = {}
+  for nom, in curz.fetchall():
+    got = MONTHLY.match(nom)
+    if got:
+      ans[date(int(got.group(1)), int(got.group(2)), 1)] = nom
+  return ans
+
+def add_partition(curz, mth):
+  '''Makes the partition of the month `mth`, with the SMS of that month that had gone to the default partition.
+It is made apart and then attached, which does not lock out the readers of the log.'''
+  nom     = partition_name(mth)
+  lo, hi  = bound(mth), bound(add_months(mth, 1))
+  curz.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS);' % (nom, SMS_TABLE))
+  # No SMS of the month may go to the default partition between their move and the attachment, which would then fail.
+  curz.execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE;' % (DEFAULT,))
+  curz.execute('WITH moved AS (DELETE FROM %s WHERE "when" >= %s AND "when" < %s RETURNING *) INSERT INTO %s SELECT * FROM moved;' % (DEFAULT, lo, hi, nom))
+  curz.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%s) TO (%s);' % (SMS_TABLE, nom, lo, hi))
+  return nom
+
+def ensure_partitions(curz, ahead, now = None):
+  '''Makes the partitions missing for the months from this one to `ahead` months on, and for those of the SMS in the default partition.
+Returns the list of the months made.'''
+  have  = partitions(curz)
+  this  = month_of(now or timezone.now())
+  want  = set([add_months(this, n) for n in range(ahead + 1)])
+  curz.execute('''SELECT DISTINCT date_trunc('month', "when" AT TIME ZONE 'UTC') FROM %s;''' % (DEFAULT,))
+  want.update([month_of(mth) for mth, in curz.fetchall()])
+  made  = sorted([mth for mth in want if mth not in have])
+  for mth in made:
+    add_partition(curz, mth)
+  return made
+
+def convert(curz, ahead, now = None):
+  '''Turns the (unpartitioned) SMS log into a partitioned table of the same name, columns, ids and indexes, with a partition for every month it has SMS of and for the `ahead` months to come.
+Meant to run in a single transaction: the log is locked against writes while its SMS are copied.
+Returns the list of the months made.'''
+  old = '%s_unpartitioned' % (SMS_TABLE,)
+  curz.execute('LOCK TABLE %s IN EXCLUSIVE MODE;' % (SMS_TABLE,))
+  curz.execute("SELECT conrelid::regclass, conname FROM pg_constraint WHERE contype = 'f' AND confrelid = %s::regclass;", (SMS_TABLE,))
+  for tbl, con in curz.fetchall():
+    curz.execute('ALTER TABLE %s DROP CONSTRAINT %s;' % (tbl, con))
+  curz.execute("SELECT pg_get_serial_sequence(%s, 'id');", (SMS_TABLE,))
+  seq,  = curz.fetchone()
+  curz.execute('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s;', (SMS_TABLE,))
+  for nom, in curz.fetchall():
+    curz.execute('ALTER INDEX %s RENAME TO %s_old;' % (nom, nom[:59]))
+  curz.execute('ALTER TABLE %s RENAME TO %s;' % (SMS_TABLE, old))
+  curz.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS, PRIMARY KEY (id, "when")) PARTITION BY RANGE ("when");' % (SMS_TABLE, old))
+  curz.execute('ALTER SEQUENCE %s OWNED BY %s.id;' % (seq, SMS_TABLE))
+  for nom, cols in SMS_INDEXES:
+    curz.execute('CREATE INDEX %s ON %s %s;' % (nom, SMS_TABLE, cols))
+  curz.execute('CREATE TABLE %s PARTITION OF %s DEFAULT;' % (DEFAULT, SMS_TABLE))
+  curz.execute('INSERT INTO %s SELECT * FROM %s;' % (DEFAULT, old))
+  curz.execute('DROP TABLE %s;' % (old,))
+  return ensure_partitions(curz, ahead, now)
+
+def expired(curz, months, now = None):
+  'Returns the sorted list of the months that have a partition and are over `months` months before this one.'
+  last  = add_months(month_of(now or timezone.now()), -months)
+  return sorted([mth for mth in partitions(curz) if mth < last])
+
+def archive_path(directory, mth):
+  'Returns the path of the archive of the month `mth`, in the directory `directory`.'
+  return os.path.join(directory, 'sms-%04d-%02d.ndjson.gz' % (mth.year, mth.month))
+
+def leftovers(curz, directory):
+  'Returns the sorted list of the months whose SMS are in a .partial file in `directory` (see `append_file`) while their partition is gone, as when an archiving was interrupted after the partition was dropped.'
+  have  = partitions(curz)
+  ans   = set()
+  for path in glob.glob(os.path.join(directory, 'sms-*.partial*')):
+    got = PARTIAL.match(os.path.basename(path))
+    if got:
+      mth = date(int(got.group(1)), int(got.group(2)), 1)
+      if mth not in have:
+        ans.add(mth)
+  return sorted(ans)
+
+def finish_appends(path):
+  '''Finishes the appends to the archive `path` that were interrupted: the archive is cut back to the size it had before each (that its part is named after), and the part appended again.'''
+  for moved in sorted(glob.glob(path + '.partial.*')):
+    base  = int(moved.rsplit('.', 1)[1])
+    with open(path, 'ab') as dest:
+      dest.truncate(base)
+      with open(moved, 'rb') as src:
+        while True:
+          blk = src.read(1 << 20)
+          if not blk:
+            break
+          dest.write(blk)
+      dest.flush()
+      os.fsync(dest.fileno())
+    os.remove(moved)
+
+def append_file(path):
+  '''Appends the gzip file `path`.partial, if there is one, to the archive `path`, as one more gzip member (which readers take for the rest of the same stream), and removes it.
+The archives are only ever appended to, never rewritten. The part is first renamed after the size of the archive, so that an append interrupted halfway is done again from there (see `finish_appends`) rather than twice.'''
+  finish_appends(path)
+  part  = path + '.partial'
+  if os.path.exists(part):
+    os.rename(part, '%s.%d' % (part, os.path.getsize(path) if os.path.exists(path) else 0))
+    finish_appends(path)
+
+def unfinished(curz, nom):
+  'Returns how many of the SMS of the partition `nom` the ingestion workers have yet to process.'
+  curz.execute("SELECT COUNT(*) FROM %s q JOIN %s s ON s.id = q.sms_id WHERE q.state IN ('queued', 'working');" % (QueuedSMS._meta.db_table, nom))
+  return curz.fetchone()[0]
+
+def archive_month(mth, directory, chunk = 2000):
+  '''Writes out the SMS of the month `mth` (oldest first) to its archive in `directory`, then drops the partition, returning how many SMS there were (None if some of them are still waiting to be processed).
+The SMS are first written to a .partial file beside the archive, which is appended to it once the partition is dropped; a .partial left behind by an interruption is either appended (if the partition is gone) or written again, and an interrupted append is finished.'''
+  nom   = partition_name(mth)
+  path  = archive_path(directory, mth)
+  part  = path + '.partial'
+  finish_appends(path)
+  with POOL.transaction() as curz:
+    if mth not in partitions(curz):
+      append_file(path)
+      return 0
+    if unfinished(curz, nom):
+      return None
+    curz.execute('LOCK TABLE %s IN SHARE MODE;' % (nom,))
+    curz.execute('SELECT COUNT(*) FROM %s;' % (nom,))
+    want, = curz.fetchone()
+    done  = 0
+    with POOL.transaction(named = True) as rows:
+      rows.itersize = chunk
+      rows.execute('SELECT id, sender, message, "when" FROM %s ORDER BY "when", id;' % (nom,))
+      with open(part, 'wb') as raw:
+        dest  = gzip.GzipFile(fileobj = raw, mode = 'wb')
+        for sid, sndr, msg, wn in rows:
+          dest.write(json.dumps({'id': sid, 'sender': sndr, 'message': msg, 'when': wn.isoformat()}) + '\n')
+          done  = done + 1
+        dest.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    if done != want:
+      raise IOError, 'Wrote %d SMS of %s to %s, and it has %d.' % (done, nom, part, want)
+    curz.execute('DROP TABLE %s;' % (nom,))
+  append_file(path)
+  return done
+
+def read_archive(path, sender = None):
+  'Iterates over the SMS (hashes of id, sender, message and when) of the archive `path`, in order, only those of the `sender` if it is given.'
+  with gzip.open(path, 'rb') as src:
+    for line in src:
+      sms = json.loads(line)
+      if sender is None or sms['sender'] == sender:
+        yield sms
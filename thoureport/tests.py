@@ -1,4 +1,337 @@
-from django.test import TestCase
 # vim: expandtab ts=2
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from StringIO import StringIO
+from thoureport.management.commands.ingestworker import claim, process, work
+from thoureport.messages.compiler import parser_for
+from thoureport.messages.corpus import corpus
+from thoureport.messages.rapid1000messages import *
+from thoureport.models import StoredSMS, SMSDigest
+from thoureport.reports.reports import ThouReport, ThouTable, ThouColumn
+from thoureport.views import REPORT_SET, MSG_ASSOC, SCHEMA, POOL, enqueue, once, store_ingest
+from thousand.settings import DEDUP_CLAIM_TIMEOUT
+import datetime
+import random
+import thoureport.messages.parser as parser
+import thoureport.reports.reports as reports
 
-# Create your tests here.
+def shape(msg):
+  'Returns what a parse gives of the Message object `msg`: its class, code, errors, and the value of each of its fields.'
+  return (msg.__class__, msg.code, msg.errors, sorted([(sub, fob.__class__, fob.working_value, fob.several_fields) for sub, fob in msg.entries.items()]))
+
+class ParserTest(SimpleTestCase):
+  'The compiled parsers (see thoureport/messages/compiler.py) against `ThouMessage.process`.'
+  SPACES  = [' ', '  ', '\t', ' \n', u'\xa0', u' \xa0 ']
+  ODD     = ['1234567890123456', '0123456789012345', '99999999999', '32768', '12.05.2013', '31.02.2013', '12', 'WT3.5', 'WT99999999.9', 'MUAC12.5', 'ANC2', 'X', 'zz', '??', u'DI\xa0', '']
+
+  def vocabulary(self, msgc):
+    'Returns the tokens that the messages of the class `msgc` are made up of: the codes of its fields (in either case), and odd ones.'
+    ans = []
+    for fld in msgc.fields:
+      exs = (fld[0] if type(fld) == type((1, 2)) else fld).expectations()
+      ans.extend(exs + [ex.lower() for ex in exs])
+    return ans + self.ODD
+
+  def test_same_parse(self):
+    'Both parsers give the same fields and errors for the same text, whether well-formed or not.'
+    rnd   = random.Random(1)
+    for cod, msgc in sorted(MSG_ASSOC.items()) + [('XXX', UnknownMessage)]:
+      voc = self.vocabulary(msgc)
+      for _ in range(300):
+        toks  = [rnd.choice(voc) for _ in range(rnd.randint(0, 12))]
+        rem   = u''.join([tok + rnd.choice(self.SPACES) for tok in toks])
+        if rnd.random() < 0.5:
+          rem = rem.strip()
+        cd    = rnd.choice([cod, cod.lower()])
+        self.assertEqual(shape(msgc.process(msgc, cd, rem)), shape(parser_for(msgc)(msgc, cd, rem)), repr(cd + ' ' + rem))
+
+def field_classes():
+  'Returns the field classes of all the messages, by name.'
+  ans = {}
+  for msgc in MSG_ASSOC.values():
+    for fld in msgc.fields:
+      fldc  = fld[0] if type(fld) == type((1, 2)) else fld
+      ans[fldc.__name__]  = fldc
+  return [ans[nom] for nom in sorted(ans)]
+
+class FieldTypeTest(TestCase):
+  'The column types of the fields (`dbtype`, `to_db` and `from_db`).'
+  # Legal tokens of the fields without expected codes, the largest number they take included.
+  SAMPLES = [(DateField, ['12.05.2013', '29.02.2012']),
+             (MUACField, ['MUAC12.5', 'MUAC3.0']),
+             (FloatedField, ['WT65.5', 'WT3']),
+             (NumberField, ['0', '12', str(SMALLINT_MAX)]),
+             (NumberedField, ['ANC2', 'PNC1', 'ANC%d' % (SMALLINT_MAX,)]),
+             (PhoneBasedIDField, ['0123456789012345']),
+             (IDField, ['1234567890123456'])]
+
+  def samples(self, fldc):
+    'Returns the list of the (token, value) pairs that the field class `fldc` is tested with: the value is what reading the token back from its column gives.'
+    if fldc.expectation_codes:
+      return [(tok, fldc.canonical(tok)) for exp in fldc.expectation_codes for tok in [exp, exp.lower()]]
+    for kls, toks in self.SAMPLES:
+      if issubclass(fldc, kls):
+        return [(tok, fldc.to_db(tok)) for tok in toks]
+    self.fail('No samples for %s.' % (fldc.__name__,))
+
+  def test_round_trip(self):
+    'What `to_db` gives of a legal token, stored in a column of the `dbtype` and read back, is turned back into it by `from_db`.'
+    curz  = connection.cursor()
+    for fldc in field_classes():
+      curz.execute('CREATE TEMPORARY TABLE roundtrip (val %s);' % (fldc.dbtype(),))
+      for tok, want in self.samples(fldc):
+        if not fldc.expectation_codes:
+          self.assertEqual(fldc.is_legal(tok), [], '%s: %s' % (fldc.__name__, tok))
+        curz.execute('INSERT INTO roundtrip (val) VALUES (%s) RETURNING val;', [fldc.to_db(tok)])
+        self.assertEqual(fldc.from_db(curz.fetchone()[0]), want, '%s: %s' % (fldc.__name__, tok))
+      curz.execute('DROP TABLE roundtrip;')
+
+  def test_bounds(self):
+    'The numbers too large for their column, and the impossible dates, are illegal.'
+    for fldc, last, past, err in [(NumberField, str(SMALLINT_MAX), str(SMALLINT_MAX + 1), 'bad_number'),
+                                  (HeightField, 'HT%d' % (SMALLINT_MAX,), 'HT%d' % (SMALLINT_MAX + 1,), 'bad_numbered_field'),
+                                  (ANCField, 'ANC%d' % (SMALLINT_MAX,), 'ANC%d' % (SMALLINT_MAX + 1,), 'anc_code'),
+                                  (PNCField, 'PNC%d' % (SMALLINT_MAX,), 'PNC%d' % (SMALLINT_MAX + 1,), 'pnc_code'),
+                                  (DateField, '28.02.2013', '29.02.2013', 'pre_4')]:
+      self.assertEqual(fldc.is_legal(last), [])
+      self.assertEqual(fldc.is_legal(past), err)
+
+  def test_too_large(self):
+    'A number too large for its column is reported, and left out of the report.'
+    msg = ThouMessage.parse('DEP 1234567890123456 %d 12.05.2013' % (SMALLINT_MAX + 1,))
+    self.assertEqual([er.code for er in msg.errors], ['bad_number'])
+    self.assertEqual(msg.entries['numberfield'].working_value, [])
+    msg = ThouMessage.parse('DEP 1234567890123456 %d 12.05.2013' % (SMALLINT_MAX,))
+    self.assertEqual(msg.errors, [])
+    self.assertEqual(msg.entries['numberfield'].db_values, [SMALLINT_MAX])
+
+def multiple_fields():
+  'Returns the field classes that the messages take several of, by name.'
+  ans = {}
+  for msgc in MSG_ASSOC.values():
+    for fldc in msgc.multiples():
+      ans[fldc.__name__]  = fldc
+  return [ans[nom] for nom in sorted(ans)]
+
+class CodeMaskTest(SimpleTestCase):
+  'The bitmasks of the codes of the multiple fields (see `CODE_BITMASKS`).'
+  def code_sets(self, fldc, rnd):
+    'Returns sets of the codes of the field class `fldc` to test with: none, each, all, and some at random, in the order of their ordinals.'
+    exps  = [exp for exp, _ in sorted(fldc.expectation_ordinals.items(), key = lambda x: x[1])]
+    return [[]] + [[exp] for exp in exps] + [exps] + [[exp for exp in exps if rnd.random() < 0.5] for _ in range(50)]
+
+  def test_round_trip(self):
+    'Every set of codes comes back from its bitmask, whatever the case it was written in, and the bitmask fits its column.'
+    rnd   = random.Random(1)
+    for fldc in multiple_fields():
+      lim = 1 << (31 if fldc.mask_dbtype() == 'INTEGER' else 63)
+      for exps in self.code_sets(fldc, rnd):
+        self.assertEqual(fldc.from_mask(fldc.to_mask(exps)), exps, fldc.__name__)
+        self.assertEqual(fldc.from_mask(fldc.to_mask([exp.lower() for exp in exps])), exps, fldc.__name__)
+        self.assertTrue(fldc.to_mask(exps) < lim, fldc.__name__)
+      self.assertEqual(fldc.from_mask(None), None)
+
+  def test_bits(self):
+    'Each code has the bit of its ordinal, and no two codes share one.'
+    for fldc in multiple_fields():
+      bits  = [fldc.bit(exp) for exp in fldc.expectation_ordinals]
+      self.assertEqual(len(set(bits)), len(bits), fldc.__name__)
+      for exp, ind in fldc.expectation_ordinals.items():
+        self.assertEqual(fldc.bit(exp), 1 << ind)
+      self.assertRaises(ValueError, fldc.bit, '??')
+
+class CodeQueryTest(TestCase):
+  'The SQL predicates on the codes of the multiple fields, with and without `CODE_BITMASKS`.'
+  def rows(self, curz, fldc, sets, masks):
+    'Makes a temporary table of the report rows with the sets of codes `sets` of the field class `fldc`, stored as bitmasks if `masks`, as a column per code otherwise.'
+    sub   = fldc.subname()
+    exps  = [exp.lower() for exp in fldc.expectation_codes]
+    if masks:
+      curz.execute('CREATE TEMPORARY TABLE codes (id INTEGER, %s %s);' % (sub, fldc.mask_dbtype()))
+    else:
+      curz.execute('CREATE TEMPORARY TABLE codes (id INTEGER, %s);' % (', '.join(['%s_%s BOOLEAN' % (sub, exp) for exp in sorted(set(exps))]),))
+    for ind, got in enumerate(sets):
+      if masks:
+        curz.execute('INSERT INTO codes VALUES (%s, %s);', [ind, fldc.to_mask(got)])
+      elif got:
+        curz.execute('INSERT INTO codes (id, %s) VALUES (%%s%s);' % (', '.join(['%s_%s' % (sub, exp.lower()) for exp in got]), ', TRUE' * len(got)), [ind])
+      else:
+        curz.execute('INSERT INTO codes (id) VALUES (%s);', [ind])
+
+  def check(self, masks):
+    'Compares, for every multiple field, the rows that the SQL predicates pick with those that have the codes.'
+    rnd   = random.Random(1)
+    curz  = connection.cursor()
+    for fldc in multiple_fields():
+      exps  = sorted(fldc.expectation_ordinals)
+      sets  = [[exp for exp in exps if rnd.random() < 0.3] for _ in range(40)]
+      self.rows(curz, fldc, sets, masks)
+      for qry in [[exp] for exp in exps] + [rnd.sample(exps, rnd.randint(2, 3)) for _ in range(20)]:
+        for sql, want in [(ThouReport.has_any(fldc, qry), lambda got: any([exp in got for exp in qry])),
+                          (ThouReport.has_all(fldc, qry), lambda got: all([exp in got for exp in qry]))]:
+          curz.execute('SELECT id FROM codes WHERE %s ORDER BY id;' % (sql,))
+          self.assertEqual([ind for ind, in curz.fetchall()], [ind for ind, got in enumerate(sets) if want(got)], sql)
+      curz.execute('DROP TABLE codes;')
+
+  def test_columns(self):
+    'The predicates on a column per code pick the rows that have the codes.'
+    self.check(False)
+
+  def test_bitmasks(self):
+    'The predicates on the bitmasks pick the rows that have the codes, and are those of the partial indexes of the codes.'
+    was = parser.CODE_BITMASKS
+    parser.CODE_BITMASKS  = True
+    try:
+      self.check(True)
+      for fldc in multiple_fields():
+        if fldc.indexed_codes:
+          for (_, stmt), exp in zip(fldc.indexes('reports', True), [exp for exp, _ in sorted(fldc.expectation_ordinals.items(), key = lambda x: x[1])]):
+            self.assertTrue(stmt.endswith(' WHERE %s;' % (ThouReport.has_code(fldc, exp),)), stmt)
+    finally:
+      parser.CODE_BITMASKS  = was
+
+class ReplayTest(TransactionTestCase):
+  'Replays of the SMS log (see thoureport/replay.py), against the test database.'
+  def setUp(self):
+    POOL.rebind(database = connection.settings_dict['NAME'])
+    SCHEMA.reset()
+
+  def tearDown(self):
+    POOL.closeall()
+    SCHEMA.reset()
+
+  def reports(self, cod):
+    'Returns how many reports the report table of the code `cod` has.'
+    with POOL.transaction() as curz:
+      curz.execute('SELECT COUNT(*) FROM %s;' % (MSG_ASSOC[cod].creation_sql(REPORT_SET[cod])[0],))
+      return curz.fetchone()[0]
+
+  def test_queued_sms(self):
+    'The SMS still queued (or being worked on) when a replay begins get their reports once, when the workers are done with them, and not from the replay as well.'
+    txts  = [txt for _, txt in corpus(20, 1, 0, 0, ['RED'])]
+    store_ingest([('0788000001', txt) for txt in txts[:10]])
+    enqueue([('0788000002', txt) for txt in txts[10:]])
+    busy  = claim(3)
+    call_command('replaysms', 'RED', processes = 1, no_swap = True, stdout = StringIO())
+    process(busy, StoredSMS.objects.in_bulk([sid for _, sid, _ in busy]))
+    while work(100):
+      pass
+    call_command('replaysms', 'RED', processes = 1, stdout = StringIO())
+    self.assertEqual(self.reports('RED'), len(txts))
+
+class DigestTest(TransactionTestCase):
+  'Re-deliveries of an SMS (see `SMSDigest`), against the test database.'
+  def setUp(self):
+    POOL.rebind(database = connection.settings_dict['NAME'])
+    SCHEMA.reset()
+
+  def tearDown(self):
+    POOL.closeall()
+    SCHEMA.reset()
+
+  def test_redelivery(self):
+    'A re-delivered SMS gets the replies of its first delivery, and is not stored again.'
+    batch = [('0788000003', txt) for _, txt in corpus(3, 2, 0, 0, ['RED'])]
+    first = once(batch, store_ingest)
+    again = once([(phone, ' %s ' % (txt.lower(),)) for phone, txt in batch], store_ingest)
+    self.assertEqual(again, [dict(got, duplicate = True) for got in first])
+    self.assertEqual(StoredSMS.objects.count(), len(batch))
+
+  def test_stale_claim(self):
+    'An SMS whose first delivery claimed it and died is a duplicate until DEDUP_CLAIM_TIMEOUT has passed, and is processed afresh after.'
+    batch = [('0788000004', corpus(1, 3, 0, 0, ['RED'])[0][1])]
+    SMSDigest.claim(batch)
+    self.assertEqual(once(batch, store_ingest), [{'duplicate': True}])
+    SMSDigest.objects.update(received = timezone.now() - datetime.timedelta(seconds = DEDUP_CLAIM_TIMEOUT + 1))
+    got = once(batch, store_ingest)
+    self.assertNotIn('duplicate', got[0])
+    self.assertEqual(once(batch, store_ingest), [dict(got[0], duplicate = True)])
+    self.assertEqual(StoredSMS.objects.count(), 1)
+
+class TableTest(SimpleTestCase):
+  'ThouTable (see thoureport/reports/reports.py), with NumPy and without.'
+  ROWS  = [('CL', ['AP', 'HE'], True, datetime.date(2013, 5, 12), 3.5, 'Kato'),
+           ('HO', ['AP'], False, datetime.date(2013, 5, 30), None, 'Revence'),
+           (None, [], True, None, 2, None),
+           ('CL', ['PA'], False, datetime.date(2013, 6, 1), 7.25, 'Kato')]
+
+  def table(self):
+    'Returns the ThouTable of the ROWS: a code, a bitmask and a flag column, then columns of a date, a number and text, whose kinds come from their values.'
+    cols  = [ThouColumn('locationfield', 'code', LocationField, integral = True),
+             ThouColumn('redsymptomcodefield', 'mask', RedSymptomCodeField),
+             ThouColumn('redsymptomcodefield_ap', 'flag', RedSymptomCodeField, 'AP'),
+             'day', 'weight', 'name']
+    return ThouTable(cols, [(loc, RedSymptomCodeField.to_mask(sym), flg, day, wt, nom) for loc, sym, flg, day, wt, nom in self.ROWS])
+
+  def check(self):
+    'Checks the values of the table of the ROWS, and what its filters and counts give.'
+    tbl = self.table()
+    self.assertEqual(len(tbl), 4)
+    self.assertEqual(tbl.rows(), [(loc, ' '.join(sym) or None, 'AP' if flg else None, day, wt, nom) for loc, sym, flg, day, wt, nom in self.ROWS])
+    self.assertEqual(tbl['locationfield':1], 'HO')
+    self.assertEqual(tbl[3], ('CL', 'PA', None, datetime.date(2013, 6, 1), 7.25, 'Kato'))
+    self.assertEqual(list(tbl.has('locationfield', 'cl')), [True, False, False, True])
+    self.assertEqual(list(tbl.has('redsymptomcodefield', 'AP')), [True, True, False, False])
+    self.assertEqual(list(tbl.has('redsymptomcodefield_ap', 'AP')), [True, False, True, False])
+    self.assertEqual(list(tbl.has('redsymptomcodefield_ap', 'HE')), [False] * 4)
+    self.assertRaises(ValueError, tbl.has, 'weight', 'AP')
+    self.assertRaises(ValueError, tbl.has, 'locationfield', '??')
+    self.assertEqual(tbl.select(tbl.has('redsymptomcodefield', 'AP')).rows(), tbl.rows()[:2])
+    self.assertEqual(tbl.counts('locationfield'), {'CL': 2, 'HO': 1})
+    self.assertEqual(tbl.counts('redsymptomcodefield'), {'AP': 2, 'HE': 1, 'PA': 1})
+    self.assertEqual(tbl.counts('redsymptomcodefield_ap'), {'AP': 2})
+    self.assertEqual(tbl.counts('name'), {'Kato': 2, 'Revence': 1})
+    self.assertEqual(tbl.group_by('locationfield', 'day', unit = 'month'), {('CL', datetime.date(2013, 5, 1)): 1, ('HO', datetime.date(2013, 5, 1)): 1, (None, None): 1, ('CL', datetime.date(2013, 6, 1)): 1})
+    self.assertEqual(tbl.group_by('locationfield', where = tbl.has('redsymptomcodefield_ap', 'AP')), {('CL',): 1, (None,): 1})
+    self.assertEqual(tbl.group_by('day', unit = 'week', where = [True, True, False, True]), {(datetime.date(2013, 5, 6),): 1, (datetime.date(2013, 5, 27),): 2})
+    self.assertRaises(ValueError, tbl.group_by, 'redsymptomcodefield')
+
+  def test_numpy(self):
+    'The table holds its columns in NumPy arrays.'
+    if reports.numeric() is None:
+      self.skipTest('NumPy is not installed.')
+    self.check()
+
+  def test_no_numpy(self):
+    'The table holds its columns in Python arrays, as when NumPy is not installed.'
+    had = (reports.numpy, reports.NUMPY_TRIED)
+    reports.numpy, reports.NUMPY_TRIED  = None, True
+    try:
+      self.check()
+    finally:
+      reports.numpy, reports.NUMPY_TRIED  = had
+
+def old_entries(msg):
+  'Returns the hash that the `entries` of the message `msg` used to be: its field objects by the `subname` of their classes, the last one winning.'
+  ans = {}
+  for fob in msg.fobs:
+    if fob is not None:
+      ans[fob.__class__.subname()]  = fob
+  return ans
+
+class EntriesTest(SimpleTestCase):
+  'The `entries` of a message (see ThouEntries).'
+  def test_same_entries(self):
+    'Both parsers give entries with the same keys and field objects as the hash that messages used to build.'
+    for _, txt in corpus(50, 2, 0.5, 0.1):
+      code, rem = ThouMessage.pull_code(txt.strip())
+      msgc      = MSG_ASSOC.get(code.upper(), UnknownMessage)
+      for msg in [ThouMessage.parse(txt), msgc.process(msgc, code, rem)]:
+        ents  = msg.entries
+        old   = old_entries(msg)
+        self.assertEqual(sorted(ents), sorted(old), txt)
+        self.assertEqual(len(ents), len(old), txt)
+        for sub in old:
+          self.assertTrue(sub in ents)
+          self.assertIs(ents[sub], old[sub])
+        self.assertEqual(ents.get('nosuchfield'), None)
+        self.assertRaises(KeyError, lambda: ents['nosuchfield'])
+
+  def test_repeated_field(self):
+    'Of a field that a message takes twice (as the dates of PRE), the entry is the last.'
+    msg = ThouMessage.parse('PRE 1234567890123456 12.05.2013 01.02.2014 2 1 NR NS HO WT55.5 TO HW')
+    self.assertEqual(msg.errors, [])
+    self.assertIs(msg.entries['datefield'], msg.fobs[2])
+    self.assertNotEqual(msg.fobs[1].working_value, msg.fobs[2].working_value)
@@ -1,15 +1,28 @@
 # vim: expandtab ts=2
 from django.contrib import messages as flashes
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.views.decorators.csrf import csrf_exempt
 from thoureport.messages.rapid1000messages import *
 from thoureport.reports.rapid1000reports import *
-from thoureport.reports.reports import THE_DATABASE as db
+from thoureport.reports.reports import POOL
 from thoureport.models import *
+from thoureport.metrics import METRICS
+from thoureport.reports.events import patient_timeline
+from thoureport.reports.rollups import rollup_table, TOTAL
+from thousand.settings import REPORT_PAGE_SIZE, REPORT_PAGE_MAX, EXPORT_CHUNK, DASHBOARD_DAYS, INGEST_ASYNC, DEDUP_WINDOW
+import csv
+import datetime
+import decimal
+import json
+import re
+import urllib
 
 REPORT_SET = {
   'RED':  RedReport,
   'REV':  RevenceReport,
 }
+SCHEMA.register(REPORT_SET, MSG_ASSOC)
 
 TRANSFORMATIONS = {
   '[!!!]' : (
@@ -34,48 +47,271 @@ def and_join(dem):
   return ', and '.join([', '.join(dem[0:-1]), dem[-1]])
 
 class TraversibleReport:
-  def __init__(self, repc, msgc):
+  'A page of the rows of a report table, newest first, keyed on `indexcol`.'
+  def __init__(self, repc, msgc, code = None, before = None, size = REPORT_PAGE_SIZE):
     self.repc                 = repc
     self.msgc                 = msgc
+    self.code                 = code
+    self.before               = before
+    self.size                 = size
+    self.older                = None
+    self.fetched              = None
     self.tablename, self.cols = msgc.creation_sql(repc)
+    self.decoders             = msgc.decoders(repc)
+
+  def decode(self, rw):
+    'Turns the row `rw`, as read from the table, into what the SMS said.'
+    return [dec(val) for dec, val in zip(self.decoders, rw)]
 
   def columns(self):
     self.msgc.create_in_db(self.repc)
     return [x[3] for x in self.cols]
 
   def rows(self):
-    curz  = db.cursor()
+    'Returns the rows of this page, read through a server-side cursor.'
+    if self.fetched is not None:
+      return self.fetched
+    self.msgc.create_in_db(self.repc)
+    qry   = 'SELECT indexcol, %s FROM %s' % (', '.join([x[0] for x in self.cols]), self.tablename)
+    args  = []
+    if self.before is not None:
+      qry   = qry + ' WHERE indexcol < %s'
+      args.append(self.before)
+    qry   = qry + ' ORDER BY indexcol DESC LIMIT %d' % (self.size,)
+    with POOL.transaction(named = True) as curz:
+      curz.itersize = self.size
+      curz.execute(qry, args)
+      got = [rw for rw in curz]
+    if len(got) == self.size:
+      self.older  = got[-1][0]
+    self.fetched  = [self.decode(rw[1:]) for rw in got]
+    return self.fetched
+
+  def indexed(self, idxs):
+    'Returns the rows (decoded) of the indices `idxs`, by index, read in one query.'
+    self.msgc.create_in_db(self.repc)
+    if not idxs:
+      return {}
+    with POOL.transaction() as curz:
+      curz.execute('SELECT indexcol, %s FROM %s WHERE indexcol = ANY(%%s)' % (', '.join([x[0] for x in self.cols]), self.tablename), (list(idxs),))
+      return dict([(rw[0], self.decode(rw[1:])) for rw in curz.fetchall()])
+
+  def stream(self, since = None, until = None):
+    'Yields all the rows of the report table, oldest first, from `since` and before `until` if given.'
+    self.msgc.create_in_db(self.repc)
     qry   = 'SELECT %s FROM %s' % (', '.join([x[0] for x in self.cols]), self.tablename)
-    curz.execute(qry)
-    rs  = curz.fetchall()
-    curz.close()
-    db.commit()
-    return rs
+    conds = []
+    args  = []
+    if since:
+      conds.append('created_at >= %s')
+      args.append(since)
+    if until:
+      conds.append('created_at < %s')
+      args.append(until)
+    if conds:
+      qry = qry + ' WHERE ' + ' AND '.join(conds)
+    with POOL.transaction(named = True) as curz:
+      curz.itersize = EXPORT_CHUNK
+      curz.execute(qry + ' ORDER BY indexcol', args)
+      for rw in curz:
+        yield self.decode(rw)
+
+class TraversibleSMS:
+  'A page of the SMS log (of everyone, or of one `sender`), newest first, keyed on ("when", id).'
+  def __init__(self, sender = None, before = None, size = REPORT_PAGE_SIZE):
+    self.sender   = sender
+    self.before   = before
+    self.size     = size
+    self.older    = None
+    self.fetched  = None
+
+  def rows(self):
+    'Returns the StoredSMS of this page, read in one query on the ("when", id) indexes.'
+    if self.fetched is not None:
+      return self.fetched
+    msgs  = StoredSMS.objects.all()
+    if self.sender:
+      msgs  = msgs.filter(sender = self.sender)
+    if self.before is not None:
+      tbl   = StoredSMS._meta.db_table
+      msgs  = msgs.extra(where = ['("when", id) < (SELECT "when", id FROM %s WHERE id = %%s)' % (tbl,)], params = [self.before])
+    got   = list(msgs.order_by('-when', '-id')[:self.size])
+    if len(got) == self.size:
+      self.older  = got[-1].id
+    self.fetched  = got
+    return got
+
+  def link(self, before = None):
+    'Returns the query string of this listing, from the SMS `before` (from the newest, if None).'
+    pars  = [('sender', self.sender), ('before', before), ('size', self.size)]
+    return urllib.urlencode([(k, v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in pars if v is not None])
+
+  def newest_link(self):
+    'The query string of the first page of this listing.'
+    return self.link()
+
+  def older_link(self):
+    'The query string of the page after this one.'
+    return self.link(self.older)
 
-def error_messenger(dat, msgobj, fld):
-  def applicant(p, n):
-    return p.replace(n, TRANSFORMATIONS[n][1](dat))
-  return reduce(applicant, TRANSFORMATIONS.keys(), fld)
+class TraversibleRollup:
+  'The per-day rollup of a report table over its last `days` days, pivoted for display.'
+  def __init__(self, repc, msgc, code, days = DASHBOARD_DAYS):
+    self.repc       = repc
+    self.msgc       = msgc
+    self.code       = code
+    self.days       = days
+    self.tablename  = msgc.creation_sql(repc)[0]
+    self.keys       = []
+    self.fetched    = None
+
+  def fetch(self):
+    'Reads the rollup rows of the period, once.'
+    if self.fetched is not None:
+      return self.fetched
+    tbl, _  = self.msgc.create_in_db(self.repc)
+    with POOL.transaction() as curz:
+      curz.execute('SELECT day, field, code, total FROM %s WHERE day > CURRENT_DATE - %%s' % (rollup_table(tbl),), (self.days,))
+      got = curz.fetchall()
+    days  = {}
+    for day, fld, cod, tot in got:
+      days.setdefault(day, {})[(fld, cod)]  = tot
+    keys          = set([(fld, cod) for _, fld, cod, _ in got])
+    self.keys     = sorted(keys, key = lambda k: (k[0] != TOTAL, k))
+    self.fetched  = [(day, days[day]) for day in sorted(days, reverse = True)]
+    return self.fetched
+
+  def columns(self):
+    self.fetch()
+    names = dict([(x.subname(), first_cap(x.display())) for x in [y[0] if type(y) == type((1, 2)) else y for y in self.msgc.fields]])
+    return ['Day'] + [('Reports' if fld == TOTAL else '%s %s' % (names.get(fld, fld), cod)) for fld, cod in self.keys]
+
+  def rows(self):
+    return [[day] + [cnts.get(key, 0) for key in self.keys] for day, cnts in self.fetch()]
+
+class ThouReplyTemplate:
+  'A reply text compiled into its literal pieces and the `TRANSFORMATIONS` placeholders between them.'
+  def __init__(self, txt):
+    self.text     = txt
+    self.segments = []
+    at            = 0
+    for mtch in PLACEHOLDERS.finditer(txt):
+      if mtch.start() > at:
+        self.segments.append((False, txt[at:mtch.start()]))
+      self.segments.append((True, mtch.group(0)))
+      at  = mtch.end()
+    if at < len(txt):
+      self.segments.append((False, txt[at:]))
+    self.fixed    = not [plc for plc, _ in self.segments if plc]
+
+  def render(self, kls):
+    'Returns the text with its placeholders replaced by what they give for the field class `kls`.'
+    if self.fixed:
+      return self.text
+    return ''.join([transformed(seg, kls) if plc else seg for plc, seg in self.segments])
+
+# The placeholders that the reply texts can have, the longest first, so that none shadows another.
+PLACEHOLDERS  = re.compile('|'.join([re.escape(k) for k in sorted(TRANSFORMATIONS, key = len, reverse = True)]))
+# The compiled reply templates, by text (so that an edited response is compiled afresh), and the transformations, by (placeholder, field class).
+TEMPLATES     = {}
+TRANSFORMED   = {}
+
+def reply_template(txt):
+  'Returns the (memoised) ThouReplyTemplate of the reply text `txt`.'
+  try:
+    return TEMPLATES[txt]
+  except KeyError:
+    ans             = ThouReplyTemplate(txt)
+    TEMPLATES[txt]  = ans
+    return ans
+
+def transformed(plc, kls):
+  'Returns the (memoised) value of the placeholder `plc` for the field class `kls`.'
+  try:
+    return TRANSFORMED[(plc, kls)]
+  except KeyError:
+    ans                     = TRANSFORMATIONS[plc][1](kls)
+    TRANSFORMED[(plc, kls)] = ans
+    return ans
+
+@METRICS.timed('replies')
+def error_replies(msgobj):
+  'Returns the list of the reply texts for the errors of the Message object `msgobj`.'
+  ans   = []
+  txts  = StoredResponse.fetch_many([er.code if isinstance(er, ThouFieldError) else er for er in msgobj.errors])
+  for er in msgobj.errors:
+    if isinstance(er, ThouFieldError):
+      kls     = er.field
+      if type(kls) == type((1, 2)):
+        kls = kls[0]
+      ans.append(reply_template(txts[er.code]).render(kls))
+    else:
+      ans.append(txts[er])
+  return ans
+
+def sms_page(req):
+  'Returns the TraversibleSMS page that the request `req` asks for, with ?sender=, ?before= and ?size=.'
+  before, size  = page_arguments(req)
+  return TraversibleSMS(req.GET.get('sender') or None, before, size)
 
 def smser(req):
-  msgs  = StoredSMS.objects.all().order_by('-when')
-  return render(req, 'smser.html', {'msgs': msgs})
+  return render(req, 'smser.html', {'msgs': sms_page(req)})
+
+def page_arguments(req):
+  'Returns the (before, size) pagination arguments of the request `req`.'
+  try:
+    before  = int(req.GET['before'])
+  except (KeyError, ValueError):
+    before  = None
+  try:
+    size    = min(max(int(req.GET['size']), 1), REPORT_PAGE_MAX)
+  except (KeyError, ValueError):
+    size    = REPORT_PAGE_SIZE
+  return (before, size)
 
 def reports(req, rcode = None):
   reps  = []
   if rcode:
     try:
-      reqc      = rcode[1:]
-      fst, snd  = metup = REPORT_SET[reqc], MSG_ASSOC[reqc]
-      reps      = [TraversibleReport(fst, snd)]
+      reqc          = rcode[1:]
+      fst, snd      = metup = REPORT_SET[reqc], MSG_ASSOC[reqc]
+      before, size  = page_arguments(req)
+      reps          = [TraversibleReport(fst, snd, reqc, before, size)]
     except Exception, e:
       raise e
       pass
   return render(req, 'reports.html', {'reps': reps, 'repset': REPORT_SET})
 
+def dashboard(req, rcode = None):
+  'Shows the daily counts of the reports of `rcode` (and of their codes) over the last ?days= days.'
+  reps  = []
+  if rcode:
+    reqc  = rcode[1:].upper()
+    if reqc not in REPORT_SET or reqc not in MSG_ASSOC:
+      raise Http404
+    try:
+      days  = min(max(int(req.GET['days']), 1), 366)
+    except (KeyError, ValueError):
+      days  = DASHBOARD_DAYS
+    reps  = [TraversibleRollup(REPORT_SET[reqc], MSG_ASSOC[reqc], reqc, days)]
+  return render(req, 'dashboard.html', {'reps': reps, 'repset': REPORT_SET})
+
 def messages(req):
-  msgs  = StoredSMS.objects.all().order_by('-when')
-  return render(req, 'messages.html', {'msgs': msgs})
+  return render(req, 'messages.html', {'msgs': sms_page(req)})
+
+def messages_since(req):
+  'Returns, in JSON, the SMS that came after the SMS ?after=, oldest first, for polling the log.'
+  try:
+    after = int(req.GET.get('after', 0))
+  except ValueError:
+    return HttpResponseBadRequest('?after= is the id of an SMS.', content_type = 'text/plain')
+  _, size = page_arguments(req)
+  msgs    = StoredSMS.objects.filter(id__gt = after)
+  if req.GET.get('sender'):
+    msgs  = msgs.filter(sender = req.GET['sender'])
+  got     = list(msgs.order_by('id').values_list('id', 'sender', 'message', 'when')[:size])
+  ans     = [{'id': sid, 'sender': sndr, 'message': msg, 'when': export_value(wn)} for sid, sndr, msg, wn in got]
+  return HttpResponse(json.dumps({'messages': ans, 'last': got[-1][0] if got else after}), content_type = 'application/json')
 
 def resp_mod(req, cod):
   try:
@@ -98,27 +334,197 @@ def sender(req):
   message               = req.POST['msg']
   req.session['phone']  = req.POST['phone']
   req.session['msg']    = message
-  sm                    = StoredSMS(message = message, sender = req.POST['phone'])
-  sm.save()
-  def unknown(uk):
-    flashes.add_message(req, flashes.ERROR, StoredResponse.fetch('unknown_message'))
-    return redirect('/')
-
-  def has_errors(msgobj):
-    for er in msgobj.errors:
-      toproc  = None
-      if type(er) == type((1, 2)):
-        kls     = er[1]
-        if type(kls) == type((1, 2)):
-          kls = kls[0]
-        toproc  = error_messenger(kls, msgobj, StoredResponse.fetch(er[0]))
-      else:
-        toproc  = StoredResponse.fetch(er)
-      flashes.add_message(req, flashes.ERROR, toproc)
-    return redirect('/')
-
-  def is_fine(msg, rept):
-    got = rept.save()
-    return redirect('/')
-
-  return ThouMessage.parse_report(req.POST['msg'], is_fine, REPORT_SET, error_handler   = has_errors, unknown_handler = unknown)
+  got                   = once([(req.POST['phone'], message)], queue if INGEST_ASYNC else store_ingest)[0]
+  if got.get('duplicate'):
+    flashes.add_message(req, flashes.INFO, 'Message already received.')
+  elif 'queued' in got:
+    flashes.add_message(req, flashes.INFO, 'Message queued (%d).' % (got['queued'],))
+  for toproc in got.get('replies', []):
+    flashes.add_message(req, flashes.ERROR, toproc)
+  return redirect('/')
+
+def ingest(batch):
+  'Parses a batch of SMS, (phone, text) pairs, saves their reports in one transaction, and returns their results.'
+  parsed  = ThouMessage.parse_many(batch, REPORT_SET)
+  saved   = iter(ThouReport.save_many([rep for _, _, rep in parsed if rep]))
+  ans     = []
+  for phone, msgobj, rep in parsed:
+    got = {'phone': phone, 'code': msgobj.code}
+    if rep:
+      got['status']   = 'saved'
+      got['index']    = next(saved)
+      got['replies']  = []
+    elif msgobj.__class__ == UnknownMessage or not msgobj.errors:
+      got['status']   = 'unknown'
+      got['replies']  = [StoredResponse.fetch('unknown_message')]
+    else:
+      got['status']   = 'errors'
+      got['replies']  = error_replies(msgobj)
+    ans.append(got)
+  return ans
+
+def store_ingest(batch):
+  'Stores the SMS of the `batch` and ingests them, in the same transaction.'
+  if not batch:
+    return []
+  with POOL.transaction() as curz:
+    pool_insert(curz, [StoredSMS(message = txt, sender = phone) for phone, txt in batch])
+    return ingest(batch)
+
+def queue(batch):
+  'Stores and queues the SMS of the `batch`, returning their `QueuedSMS.results`.'
+  return [qd.results() for qd in enqueue(batch)]
+
+def once(batch, process):
+  'Runs `process` on the SMS of the `batch` not received within `DEDUP_WINDOW`, returning the results of all.'
+  if not DEDUP_WINDOW:
+    return process(batch)
+  clms  = SMSDigest.claim(batch)
+  fresh = [dgs for dgs, old in clms if old is None]
+  outs  = {}
+  if fresh:
+    try:
+      with POOL.transaction() as curz:
+        outs  = dict(zip(fresh, process([sms for sms, (_, old) in zip(batch, clms) if old is None])))
+        SMSDigest.settle(curz, outs)
+    except DigestLost:
+      SMSDigest.release(fresh)
+      return once(batch, process)
+    except Exception:
+      SMSDigest.release(fresh)
+      raise
+  ans   = []
+  for dgs, old in clms:
+    if old is None:
+      ans.append(outs[dgs])
+    elif dgs in outs:
+      ans.append(dict(outs[dgs], duplicate = True))
+    else:
+      ans.append(old.results())
+  return ans
+
+def enqueue(batch):
+  'Stores the SMS of the `batch` and queues them for the ingestion workers, in one transaction.'
+  if not batch:
+    return []
+  with POOL.transaction() as curz:
+    sms = pool_insert(curz, [StoredSMS(message = txt, sender = phone) for phone, txt in batch])
+    return pool_insert(curz, [QueuedSMS(sms = sm) for sm in sms])
+
+@csrf_exempt
+def bulk_sender(req):
+  'Receives a JSON list of SMS, as `sender` takes them, and responds with their results, in JSON.'
+  try:
+    batch = [(sms['phone'], sms['msg']) for sms in json.loads(req.body)]
+    for phone, txt in batch:
+      if not (isinstance(phone, basestring) and isinstance(txt, basestring)):
+        raise TypeError, ('the phone and the msg have to be strings, not %r and %r' % (phone, txt))
+  except (ValueError, TypeError, KeyError), e:
+    return HttpResponseBadRequest('A JSON list of {"phone": ..., "msg": ...} objects is expected (%s).' % (str(e),), content_type = 'text/plain')
+  ans = once(batch, queue if INGEST_ASYNC else store_ingest)
+  return HttpResponse(json.dumps(ans), content_type = 'application/json')
+
+def queued(req, qid):
+  'Describes, in JSON, how far the processing of the queued SMS `qid` has gone.'
+  try:
+    qd  = QueuedSMS.objects.get(id = int(qid))
+  except QueuedSMS.DoesNotExist:
+    raise Http404
+  return HttpResponse(json.dumps(qd.results()), content_type = 'application/json')
+
+def report_tables():
+  'Returns the hash of the report tables of `REPORT_SET` to their codes.'
+  return dict([(MSG_ASSOC[cod].creation_sql(REPORT_SET[cod])[0], cod) for cod in REPORT_SET if cod in MSG_ASSOC])
+
+def timeline(req, pid):
+  'Returns, in JSON, the timeline of the patient `pid`: all of their reports, oldest first.'
+  with POOL.transaction() as curz:
+    evts  = patient_timeline(curz, pid)
+  tbls  = report_tables()
+  rows  = {}
+  for tbl in set([tbl for _, tbl, _ in evts if tbl in tbls]):
+    cod         = tbls[tbl]
+    trep        = TraversibleReport(REPORT_SET[cod], MSG_ASSOC[cod], cod)
+    rows[tbl]   = (trep, trep.indexed([ind for _, tb, ind in evts if tb == tbl]))
+  ans   = []
+  for tm, tbl, ind in evts:
+    got = {'at': export_value(tm), 'table': tbl, 'index': ind, 'code': tbls.get(tbl)}
+    if tbl in rows and ind in rows[tbl][1]:
+      trep, byi     = rows[tbl]
+      got['report'] = dict(zip([x[0] for x in trep.cols], [export_value(v) for v in byi[ind]]))
+    ans.append(got)
+  return HttpResponse(json.dumps({'patient': pid, 'events': ans}), content_type = 'application/json')
+
+def pool_stats(req):
+  'Lists the statistics of the reports database connection pool, one "name value" pair per line.'
+  stats = POOL.stats()
+  return HttpResponse(''.join(['%s %s\n' % (k, stats[k]) for k in sorted(stats)]), content_type = 'text/plain')
+
+def metrics(req):
+  'Lists the stage timings and counters of this process in the Prometheus text format.'
+  stats = POOL.stats()
+  gags  = ['min', 'max', 'open', 'idle', 'busy']
+  return HttpResponse(METRICS.text(dict([('pool_%s' % (k,), stats[k]) for k in gags]), dict([('pool_%s' % (k,), stats[k]) for k in stats if k not in gags])),
+                      content_type = 'text/plain; version=0.0.4')
+
+class EchoBuffer:
+  'A file-like object handing back what is written to it, for `csv.writer` to stream.'
+  def write(self, val):
+    return val
+
+def export_value(val):
+  'Renders the database value `val` for export.'
+  if isinstance(val, (datetime.datetime, datetime.date)):
+    return val.isoformat()
+  if isinstance(val, unicode):
+    return val.encode('utf-8')
+  if isinstance(val, decimal.Decimal):
+    return float(val)
+  return val
+
+def csv_lines(trep, rows):
+  'Yields the CSV export of the `rows` of the TraversibleReport `trep`, in chunks.'
+  wrt = csv.writer(EchoBuffer())
+  buf = [wrt.writerow([export_value(x[3]) for x in trep.cols])]
+  for rw in rows:
+    buf.append(wrt.writerow(['' if v is None else export_value(v) for v in rw]))
+    if len(buf) >= EXPORT_CHUNK:
+      yield ''.join(buf)
+      buf = []
+  yield ''.join(buf)
+
+def ndjson_lines(trep, rows):
+  'Yields the NDJSON export of the `rows` of the TraversibleReport `trep`, in chunks.'
+  names = [x[0] for x in trep.cols]
+  buf   = []
+  for rw in rows:
+    buf.append(json.dumps(dict(zip(names, [export_value(v) for v in rw]))) + '\n')
+    if len(buf) >= EXPORT_CHUNK:
+      yield ''.join(buf)
+      buf = []
+  yield ''.join(buf)
+
+EXPORT_FORMATS = {
+  'csv':    (csv_lines, 'text/csv'),
+  'ndjson': (ndjson_lines, 'application/x-ndjson'),
+}
+
+def export(req, rcode, fmt):
+  'Streams the table of the report `rcode` as CSV or NDJSON (`fmt`), within ?from= and ?to= if given.'
+  try:
+    repc, msgc  = REPORT_SET[rcode], MSG_ASSOC[rcode]
+    lines, ctyp = EXPORT_FORMATS[fmt]
+  except KeyError:
+    raise Http404
+  try:
+    since = until = None
+    if req.GET.get('from'):
+      since = datetime.datetime.strptime(req.GET['from'], '%Y-%m-%d')
+    if req.GET.get('to'):
+      until = datetime.datetime.strptime(req.GET['to'], '%Y-%m-%d') + datetime.timedelta(days = 1)
+  except ValueError, e:
+    return HttpResponseBadRequest('Dates are expected as YYYY-MM-DD (%s).' % (str(e),), content_type = 'text/plain')
+  trep  = TraversibleReport(repc, msgc, rcode)
+  ans   = StreamingHttpResponse(lines(trep, trep.stream(since, until)), content_type = ctyp)
+  ans['Content-Disposition']  = 'attachment; filename="%s.%s"' % (trep.tablename, fmt)
+  return ans
@@ -48,6 +48,8 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Last, so that a profiled view still goes through the checks of the others.
+    'thoureport.middleware.ThouMetricsMiddleware',
 )
 
 ROOT_URLCONF = 'thousand.urls'
@@ -57,6 +59,8 @@ WSGI_APPLICATION = 'thousand.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
+# PostgreSQL 9.5 or later (for ON CONFLICT and CREATE INDEX IF NOT EXISTS); 11 or later to
+# partition the SMS log (see SMS_PARTITIONS_AHEAD).
 
 DATABASES = {
     'default': {
@@ -69,6 +73,63 @@ DATABASES = {
     }
 }
 
+# The reports pool (thoureport.reports.reports.POOL): its bounds, the seconds a request waits
+# for a free connection, and the seconds idle after which a connection is pinged before use.
+REPORTS_POOL = {
+    'MIN': 1,
+    'MAX': 8,
+    'TIMEOUT': 10,
+    'HEALTH_CHECK': 30,
+}
+
+# Whether the WSGI process loads the report catalog and opens the pool as it boots (needs the database).
+WSGI_WARM_UP = False
+
+# Seconds for which a process trusts its cached StoredResponse texts.
+RESPONSE_CACHE_TTL = 300
+
+# Rows per page of /reports, of the SMS log and of /messages/since (by default, and at most).
+REPORT_PAGE_SIZE = 100
+REPORT_PAGE_MAX = 1000
+
+# Rows fetched from the database, and sent out, at a time by the /export streams.
+EXPORT_CHUNK = 2000
+
+# Whether saving reports also counts them in the per-day rollups (if not, run
+# `manage.py rollup` periodically), and how many days the dashboard shows.
+ROLLUPS_ON_SAVE = True
+DASHBOARD_DAYS = 30
+
+# Whether the codes of a multiple field are stored as one bitmask column (see `manage.py packcodes`).
+CODE_BITMASKS = False
+
+# With INGEST_ASYNC, the SMS are only queued, for `manage.py ingestworker` to process in batches;
+# a batch not done after INGEST_RETRY seconds is taken up again, up to INGEST_ATTEMPTS times.
+INGEST_ASYNC = False
+INGEST_WORKERS = 2
+INGEST_BATCH = 100
+INGEST_POLL = 1.0
+INGEST_RETRY = 300
+INGEST_ATTEMPTS = 3
+
+# An SMS repeated by the same phone within DEDUP_WINDOW seconds gets the results of the first (0: off).
+DEDUP_WINDOW = 600
+
+# Seconds after which a first delivery still without results is taken for dead, and done again.
+DEDUP_CLAIM_TIMEOUT = 120
+
+# The monthly partitions of the SMS log (PostgreSQL 11 or later): how many `manage.py smspartitions`
+# makes ahead, and after how many months `manage.py archivesms` moves them to SMS_ARCHIVE_DIR.
+SMS_PARTITIONS_AHEAD = 3
+SMS_RETENTION_MONTHS = 12
+SMS_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# Whether the ingest stages are timed (see /metrics), each field of a parse too, and whether
+# adding ?profile to a URL profiles its request.
+METRICS_ON = True
+METRICS_FIELD_TIMING = False
+METRICS_PROFILE = DEBUG
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
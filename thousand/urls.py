@@ -7,13 +7,21 @@ admin.autodiscover()
 urlpatterns = patterns('',
     url(r'^$', 'thoureport.views.smser', name='smser'),
     url(r'^sendsms$', 'thoureport.views.sender', name='sender'),
+    url(r'^sendsms/bulk$', 'thoureport.views.bulk_sender', name='bulk_sender'),
+    url(r'^sendsms/queued/(\d+)$', 'thoureport.views.queued', name='queued'),
 
     url(r'^responses$', 'thoureport.views.responses', name='responses'),
     url(r'^modresp/(.+)$', 'thoureport.views.resp_mod', name='resp_mod'),
 
     url(r'^messages$', 'thoureport.views.messages', name='messages'),
+    url(r'^messages/since$', 'thoureport.views.messages_since', name='messages_since'),
     url(r'^reports(/\w+)?$', 'thoureport.views.reports', name='reports'),
+    url(r'^dashboard(/\w+)?$', 'thoureport.views.dashboard', name='dashboard'),
+    url(r'^export/(\w+)\.(csv|ndjson)$', 'thoureport.views.export', name='export'),
+    url(r'^patients/(\w+)$', 'thoureport.views.timeline', name='timeline'),
     url(r'^docs?$', 'thoureport.views.docs', name='docs'),
+    url(r'^pool$', 'thoureport.views.pool_stats', name='pool_stats'),
+    url(r'^metrics$', 'thoureport.views.metrics', name='metrics'),
 
     url(r'^admin/', include(admin.site.urls)),
 )
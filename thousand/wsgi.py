@@ -13,3 +13,11 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "thousand.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# Load the report tables' catalog (creating what is missing), and open the pool's first
+# connections, before the first request; otherwise both wait for the first use.
+from thousand.settings import WSGI_WARM_UP
+if WSGI_WARM_UP:
+  from thoureport.views import SCHEMA, POOL
+  SCHEMA.prepare()
+  POOL.warm()